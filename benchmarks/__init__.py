@@ -0,0 +1,6 @@
+"""
+Benchmarks of txmsgpackrpc. They are not part of the installed package, run
+them from the root of the source tree, e.g.::
+
+    % python -m benchmarks.e2e run --output results.json
+"""
@@ -0,0 +1,343 @@
+"""
+End-to-end benchmark of txmsgpackrpc over loopback.
+
+For every transport supported by C{txmsgpackrpc.client} the benchmark starts
+C{MsgpackRPCServer} in the same process, connects to it and measures echo
+requests while sweeping payload sizes, concurrency and pool sizes. Results
+are written as JSON and two result files can be compared to find
+regressions::
+
+    % python -m benchmarks.e2e run --transports tcp,pool,udp --output new.json
+    % python -m benchmarks.e2e compare old.json new.json --threshold 0.1
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+import msgpack
+import twisted
+from twisted.internet import defer, reactor
+
+from txmsgpackrpc import client, mmsg
+from txmsgpackrpc.completion import FirstResponse
+from txmsgpackrpc.metrics import Histogram
+from txmsgpackrpc.server import MsgpackRPCServer
+
+
+TRANSPORTS = ('tcp', 'pool', 'unix', 'ssl', 'udp', 'udp-mmsg', 'multicast')
+DATAGRAM_TRANSPORTS = ('udp', 'udp-mmsg', 'multicast')
+
+# payload of one datagram must fit into 64 kB together with msgpack framing
+MAX_DATAGRAM_PAYLOAD = 60000
+
+MULTICAST_GROUP = '228.0.0.5'
+
+CERT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples', 'cert')
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class EchoServer(MsgpackRPCServer):
+    def remote_echo(self, value):
+        return value
+
+
+class Loopback(object):
+    """
+    Server listening on loopback interface and client connected to it using
+    one transport.
+    """
+    def __init__(self, transport, poolsize=None, multicastTimeout=0.05):
+        self.transport = transport
+        self.poolsize = poolsize
+        self.multicastTimeout = multicastTimeout
+        self.server = EchoServer()
+        self.port = None
+        self.client = None
+        self._tmpdir = None
+
+    @defer.inlineCallbacks
+    def start(self):
+        transport = self.transport
+
+        if transport in ('tcp', 'pool'):
+            self.port = reactor.listenTCP(0, self.server.getStreamFactory(), interface='127.0.0.1')
+            port = self.port.getHost().port
+            if transport == 'tcp':
+                self.client = yield client.connect('127.0.0.1', port, connectTimeout=5, maxRetries=0)
+            else:
+                self.client = yield client.connect_pool('127.0.0.1', port, poolsize=self.poolsize,
+                                                        connectTimeout=5, maxRetries=0)
+
+        elif transport == 'ssl':
+            from twisted.internet import ssl
+            context = ssl.DefaultOpenSSLContextFactory(os.path.join(CERT_DIR, 'example.key'),
+                                                       os.path.join(CERT_DIR, 'example.cert'))
+            self.port = reactor.listenSSL(0, self.server.getStreamFactory(), context, interface='127.0.0.1')
+            self.client = yield client.connect('127.0.0.1', self.port.getHost().port, connectTimeout=5,
+                                               maxRetries=0, ssl=True)
+
+        elif transport == 'unix':
+            self._tmpdir = tempfile.mkdtemp(prefix='txmsgpackrpc-bench-')
+            address = os.path.join(self._tmpdir, 'rpc.sock')
+            self.port = reactor.listenUNIX(address, self.server.getStreamFactory())
+            self.client = yield client.connect_UNIX(address, connectTimeout=5, maxRetries=0)
+
+        elif transport == 'udp':
+            self.port = reactor.listenUDP(0, self.server.getDatagramProtocol(), interface='127.0.0.1')
+            self.client = yield client.connect_UDP('127.0.0.1', self.port.getHost().port, waitTimeout=5)
+
+        elif transport == 'udp-mmsg':
+            self.port = mmsg.listenUDP(0, self.server.getDatagramProtocol(), interface='127.0.0.1')
+            self.client = yield client.connect_UDP('127.0.0.1', self.port.getHost().port, waitTimeout=5)
+
+        elif transport == 'multicast':
+            protocol = self.server.getMulticastProtocol(MULTICAST_GROUP, ttl=0)
+            self.port = reactor.listenMulticast(0, protocol, listenMultiple=True)
+            # single server answers, so request is complete with the first response
+            self.client = yield client.connect_multicast(MULTICAST_GROUP, self.port.getHost().port, ttl=0,
+                                                         waitTimeout=self.multicastTimeout,
+                                                         completion=FirstResponse())
+
+        else:
+            raise ValueError('Unknown transport: %s' % transport)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        if self.client is not None:
+            if hasattr(self.client, 'disconnect'):
+                yield self.client.disconnect()
+            else:
+                self.client.closeConnection()
+        if self.port is not None:
+            yield self.port.stopListening()
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+
+@defer.inlineCallbacks
+def runRequests(conn, payload, concurrency, requests, histogram=None):
+    """
+    Send C{requests} echo requests by C{concurrency} closed-loop workers.
+    Returns number of failed requests.
+    """
+    state = {'remaining': requests, 'errors': 0}
+
+    @defer.inlineCallbacks
+    def worker():
+        while state['remaining'] > 0:
+            state['remaining'] -= 1
+            started = default_timer()
+            try:
+                yield conn.createRequest('echo', payload)
+            except Exception:
+                state['errors'] += 1
+                continue
+            if histogram is not None:
+                histogram.record((default_timer() - started) * 1e6)
+
+    yield defer.gatherResults([worker() for _ in range(concurrency)])
+    defer.returnValue(state['errors'])
+
+
+@defer.inlineCallbacks
+def runScenario(conn, transport, size, concurrency, poolsize, requests, warmup):
+    payload = 'x' * size
+
+    yield runRequests(conn, payload, concurrency, warmup)
+
+    histogram = Histogram()
+    started = default_timer()
+    errors = yield runRequests(conn, payload, concurrency, requests, histogram)
+    elapsed = default_timer() - started
+
+    latency = dict(('p%s' % p, v) for p, v in zip(PERCENTILES, histogram.percentiles(PERCENTILES)))
+    latency.update({'min': histogram.min or 0, 'max': histogram.max or 0, 'mean': histogram.mean()})
+
+    defer.returnValue({
+        'transport': transport,
+        'size': size,
+        'concurrency': concurrency,
+        'poolsize': poolsize,
+        'requests': requests,
+        'errors': errors,
+        'elapsed': elapsed,
+        'throughput': (requests - errors) / elapsed if elapsed else 0,
+        'latency_us': latency,
+    })
+
+
+@defer.inlineCallbacks
+def runBenchmark(options):
+    results = []
+    for transport in options.transports:
+        poolsizes = options.poolsizes if transport == 'pool' else [None]
+        requests = options.requests
+        if transport == 'multicast':
+            requests = min(requests, options.multicast_requests)
+        warmup = min(options.warmup, requests)
+
+        for poolsize in poolsizes:
+            loopback = Loopback(transport, poolsize, options.multicast_timeout)
+            try:
+                yield loopback.start()
+            except Exception as e:
+                print('%s: cannot start transport: %s' % (transport, e), file=sys.stderr)
+                yield loopback.stop()
+                continue
+
+            try:
+                for size in options.sizes:
+                    if transport in DATAGRAM_TRANSPORTS and size > MAX_DATAGRAM_PAYLOAD:
+                        continue
+                    for concurrency in options.concurrency:
+                        result = yield runScenario(loopback.client, transport, size, concurrency, poolsize,
+                                                   requests, warmup)
+                        results.append(result)
+                        print(formatResult(result), file=sys.stderr)
+            finally:
+                yield loopback.stop()
+
+    defer.returnValue(results)
+
+
+def formatResult(result):
+    return '%-9s size=%-7d conc=%-4d pool=%-4s %10.1f req/s  p50=%dus p99=%dus errors=%d' % (
+        result['transport'], result['size'], result['concurrency'], result['poolsize'] or '-',
+        result['throughput'], result['latency_us']['p50'], result['latency_us']['p99'], result['errors'])
+
+
+def resultKey(result):
+    return (result['transport'], result['size'], result['concurrency'], result['poolsize'])
+
+
+def compareResults(baseline, current, threshold):
+    """
+    Compare two lists of results. Returns list of tuples(baseline result,
+    current result, throughput change, p99 latency change, regression flag).
+    Changes are relative, regression is reported when throughput drops or
+    p99 latency grows by more than C{threshold}.
+    """
+    baseline = dict((resultKey(r), r) for r in baseline)
+    comparison = []
+    for result in current:
+        base = baseline.get(resultKey(result))
+        if base is None:
+            continue
+        throughput = _relativeChange(base['throughput'], result['throughput'])
+        latency = _relativeChange(base['latency_us']['p99'], result['latency_us']['p99'])
+        regression = throughput < -threshold or latency > threshold
+        comparison.append((base, result, throughput, latency, regression))
+    return comparison
+
+
+def _relativeChange(old, new):
+    if not old:
+        return 0.0
+    return float(new - old) / old
+
+
+def metadata():
+    return {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'twisted': twisted.__version__,
+        'msgpack': '.'.join(str(v) for v in msgpack.version),
+        'msgpack_implementation': msgpack.Packer.__module__,
+        'reactor': reactor.__class__.__name__,
+    }
+
+
+def _intList(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def _transportList(value):
+    transports = [v for v in value.split(',') if v]
+    for transport in transports:
+        if transport not in TRANSPORTS:
+            raise argparse.ArgumentTypeError('unknown transport %s' % transport)
+    return transports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.e2e', description=__doc__.strip().split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+
+    run = commands.add_parser('run', help='run benchmark')
+    run.add_argument('--transports', type=_transportList, default=list(TRANSPORTS),
+                     help='comma separated transports (default: %s)' % ','.join(TRANSPORTS))
+    run.add_argument('--sizes', type=_intList, default=[16, 1024, 65536],
+                     help='comma separated payload sizes in bytes (default: 16,1024,65536)')
+    run.add_argument('--concurrency', type=_intList, default=[1, 16, 64],
+                     help='comma separated numbers of concurrent requests (default: 1,16,64)')
+    run.add_argument('--poolsizes', type=_intList, default=[1, 4, 16],
+                     help='comma separated pool sizes of pool transport (default: 1,4,16)')
+    run.add_argument('--requests', type=int, default=2000, help='requests per scenario (default: 2000)')
+    run.add_argument('--warmup', type=int, default=200, help='warmup requests per scenario (default: 200)')
+    run.add_argument('--multicast-requests', type=int, default=100,
+                     help='requests per multicast scenario (default: 100)')
+    run.add_argument('--multicast-timeout', type=float, default=0.05,
+                     help='seconds multicast client waits for response (default: 0.05)')
+    run.add_argument('--output', help='write JSON results to file instead of stdout')
+
+    compare = commands.add_parser('compare', help='compare two result files')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help='relative change reported as regression (default: 0.1)')
+
+    options = parser.parse_args(argv)
+
+    if options.command == 'run':
+        output = {}
+
+        @defer.inlineCallbacks
+        def run():
+            try:
+                output['results'] = yield runBenchmark(options)
+            finally:
+                reactor.stop()
+
+        reactor.callWhenRunning(run)
+        reactor.run()
+
+        document = json.dumps({'meta': metadata(), 'results': output.get('results', [])}, indent=2, sort_keys=True)
+        if options.output:
+            with open(options.output, 'w') as f:
+                f.write(document + '\n')
+        else:
+            print(document)
+        return 0
+
+    if options.command == 'compare':
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+        with open(options.current) as f:
+            current = json.load(f)['results']
+
+        regressions = 0
+        for base, result, throughput, latency, regression in compareResults(baseline, current, options.threshold):
+            regressions += regression
+            print('%-9s size=%-7d conc=%-4d pool=%-4s throughput %+7.1f%%  p99 %+7.1f%%%s' % (
+                result['transport'], result['size'], result['concurrency'], result['poolsize'] or '-',
+                throughput * 100, latency * 100, '  REGRESSION' if regression else ''))
+        print('%d regression(s)' % regressions)
+        return 1 if regressions else 0
+
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
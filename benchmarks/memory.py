@@ -0,0 +1,106 @@
+"""
+Memory used by idle server connections.
+
+Server protocols are connected to in-memory transports and each of them
+handles the traffic of scenario before it becomes idle. Memory retained per
+connection is measured by tracemalloc, transports are created before the
+measurement starts, so only memory of protocols is reported::
+
+    % python -m benchmarks.memory
+    % python -m benchmarks.memory --connections 100000 --output memory.json
+
+Scenarios:
+
+    idle      connection is accepted, nothing is received
+    request   one small request is answered
+    burst     one request with 64 kB argument is answered
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+
+import msgpack
+
+from benchmarks.e2e import metadata
+from benchmarks.micro import EchoServer, NullTransport
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST
+
+
+SCENARIOS = {
+    'idle': None,
+    'request': msgpack.packb((MSGTYPE_REQUEST, 1, 'echo', ('x',)), use_bin_type=False),
+    'burst': msgpack.packb((MSGTYPE_REQUEST, 1, 'echo', ('x' * 65536,)), use_bin_type=False),
+}
+
+MODES = ['default', 'lowMemory']
+
+
+def measure(scenario, lowMemory, connections):
+    """
+    Return number of bytes retained per connection after C{scenario}.
+    """
+    factory = EchoServer().getStreamFactory(lowMemory=lowMemory)
+    data = SCENARIOS[scenario]
+    transports = [NullTransport() for _ in range(connections)]
+    protocols = []
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        for transport in transports:
+            proto = factory.buildProtocol(None)
+            proto.makeConnection(transport)
+            if data is not None:
+                proto.dataReceived(data)
+            protocols.append(proto)
+        gc.collect()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    for proto in protocols:
+        proto.connectionLost()
+    return float(after - before) / connections
+
+
+def runBenchmarks(scenarios, connections):
+    results = []
+    for scenario in scenarios:
+        result = {'name': scenario, 'connections': connections}
+        for mode in MODES:
+            result['%s_bytes_per_connection' % mode] = measure(scenario, mode == 'lowMemory', connections)
+        results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.memory', description=__doc__.strip().split('\n')[0])
+    parser.add_argument('names', nargs='*', help='scenarios to run: %s' % ', '.join(sorted(SCENARIOS)))
+    parser.add_argument('--connections', type=int, default=10000, help='number of connections (default: 10000)')
+    parser.add_argument('--output', help='write JSON results to file')
+    options = parser.parse_args(argv)
+
+    scenarios = [name for name in ('idle', 'request', 'burst') if not options.names or name in options.names]
+    results = runBenchmarks(scenarios, options.connections)
+
+    if msgpack.Packer.__module__ == 'msgpack.fallback':
+        print('warning: msgpack C extension is not available, results measure pure Python fallback',
+              file=sys.stderr)
+
+    print('%-10s %14s %14s' % ('scenario', 'default B/conn', 'lowMemory B/conn'))
+    for result in results:
+        print('%-10s %14.0f %16.0f' % (result['name'], result['default_bytes_per_connection'],
+                                       result['lowMemory_bytes_per_connection']))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'meta': metadata(), 'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
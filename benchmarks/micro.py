@@ -0,0 +1,324 @@
+"""
+Microbenchmarks of the protocol hot path without sockets.
+
+Protocols are driven through in-memory transport, so results are not
+affected by kernel and network noise. Each benchmark reports time per
+operation together with tracemalloc statistics: peak of memory allocated
+while one operation runs and number of memory blocks retained per
+operation, which reveals leaks and growing caches::
+
+    % python -m benchmarks.micro
+    % python -m benchmarks.micro --number 100000 --output micro.json
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+from timeit import default_timer
+
+import msgpack
+from twisted.internet import defer
+from twisted.test import proto_helpers
+
+from benchmarks.e2e import metadata
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.handler import PooledConnectionHandler
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST, MSGTYPE_RESPONSE
+from txmsgpackrpc.pubsub import Broker
+from txmsgpackrpc.server import MsgpackRPCServer
+
+
+PAYLOAD = {'name': 'John Smith', 'age': 25, 'tags': ['a', 'b', 'c'], 'height': 167.6}
+
+
+class EchoServer(MsgpackRPCServer):
+    def remote_echo(self, value):
+        return value
+
+
+class NullTransport(proto_helpers.StringTransport):
+    """
+    Transport that discards written data.
+    """
+    def write(self, data):
+        pass
+
+
+class FakeFactory(object):
+    continueTrying = 1
+    metrics = None
+    clock = None
+
+
+class FakeConnection(object):
+    connected = 1
+
+
+def serverProtocol():
+    proto = EchoServer().getStreamFactory().buildProtocol(None)
+    proto.makeConnection(NullTransport())
+    return proto
+
+
+def clientProtocol():
+    proto = MsgpackClientFactory().buildProtocol(None)
+    proto.makeConnection(NullTransport())
+    return proto
+
+
+class Benchmark(object):
+    """
+    Base class of benchmarks. Subclasses prepare state for C{number}
+    operations in L{setUp} and perform one operation in L{run}.
+    """
+    name = None
+
+    def setUp(self, number):
+        pass
+
+    def run(self, i):
+        raise NotImplementedError()
+
+    def tearDown(self):
+        pass
+
+
+class UnpackDispatch(Benchmark):
+    """
+    rawDataReceived -> messageReceived -> requestReceived -> remote method,
+    response packing and writing is disabled.
+    """
+    name = 'unpack_dispatch'
+
+    def setUp(self, number):
+        packer = msgpack.Packer(encoding='utf-8')
+        self.proto = serverProtocol()
+        self.proto.writeMessage = lambda message, context, timing=None: None
+        self.data = [packer.pack((MSGTYPE_REQUEST, i, 'echo', (PAYLOAD,))) for i in range(number)]
+
+    def run(self, i):
+        self.proto.rawDataReceived(self.data[i])
+
+
+class PackResponse(Benchmark):
+    """
+    writeMessage of response to transport.
+    """
+    name = 'pack_response'
+
+    def setUp(self, number):
+        self.proto = serverProtocol()
+
+    def run(self, i):
+        self.proto.writeMessage((MSGTYPE_RESPONSE, i, None, PAYLOAD), None)
+
+
+class CompleteResponse(Benchmark):
+    """
+    responseReceived matching outstanding request and firing its Deferred.
+    """
+    name = 'complete_response'
+
+    def setUp(self, number):
+        self.proto = clientProtocol()
+        self.messages = []
+        for i in range(number):
+            self.proto._outgoing_requests[i] = defer.Deferred()
+            self.messages.append((MSGTYPE_RESPONSE, i, None, PAYLOAD))
+
+    def run(self, i):
+        self.proto.responseReceived(self.messages[i])
+
+
+class SendRequest(Benchmark):
+    """
+    SimpleConnectionHandler.createRequest packing and writing request.
+    """
+    name = 'send_request'
+
+    def setUp(self, number):
+        factory = MsgpackClientFactory()
+        self.proto = factory.buildProtocol(None)
+        self.proto.makeConnection(NullTransport())
+        self.call = self.prepare(factory.handler)
+
+    def prepare(self, handler):
+        return lambda *params: handler.createRequest('echo', *params)
+
+    def run(self, i):
+        self.call(PAYLOAD)
+        self.proto._outgoing_requests.clear()
+
+
+class SendRequestStub(SendRequest):
+    """
+    Call of MethodStub with pre-encoded method name.
+    """
+    name = 'send_request_stub'
+
+    def prepare(self, handler):
+        return handler.method('echo')
+
+
+class PoolCheckout(Benchmark):
+    """
+    PooledConnectionHandler.getConnection and releaseConnection of
+    non-isolated pool.
+    """
+    name = 'pool_checkout'
+
+    def setUp(self, number):
+        self.handler = PooledConnectionHandler(FakeFactory(), poolsize=10)
+        for _ in range(10):
+            self.handler.addConnection(FakeConnection())
+
+    def run(self, i):
+        self.handler.getConnection().addCallback(self.handler.releaseConnection)
+
+
+class NotifyEach(Benchmark):
+    """
+    createNotification on each of 100 connections, payload is packed 100 times.
+    """
+    name = 'notify_each_100'
+
+    def setUp(self, number):
+        self.protocols = [serverProtocol() for _ in range(100)]
+
+    def run(self, i):
+        for proto in self.protocols:
+            proto.createNotification('prices', [PAYLOAD])
+
+
+class Publish(Benchmark):
+    """
+    Broker.publish to 100 subscribed connections, payload is packed once.
+    """
+    name = 'publish_100'
+
+    def setUp(self, number):
+        self.broker = Broker()
+        for _ in range(100):
+            self.broker.subscribe(serverProtocol(), 'prices')
+
+    def run(self, i):
+        self.broker.publish('prices', PAYLOAD)
+
+
+BENCHMARKS = [UnpackDispatch, PackResponse, CompleteResponse, SendRequest, SendRequestStub, PoolCheckout,
+              NotifyEach, Publish]
+
+
+def timeBenchmark(benchmark, number, repeat):
+    """
+    Return list of durations of C{number} operations in seconds, one for
+    each repetition.
+    """
+    timings = []
+    for _ in range(repeat):
+        benchmark.setUp(number)
+        run = benchmark.run
+        gc.collect()
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            started = default_timer()
+            for i in range(number):
+                run(i)
+            timings.append(default_timer() - started)
+        finally:
+            if gcEnabled:
+                gc.enable()
+            benchmark.tearDown()
+    return timings
+
+
+def traceBenchmark(benchmark, number):
+    """
+    Return tuple(peak bytes allocated by one operation, blocks retained per
+    operation) measured by tracemalloc.
+    """
+    benchmark.setUp(number + 1)
+    run = benchmark.run
+    gc.collect()
+    tracemalloc.start()
+    try:
+        # peak of single operation, first one is left out to warm up caches
+        run(0)
+        current, _ = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+            run(1)
+            _, peak = tracemalloc.get_traced_memory()
+            peak -= current
+            start = 2
+        else:
+            peak = None
+            start = 1
+
+        before = tracemalloc.take_snapshot()
+        for i in range(start, number + 1):
+            run(i)
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+        benchmark.tearDown()
+
+    retained = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return peak, float(retained) / max(1, number + 1 - start)
+
+
+def runBenchmarks(names, number, repeat):
+    results = []
+    for cls in BENCHMARKS:
+        if names and cls.name not in names:
+            continue
+        benchmark = cls()
+        timings = timeBenchmark(benchmark, number, repeat)
+        peak, retained = traceBenchmark(benchmark, min(number, 10000))
+        timings.sort()
+        results.append({
+            'name': cls.name,
+            'number': number,
+            'repeat': repeat,
+            'ns_per_op': timings[0] / number * 1e9,
+            'ns_per_op_median': timings[len(timings) // 2] / number * 1e9,
+            'peak_bytes_per_op': peak,
+            'retained_blocks_per_op': retained,
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.micro', description=__doc__.strip().split('\n')[0])
+    parser.add_argument('names', nargs='*', help='benchmarks to run: %s' % ', '.join(b.name for b in BENCHMARKS))
+    parser.add_argument('--number', type=int, default=20000, help='operations per repetition (default: 20000)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of repetitions (default: 5)')
+    parser.add_argument('--output', help='write JSON results to file')
+    options = parser.parse_args(argv)
+
+    results = runBenchmarks(options.names, options.number, options.repeat)
+
+    if msgpack.Packer.__module__ == 'msgpack.fallback':
+        print('warning: msgpack C extension is not available, results measure pure Python fallback',
+              file=sys.stderr)
+
+    for result in results:
+        print('%-18s %9.0f ns/op (median %9.0f)  peak %6s B/op  retained %6.2f blocks/op' % (
+            result['name'], result['ns_per_op'], result['ns_per_op_median'],
+            result['peak_bytes_per_op'] if result['peak_bytes_per_op'] is not None else '-',
+            result['retained_blocks_per_op']))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'meta': metadata(), 'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
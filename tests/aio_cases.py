@@ -0,0 +1,137 @@
+"""
+Tests of asyncio backend, they use syntax of Python 3.5 and are imported by
+test_aio only where it is available.
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+from txmsgpackrpc import aio
+from txmsgpackrpc.error import ConnectionError, RateLimitExceeded, ResponseError, TimeoutError
+
+
+class EchoServer(aio.MsgpackRPCServer):
+    def __init__(self):
+        self.notifications = []
+
+    def remote_echo(self, value, msgid=None):
+        return value
+
+    async def remote_sleep(self, seconds):
+        await asyncio.sleep(seconds)
+        return seconds
+
+    def remote_fail(self):
+        raise ValueError("failure")
+
+    def remote_limited(self):
+        raise RateLimitExceeded("slow down")
+
+    def remote_notify(self, value):
+        self.notifications.append(value)
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(asyncio.wait_for(coro, 10))
+    finally:
+        loop.close()
+
+
+class AsyncioTestCase(unittest.TestCase):
+    def test_connect(self):
+        async def test():
+            server = EchoServer()
+            listener = await server.serve('127.0.0.1', 0)
+            port = listener.sockets[0].getsockname()[1]
+            client = await aio.connect('127.0.0.1', port, connectTimeout=5, waitTimeout=0.5)
+            try:
+                self.assertEqual(await client.createRequest('echo', 'hello'), 'hello')
+                self.assertEqual(await asyncio.gather(*[client.createRequest('sleep', 0.01 * i) for i in range(3)]),
+                                 [0, 0.01, 0.02])
+                with self.assertRaises(ResponseError):
+                    await client.createRequest('fail')
+                with self.assertRaises(RateLimitExceeded):
+                    await client.createRequest('limited')
+                with self.assertRaises(TimeoutError):
+                    await client.createRequest('sleep', 1)
+
+                await client.createNotification('notify', 'n')
+                self.assertEqual(await client.createRequest('echo', 'sync'), 'sync')
+                self.assertEqual(server.notifications, ['n'])
+            finally:
+                await client.disconnect()
+                listener.close()
+                await listener.wait_closed()
+        run(test())
+
+    def test_connect_pool(self):
+        async def test():
+            listener = await EchoServer().serve('127.0.0.1', 0)
+            port = listener.sockets[0].getsockname()[1]
+            client = await aio.connect_pool('127.0.0.1', port, poolsize=3, isolated=True, connectTimeout=5)
+            try:
+                results = await asyncio.gather(*[client.createRequest('echo', i) for i in range(20)])
+                self.assertEqual(results, list(range(20)))
+                self.assertEqual(client.size, 3)
+            finally:
+                await client.disconnect()
+                listener.close()
+                await listener.wait_closed()
+            self.assertEqual(client.size, 0)
+        run(test())
+
+    def test_connect_UNIX(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        address = os.path.join(tmpdir, 'rpc.sock')
+
+        async def test():
+            listener = await EchoServer().serve_UNIX(address)
+            client = await aio.connect_UNIX(address, connectTimeout=5)
+            try:
+                self.assertEqual(await client.createRequest('echo', [1, 2]), [1, 2])
+            finally:
+                await client.disconnect()
+                listener.close()
+                await listener.wait_closed()
+        run(test())
+
+    def test_connection_failed(self):
+        async def test():
+            listener = await EchoServer().serve('127.0.0.1', 0)
+            port = listener.sockets[0].getsockname()[1]
+            listener.close()
+            await listener.wait_closed()
+            with self.assertRaises(ConnectionError):
+                await aio.connect('127.0.0.1', port, connectTimeout=1, maxRetries=0)
+        run(test())
+
+    def test_reconnectBackoff(self):
+        sleeps = []
+
+        class Protocol(object):
+            async def waitClosed(self):
+                pass
+
+        async def connect(protocolFactory):
+            # accepted and closed, then refused
+            if not sleeps:
+                return None, Protocol()
+            raise OSError("refused")
+
+        async def sleep(delay):
+            sleeps.append(delay)
+            if len(sleeps) == 3:
+                connector.stopTrying()
+
+        connector = aio._ReconnectingConnector(connect, None, 1, 1, None, {})
+        connector.jitter = 0
+        self.patch(aio.asyncio, 'sleep', sleep)
+        run(connector._keepConnected())
+        self.assertEqual(sleeps, [connector.initialDelay, connector.initialDelay * connector.factor,
+                                  connector.initialDelay * connector.factor ** 2])
@@ -0,0 +1,88 @@
+"""
+Fakes and fixtures shared by test modules.
+"""
+import msgpack
+from twisted.test import proto_helpers
+
+from txmsgpackrpc.interceptor import Interceptor
+from txmsgpackrpc.server import MsgpackRPCServer
+
+
+class Echo(MsgpackRPCServer):
+    def remote_echo(self, value):
+        return value
+
+    def remote_fail(self):
+        raise ValueError("failure")
+
+
+class Recorder(Interceptor):
+    """
+    Interceptor that records names of called methods.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def intercept(self, call, proceed):
+        self.calls.append(call.method)
+        return proceed(call)
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeDatagramTransport(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data, addr=None):
+        self.written.append((data, addr))
+
+    def connect(self, host, port):
+        pass
+
+
+class FakeMulticastTransport(FakeDatagramTransport):
+    def setTTL(self, ttl):
+        pass
+
+    def joinGroup(self, group):
+        pass
+
+
+class Connector(object):
+    def __init__(self):
+        self.attempts = 0
+        self.timeout = None
+
+    def connect(self):
+        self.attempts += 1
+
+    def stopConnecting(self):
+        pass
+
+
+def connect(factory, addr=None):
+    """
+    Build protocol of C{factory} connected to C{StringTransport}, return
+    the protocol and the transport.
+    """
+    proto = factory.buildProtocol(addr)
+    transport = proto_helpers.StringTransport()
+    proto.makeConnection(transport)
+    return proto, transport
+
+
+def messages(transport):
+    """
+    Return messages written to C{StringTransport} and clear it.
+    """
+    unpacker = msgpack.Unpacker(encoding="utf-8")
+    unpacker.feed(transport.value())
+    transport.clear()
+    return list(unpacker)
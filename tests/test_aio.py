@@ -0,0 +1,9 @@
+import sys
+
+from twisted.trial import unittest
+
+if sys.version_info >= (3, 5):
+    from tests.aio_cases import AsyncioTestCase
+else:
+    class AsyncioTestCase(unittest.TestCase):
+        skip = "asyncio backend requires Python 3.5 or newer"
@@ -0,0 +1,84 @@
+import msgpack
+from twisted.internet import defer, reactor
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmsgpackrpc import client
+from txmsgpackrpc.error import ResponseError, unpackError
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST, MSGTYPE_RESPONSE
+from txmsgpackrpc.server import MsgpackRPCServer, passConnection
+
+
+class Server(MsgpackRPCServer):
+    @passConnection
+    @defer.inlineCallbacks
+    def remote_double(self, value, connection):
+        # ask the client to do the work
+        proxy = connection.getClientProxy()
+        result = yield proxy.createRequest("mul", value, 2)
+        defer.returnValue(result)
+
+    @passConnection
+    def remote_triple(self, value, msgid, connection):
+        return connection.getClientProxy().method("mul")(value, 3)
+
+    def remote_query(self, connection, sql):
+        # ordinary parameter that happens to be called connection
+        return [connection, sql]
+
+
+class ClientHandler(object):
+    def remote_mul(self, a, b):
+        return a * b
+
+
+class BidirectionalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.packer = msgpack.Packer(encoding="utf-8")
+
+    @defer.inlineCallbacks
+    def test_callback(self):
+        port = reactor.listenTCP(0, Server().getStreamFactory(), interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+
+        conn = yield client.connect_pool("127.0.0.1", port.getHost().port, poolsize=2, connectTimeout=5,
+                                         maxRetries=0, rpcHandler=ClientHandler())
+        self.addCleanup(conn.disconnect)
+        results = yield defer.gatherResults([conn.createRequest("double", 21), conn.createRequest("triple", 5)])
+        self.assertEqual(results, [42, 15])
+
+    def test_noHandler(self):
+        factory = MsgpackClientFactory()
+        proto = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "mul", (1, 2))))
+
+        unpacker = msgpack.Unpacker(encoding="utf-8")
+        unpacker.feed(transport.value())
+        (msgType, msgid, error, result), = unpacker
+        self.assertEqual((msgType, msgid, result), (MSGTYPE_RESPONSE, 1, None))
+        self.assertNotEqual(error, None)
+
+    def test_clientError(self):
+        factory = MsgpackClientFactory(rpcHandler=ClientHandler())
+        proto = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "mul", (6, 7))))
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 2, "mul", (6,))))
+
+        unpacker = msgpack.Unpacker(encoding="utf-8")
+        unpacker.feed(transport.value())
+        first, second = unpacker
+        self.assertEqual(first, [MSGTYPE_RESPONSE, 1, None, 42])
+        self.assertIsInstance(unpackError(second[2]), ResponseError)
+
+    def test_plainConnectionArgument(self):
+        proto = Server().getStreamFactory().buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "query", ("db1", "select 1"))))
+        self.assertEqual(msgpack.loads(transport.value(), encoding="utf-8"),
+                         [MSGTYPE_RESPONSE, 1, None, ["db1", "select 1"]])
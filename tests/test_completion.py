@@ -0,0 +1,88 @@
+import msgpack
+from twisted.internet import task
+from twisted.trial import unittest
+
+from txmsgpackrpc.completion import FirstResponse, FirstResponses, KnownResponders, QuietPeriod
+from txmsgpackrpc.error import TimeoutError
+from txmsgpackrpc.protocol import MSGTYPE_RESPONSE, MsgpackMulticastDatagramProtocol
+
+from tests.helpers import FakeMulticastTransport, Recorder
+
+
+class CompletionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.packer = msgpack.Packer(encoding="utf-8")
+
+    def _client(self, **kwargs):
+        proto = MsgpackMulticastDatagramProtocol("228.0.0.5", 1, 8000, timeout=30, clock=self.clock, **kwargs)
+        proto.transport = FakeMulticastTransport()
+        proto.startProtocol()
+        return proto
+
+    def _respond(self, proto, msgid, result, peer):
+        proto.datagramReceived(self.packer.pack((MSGTYPE_RESPONSE, msgid, None, result)), peer)
+
+    def test_first_responses(self):
+        proto = self._client()
+        d = proto.createRequest("echo", "x", completion=FirstResponses(2))
+        self._respond(proto, 1, "a", ("10.0.0.1", 8000))
+        self.assertNoResult(d)
+        self._respond(proto, 1, "b", ("10.0.0.2", 8000))
+        self.assertEqual(self.successResultOf(d), ("a", "b"))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        # late response is ignored
+        self._respond(proto, 1, "c", ("10.0.0.3", 8000))
+
+    def test_default_policy(self):
+        proto = self._client(completion=FirstResponse())
+        d = proto.createRequest("echo", "x")
+        self._respond(proto, 1, "a", ("10.0.0.1", 8000))
+        self.assertEqual(self.successResultOf(d), ("a",))
+
+    def test_known_responders(self):
+        proto = self._client()
+        d = proto.createRequest("echo", "x", completion=KnownResponders(["10.0.0.1", ("10.0.0.2", 8000)]))
+        self._respond(proto, 1, "a", ("10.0.0.1", 8000))
+        self._respond(proto, 1, "b", ("10.0.0.2", 9000))
+        self.assertNoResult(d)
+        self._respond(proto, 1, "c", ("10.0.0.2", 8000))
+        self.assertEqual(self.successResultOf(d), ("a", "b", "c"))
+
+    def test_quiet_period(self):
+        proto = self._client()
+        d = proto.createRequest("echo", "x", completion=QuietPeriod(0.1))
+        self.clock.advance(1)
+        self._respond(proto, 1, "a", ("10.0.0.1", 8000))
+        self.clock.advance(0.05)
+        self._respond(proto, 1, "b", ("10.0.0.2", 8000))
+        self.clock.advance(0.05)
+        self.assertNoResult(d)
+        self.clock.advance(0.05)
+        self.assertEqual(self.successResultOf(d), ("a", "b"))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_timeout(self):
+        proto = self._client(completion=FirstResponses(3))
+        d = proto.createRequest("echo", "x")
+        self._respond(proto, 1, "a", ("10.0.0.1", 8000))
+        self.clock.advance(30)
+        self.assertEqual(self.successResultOf(d), ("a",))
+
+        d = proto.createRequest("echo", "x", completion=QuietPeriod(0.1))
+        self.clock.advance(30)
+        self.failureResultOf(d, TimeoutError)
+
+    def test_interceptors(self):
+        recorder = Recorder()
+        proto = self._client(interceptors=[recorder])
+        d = proto.createRequest("echo", "x", completion=FirstResponse())
+        self._respond(proto, 1, "a", ("10.0.0.1", 8000))
+        self.assertEqual(self.successResultOf(d), ("a",))
+        self.assertEqual(recorder.calls, ["echo"])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, FirstResponses, 0)
+        self.assertRaises(ValueError, QuietPeriod, 0)
+        self.assertRaises(TypeError, self._client().createRequest, "echo", timeout=1)
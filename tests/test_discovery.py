@@ -0,0 +1,126 @@
+import msgpack
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmsgpackrpc.cluster import ClusterConnectionHandler
+from txmsgpackrpc.discovery import Announcer, DiscoveryProtocol, Membership
+from txmsgpackrpc.error import ConnectionError
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST, MSGTYPE_RESPONSE, MsgpackMulticastDatagramProtocol
+
+from tests.helpers import FakeMulticastTransport, connect, messages
+
+
+class Target(object):
+    def __init__(self):
+        self.endpoints = []
+
+    def addEndpoint(self, endpoint, info=None):
+        self.endpoints.append(endpoint)
+
+    def removeEndpoint(self, endpoint):
+        self.endpoints.remove(endpoint)
+
+
+class DiscoveryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.target = Target()
+        self.membership = Membership(self.target, expireAfter=3, clock=self.clock)
+
+    def test_announce(self):
+        announcerProto = MsgpackMulticastDatagramProtocol("228.0.0.5", 1, 8005)
+        announcerProto.transport = FakeMulticastTransport()
+        announcerProto.startProtocol()
+        announcer = Announcer(announcerProto, ("", 8000), interval=1, load=lambda: 7, capabilities=["kv"],
+                              clock=self.clock)
+
+        discovery = DiscoveryProtocol("228.0.0.5", self.membership)
+        discovery.transport = FakeMulticastTransport()
+        discovery.startProtocol()
+
+        def deliver():
+            for data, addr in announcerProto.transport.written:
+                self.assertEqual(addr, ("228.0.0.5", 8005))
+                discovery.datagramReceived(data, ("10.0.0.1", 40000))
+            del announcerProto.transport.written[:]
+
+        announcer.start()
+        deliver()
+        self.assertEqual(self.target.endpoints, [("10.0.0.1", 8000)])
+        member = self.membership.members[("10.0.0.1", 8000)]
+        self.assertEqual((member.load, member.capabilities), (7, frozenset(["kv"])))
+
+        for _ in range(5):
+            self.clock.advance(1)
+            deliver()
+        self.assertEqual(self.target.endpoints, [("10.0.0.1", 8000)])
+
+        announcer.stop()
+        deliver()
+        self.assertEqual(self.target.endpoints, [])
+        discovery.stopProtocol()
+
+    def test_expire(self):
+        self.membership.start()
+        self.membership.announced({"host": "10.0.0.1", "port": 8000})
+        self.membership.announced({"host": "10.0.0.2", "port": 8000})
+        self.assertEqual(len(self.membership), 2)
+
+        for _ in range(5):
+            self.clock.advance(1)
+            self.membership.announced({"host": "10.0.0.2", "port": 8000})
+        self.assertEqual(self.target.endpoints, [("10.0.0.2", 8000)])
+        self.membership.stop()
+
+    def test_capabilities(self):
+        membership = Membership(self.target, capabilities=["kv"], clock=self.clock)
+        membership.announced({"host": "10.0.0.1", "port": 8000, "capabilities": ["kv", "sql"]})
+        membership.announced({"host": "10.0.0.2", "port": 8000, "capabilities": ["sql"]})
+        membership.announced({"port": 8000}, ("10.0.0.3", 1234))
+        membership.announced({"host": "10.0.0.4"})
+        self.assertEqual(self.target.endpoints, [("10.0.0.1", 8000)])
+
+
+class ClusterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor = proto_helpers.MemoryReactor()
+        self.cluster = ClusterConnectionHandler(poolsize=2, reactor=self.reactor)
+        self.packer = msgpack.Packer(encoding="utf-8")
+
+    def _connect(self, index):
+        return connect(self.reactor.tcpClients[index][2])
+
+    def test_balance(self):
+        d = self.cluster.createRequest("echo", "x")
+        self.assertNoResult(d)
+
+        self.cluster.addEndpoint(("10.0.0.1", 8000))
+        self.cluster.addEndpoint(("10.0.0.2", 8000))
+        self.cluster.addEndpoint(("10.0.0.1", 8000))
+        self.assertEqual([c[:2] for c in self.reactor.tcpClients],
+                         [("10.0.0.1", 8000)] * 2 + [("10.0.0.2", 8000)] * 2)
+
+        proto1, transport1 = self._connect(0)
+        self.assertEqual(transport1.value(), self.packer.pack((MSGTYPE_REQUEST, 1, "echo", ("x",))))
+        proto1.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, 1, None, "x")))
+        self.assertEqual(self.successResultOf(d), "x")
+
+        proto2, transport2 = self._connect(2)
+        for _ in range(4):
+            self.cluster.createRequest("echo", "y")
+        self.assertEqual(len(messages(transport1)), 3)
+        self.assertEqual(len(messages(transport2)), 2)
+
+    def test_remove(self):
+        self.cluster.addEndpoint(("10.0.0.1", 8000))
+        proto, transport = self._connect(0)
+        self.cluster.removeEndpoint(("10.0.0.1", 8000))
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(self.cluster.endpoints, [])
+
+        proto.connectionLost()
+        d = self.cluster.createRequest("echo", "x")
+        self.assertNoResult(d)
+        self.cluster.disconnect()
+        self.failureResultOf(d, ConnectionError)
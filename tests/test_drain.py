@@ -0,0 +1,235 @@
+import os
+import random
+import shutil
+import socket
+import stat
+import struct
+import tempfile
+
+import msgpack
+from twisted.internet import defer, reactor, task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmsgpackrpc import client
+from txmsgpackrpc import drain
+from txmsgpackrpc.drain import GOAWAY_METHOD, handOverListeners, takeOverListeners
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST, MSGTYPE_RESPONSE, MSGTYPE_NOTIFICATION
+
+from tests import helpers
+from tests.helpers import Connector, connect, messages
+
+
+class Slow(helpers.Echo):
+    def __init__(self):
+        self.pending = []
+
+    def remote_slow(self):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+
+class Port(object):
+    listening = True
+
+    def stopListening(self):
+        self.listening = False
+
+
+class DrainTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.server = Slow()
+        self.factory = self.server.getStreamFactory()
+        self.packer = msgpack.Packer(encoding="utf-8")
+
+    def _connect(self):
+        return connect(self.factory)[0]
+
+    def _lose(self, *protos):
+        for proto in protos:
+            proto.connectionLost()
+
+    def test_drain(self):
+        busy, idle = self._connect(), self._connect()
+        busy.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "slow", [])))
+        port = Port()
+        d = self.factory.drain(timeout=10, ports=[port], clock=self.clock)
+        self.assertFalse(port.listening)
+        self.assertTrue(self.factory.draining)
+        for proto in (busy, idle):
+            self.assertEqual(messages(proto.transport), [[MSGTYPE_NOTIFICATION, GOAWAY_METHOD, []]])
+        self.assertTrue(idle.transport.disconnecting)
+        self.assertFalse(busy.transport.disconnecting)
+
+        # busy connection is closed after its response
+        self.server.pending.pop().callback("done")
+        self.assertEqual(messages(busy.transport), [[MSGTYPE_RESPONSE, 1, None, "done"]])
+        self.assertTrue(busy.transport.disconnecting)
+
+        self._lose(busy, idle)
+        self.assertIdentical(self.successResultOf(d), None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.successResultOf(self.factory.drain())
+
+    def test_requestWhileDraining(self):
+        proto = self._connect()
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "slow", [])))
+        self.factory.drain(timeout=10, clock=self.clock)
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 2, "slow", [])))
+        first, second = self.server.pending
+        first.callback(1)
+        self.assertFalse(proto.transport.disconnecting)
+        second.callback(2)
+        self.assertTrue(proto.transport.disconnecting)
+
+    def test_deadline(self):
+        proto = self._connect()
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "slow", [])))
+        d = self.factory.drain(timeout=10, clock=self.clock)
+        late = self._connect()
+        self.assertTrue(late.transport.disconnecting)
+        self._lose(late)
+
+        self.clock.advance(10)
+        self.assertTrue(proto.transport.disconnected)
+        self.assertNoResult(d)
+        self._lose(proto)
+        self.successResultOf(d)
+        self.assertEqual(self.factory._drain.aborted, 1)
+
+    def test_noConnections(self):
+        self.successResultOf(self.factory.drain(timeout=10, clock=self.clock))
+
+
+class GoAwayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = MsgpackClientFactory()
+        self.factory.clock = self.clock
+        self.proto = self.factory.buildProtocol(None)
+        self.proto.makeConnection(proto_helpers.StringTransport())
+        self.packer = msgpack.Packer(encoding="utf-8")
+        self.patch(random, "uniform", lambda low, high: high / 2.0)
+
+    def test_goaway(self):
+        handler = self.factory.handler
+        result = handler.createRequest("echo", 1)
+        self.proto.dataReceived(self.packer.pack((MSGTYPE_NOTIFICATION, GOAWAY_METHOD, [])))
+        self.assertIdentical(handler.connection, None)
+        self.assertFalse(self.proto.transport.disconnecting)
+
+        # new requests wait for the next connection
+        waiting = handler.createRequest("echo", 2)
+        self.assertEqual(handler.queued, 1)
+
+        self.proto.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, 1, None, 1)))
+        self.assertEqual(self.successResultOf(result), 1)
+        self.assertTrue(self.proto.transport.disconnecting)
+
+        self.proto.connectionLost()
+        self.factory.clientConnectionLost(Connector(), None)
+        self.assertEqual([call.getTime() for call in self.clock.getDelayedCalls()],
+                         [self.factory.reconnectStagger / 2])
+
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        self.assertEqual(messages(proto.transport), [[MSGTYPE_REQUEST, 1, "echo", [2]]])
+        self.assertNoResult(waiting)
+
+    def test_stubAfterGoaway(self):
+        echo = self.factory.handler.method("echo")
+        first = echo(1)
+        self.proto.dataReceived(self.packer.pack((MSGTYPE_NOTIFICATION, GOAWAY_METHOD, [])))
+        messages(self.proto.transport)
+
+        # the stub doesn't reuse the leaving connection
+        second = echo(2)
+        self.assertEqual(messages(self.proto.transport), [])
+        self.proto.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, 1, None, 1)))
+        self.assertEqual(self.successResultOf(first), 1)
+        self.proto.connectionLost()
+        self.factory.clientConnectionLost(Connector(), None)
+
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        self.assertEqual(messages(proto.transport), [[MSGTYPE_REQUEST, 1, "echo", [2]]])
+        self.assertIs(echo.connection, proto)
+        self.assertNoResult(second)
+
+
+class Handle(object):
+    def __init__(self, uid):
+        self.uid = uid
+
+    def getsockopt(self, level, option, size):
+        return struct.pack('3i', 1, self.uid, 1)
+
+
+class PeerTransport(proto_helpers.StringTransport):
+    def __init__(self, uid):
+        proto_helpers.StringTransport.__init__(self)
+        self.handle = Handle(uid)
+        self.descriptors = []
+
+    def getHandle(self):
+        return self.handle
+
+    def sendFileDescriptor(self, descriptor):
+        self.descriptors.append(descriptor)
+
+
+class HandOverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    @defer.inlineCallbacks
+    def test_handOver(self):
+        path = os.path.join(self.directory, "handoff.sock")
+        old, new = Slow().getStreamFactory(), Slow().getStreamFactory()
+        port = reactor.listenTCP(0, old, interface="127.0.0.1")
+        handedOver = handOverListeners(path, [port])
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+        ports = yield takeOverListeners(path, new)
+        self.addCleanup(ports[0].stopListening)
+        self.assertEqual((yield handedOver), 1)
+        self.assertFalse(os.path.exists(path))
+
+        yield old.drain(timeout=1, ports=[port])
+        conn = yield client.connect("127.0.0.1", port.getHost().port, connectTimeout=5, maxRetries=0)
+        self.addCleanup(conn.disconnect)
+        result = yield conn.createRequest("echo", "hello")
+        self.assertEqual(result, "hello")
+        self.assertEqual(len(new.connections), 1)
+
+    def test_otherUser(self):
+        if not hasattr(socket, "SO_PEERCRED"):
+            raise unittest.SkipTest("peer credentials are not available")
+        port = reactor.listenTCP(0, Slow().getStreamFactory(), interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        factory = drain._HandOverFactory([port])
+        proto = factory.buildProtocol(None)
+        transport = PeerTransport(os.getuid() + 1)
+        proto.makeConnection(transport)
+        proto.connectionLost(None)
+        self.assertEqual((transport.descriptors, transport.value()), ([], b""))
+        self.assertTrue(transport.disconnecting)
+        self.assertNoResult(factory.deferred)
+
+    @defer.inlineCallbacks
+    def test_staleSocket(self):
+        path = os.path.join(self.directory, "handoff.sock")
+        stale = socket.socket(socket.AF_UNIX)
+        stale.bind(path)
+        stale.close()
+        port = reactor.listenTCP(0, Slow().getStreamFactory(), interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        handOverListeners(path, [port])
+
+        ports = yield takeOverListeners(path, Slow().getStreamFactory())
+        for taken in ports:
+            self.addCleanup(taken.stopListening)
+        self.assertEqual(len(ports), 1)
@@ -0,0 +1,74 @@
+import msgpack
+from twisted.internet import task
+from twisted.trial import unittest
+
+from txmsgpackrpc.fragment import FRAGMENT_HEADER, Reassembler, fragment, isFragment
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST, MSGTYPE_RESPONSE, MsgpackDatagramProtocol
+
+from tests.helpers import Echo, FakeDatagramTransport
+
+
+class FragmentTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_fragment(self):
+        data = bytes(bytearray(range(256))) * 10
+        datagrams = fragment(data, 1, 100)
+        self.assertTrue(all(len(d) <= 100 and isFragment(d) for d in datagrams))
+        self.assertEqual(len(datagrams), -(-len(data) // (100 - FRAGMENT_HEADER.size)))
+
+        reassembler = Reassembler(clock=self.clock)
+        peer = ("127.0.0.1", 1)
+        results = [reassembler.feed(peer, d) for d in reversed(datagrams)]
+        self.assertEqual(results[:-1], [None] * (len(datagrams) - 1))
+        self.assertEqual(results[-1], data)
+        self.assertEqual(len(reassembler), 0)
+
+    def test_bounded(self):
+        reassembler = Reassembler(maxsize=2, timeout=1, maxMessageSize=500, clock=self.clock)
+        for messageId in range(5):
+            reassembler.feed(("127.0.0.1", 1), fragment(b"x" * 200, messageId, 100)[0])
+        self.assertEqual(len(reassembler), 2)
+
+        # expired incomplete message is not completed by late fragment
+        datagrams = fragment(b"y" * 200, 10, 100)
+        reassembler.feed(("127.0.0.1", 1), datagrams[0])
+        self.clock.advance(2)
+        self.assertIdentical(reassembler.feed(("127.0.0.1", 1), datagrams[1]), None)
+
+        # too large message
+        for d in fragment(b"z" * 1000, 11, 100):
+            self.assertIdentical(reassembler.feed(("127.0.0.1", 1), d), None)
+        self.assertTrue(reassembler.invalid > 0)
+
+    def test_protocol(self):
+        server = Echo().getDatagramProtocol(mtu=512, clock=self.clock)
+        server.transport = FakeDatagramTransport()
+        server.startProtocol()
+
+        client = MsgpackDatagramProtocol(address=("127.0.0.1", 9000), mtu=512, clock=self.clock)
+        client.transport = FakeDatagramTransport()
+        client.startProtocol()
+
+        value = u"x" * 5000
+        d = client.createRequest("echo", value)
+        self.assertTrue(len(client.transport.written) > 1)
+        self.assertTrue(all(len(data) <= 512 for data, _ in client.transport.written))
+
+        for data, _ in client.transport.written:
+            server.datagramReceived(data, ("127.0.0.1", 5000))
+        self.assertTrue(len(server.transport.written) > 1)
+
+        for data, _ in server.transport.written:
+            client.datagramReceived(data, ("127.0.0.1", 9000))
+        self.assertEqual(self.successResultOf(d), value)
+
+    def test_small_message_not_fragmented(self):
+        client = MsgpackDatagramProtocol(address=("127.0.0.1", 9000), mtu=512, clock=self.clock)
+        client.transport = FakeDatagramTransport()
+        client.startProtocol()
+        client.createRequest("echo", "x")
+        packer = msgpack.Packer(encoding="utf-8")
+        self.assertEqual(client.transport.written, [(packer.pack((MSGTYPE_REQUEST, 1, "echo", ("x",))), ("127.0.0.1", 9000))])
+        client.datagramReceived(packer.pack((MSGTYPE_RESPONSE, 1, None, "x")), ("127.0.0.1", 9000))
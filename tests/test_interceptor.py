@@ -0,0 +1,95 @@
+import msgpack
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.interceptor import Interceptor, InterceptorChain
+from txmsgpackrpc.protocol import MSGTYPE_NOTIFICATION, MSGTYPE_REQUEST, MSGTYPE_RESPONSE
+
+from tests import helpers
+
+
+class Echo(helpers.Echo):
+    def __init__(self):
+        self.notifications = []
+
+    def remote_notify(self, value):
+        self.notifications.append(value)
+
+
+class Recorder(Interceptor):
+    def __init__(self, name, log):
+        self.name = name
+        self.log = log
+
+    def intercept(self, call, proceed):
+        self.log.append(('enter', self.name, call.role, call.method))
+        d = proceed(call)
+
+        def done(result):
+            self.log.append(('exit', self.name, result))
+            return result
+        return d.addBoth(done)
+
+
+class InterceptorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.packer = msgpack.Packer(encoding="utf-8")
+        self.log = []
+
+    def _serverProtocol(self, interceptors):
+        self.server = Echo()
+        factory = self.server.getStreamFactory(interceptors=interceptors)
+        proto = factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        proto.makeConnection(self.transport)
+        return proto
+
+    def _response(self):
+        return msgpack.loads(self.transport.value(), encoding="utf-8")
+
+    def test_order_and_outcome(self):
+        proto = self._serverProtocol([Recorder('outer', self.log), Recorder('inner', self.log)])
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "echo", ("x",))))
+
+        self.assertEqual(self._response(), [MSGTYPE_RESPONSE, 1, None, "x"])
+        self.assertEqual(self.log, [('enter', 'outer', 'server', 'echo'),
+                                    ('enter', 'inner', 'server', 'echo'),
+                                    ('exit', 'inner', 'x'),
+                                    ('exit', 'outer', 'x')])
+
+    def test_modify_and_short_circuit(self):
+        def upper(call, proceed):
+            call.params = [p.upper() for p in call.params]
+            return proceed(call)
+
+        def cache(call, proceed):
+            if call.params == ["CACHED"]:
+                return "from cache"
+            return proceed(call)
+
+        proto = self._serverProtocol(InterceptorChain([upper, cache]))
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "echo", ("x",))))
+        self.assertEqual(self._response()[3], "X")
+
+        self.transport.clear()
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 2, "echo", ("cached",))))
+        self.assertEqual(self._response()[3], "from cache")
+
+    def test_notification(self):
+        proto = self._serverProtocol([Recorder('only', self.log)])
+        proto.dataReceived(self.packer.pack((MSGTYPE_NOTIFICATION, "notify", ("n",))))
+        self.assertEqual(self.server.notifications, ["n"])
+        self.assertEqual(self.log[0], ('enter', 'only', 'server', 'notify'))
+
+    def test_client(self):
+        factory = MsgpackClientFactory(interceptors=[Recorder('client', self.log)])
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+
+        d = proto.createRequest("echo", ("x",))
+        proto.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, 1, None, "y")))
+
+        self.assertEqual(self.successResultOf(d), "y")
+        self.assertEqual(self.log, [('enter', 'client', 'client', 'echo'),
+                                    ('exit', 'client', 'y')])
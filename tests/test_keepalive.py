@@ -0,0 +1,92 @@
+import msgpack
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmsgpackrpc.error import TimeoutError
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.keepalive import PING_METHOD
+from txmsgpackrpc.metrics import Metrics, ROLE_CLIENT
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST, MSGTYPE_RESPONSE
+from txmsgpackrpc.server import MsgpackRPCServer
+
+from tests.helpers import messages
+
+
+class KeepAliveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = MsgpackClientFactory(keepaliveInterval=10, keepaliveTimeout=2)
+        self.factory.clock = self.clock
+        self.proto = self.factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.transport)
+        self.packer = msgpack.Packer(encoding="utf-8")
+
+    def test_rtt(self):
+        self.assertIdentical(self.proto.rtt, None)
+        self.clock.advance(10)
+        self.assertEqual(messages(self.transport), [[MSGTYPE_REQUEST, 1, PING_METHOD, []]])
+        self.clock.advance(0.5)
+        self.proto.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, 1, None, None)))
+        self.assertEqual(self.proto.rtt, 0.5)
+
+        self.clock.advance(10)
+        self.assertEqual(messages(self.transport), [[MSGTYPE_REQUEST, 2, PING_METHOD, []]])
+        self.clock.advance(1.5)
+        self.proto.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, 2, None, None)))
+        self.assertEqual(self.proto.rtt, 0.625)
+        self.assertEqual(self.proto.keepalive.lastRtt, 1.5)
+        self.assertFalse(self.transport.disconnecting)
+
+    def test_dead(self):
+        self.clock.advance(10)
+        self.clock.advance(2)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(self.proto.keepalive.expired, 1)
+
+        self.proto.connectionLost()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_errorAnswer(self):
+        # peer without keepalive support still proves the connection is alive
+        self.clock.advance(10)
+        self.proto.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, 1, "unknown method", None)))
+        self.clock.advance(5)
+        self.assertFalse(self.transport.disconnecting)
+        self.clock.advance(5)
+        self.assertEqual(messages(self.transport)[-1], [MSGTYPE_REQUEST, 2, PING_METHOD, []])
+
+    def test_server(self):
+        proto = MsgpackRPCServer().getStreamFactory().buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 7, PING_METHOD, [])))
+        self.assertEqual(msgpack.unpackb(transport.value()), [MSGTYPE_RESPONSE, 7, None, None])
+
+    def test_waitTimeout(self):
+        # answered probes keep the connection alive, but a request without
+        # response still times out
+        metrics = Metrics()
+        factory = MsgpackClientFactory(waitTimeout=5, keepaliveInterval=1, metrics=metrics)
+        factory.clock = self.clock
+        proto = factory.buildProtocol(None)
+        proto.setTimeout(None)
+        proto.callLater = self.clock.callLater
+        proto.setTimeout(5)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        d = proto.createRequest("stuck", [])
+
+        for _ in range(6):
+            self.clock.advance(1)
+            unpacker = msgpack.Unpacker(encoding="utf-8")
+            unpacker.feed(transport.value())
+            transport.clear()
+            for msgType, msgid, method, params in unpacker:
+                if method == PING_METHOD:
+                    proto.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, msgid, None, None)))
+        self.failureResultOf(d, TimeoutError)
+
+        # probes are not client calls
+        self.assertEqual(list(metrics.snapshot()[ROLE_CLIENT]), ["stuck"])
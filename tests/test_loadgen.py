@@ -0,0 +1,111 @@
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from txmsgpackrpc.error import ConnectionError
+from txmsgpackrpc.loadgen import LoadGenerator, isSaturated, percentileDistribution, ramp
+from txmsgpackrpc.metrics import Histogram
+
+
+class FakeConnection(object):
+    """
+    Connection that responds after C{serviceTime} seconds, one request
+    at a time, like a server with single worker.
+    """
+    def __init__(self, clock, serviceTime):
+        self.clock = clock
+        self.serviceTime = serviceTime
+        self.busyUntil = 0
+        self.requests = []
+
+    def createRequest(self, method, *params):
+        self.requests.append((method, params))
+        d = defer.Deferred()
+        self.busyUntil = max(self.busyUntil, self.clock.seconds()) + self.serviceTime
+        self.clock.callLater(self.busyUntil - self.clock.seconds(), d.callback, params)
+        return d
+
+
+class LoadGeneratorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def advance(self, seconds, step=0.001):
+        for _ in range(int(round(seconds / step))):
+            self.clock.advance(step)
+
+    def test_fixed_rate(self):
+        conn = FakeConnection(self.clock, 0.002)
+        d = LoadGenerator(conn, "echo", ("x",), rate=100, duration=1, clock=self.clock).run()
+        self.advance(1.1)
+        result = self.successResultOf(d)
+
+        self.assertEqual(result["sent"], 100)
+        self.assertEqual(result["completed"], 100)
+        self.assertEqual(conn.requests[0], ("echo", ("x",)))
+        self.assertFalse(isSaturated(result))
+        self.assertEqual(result["latency_us"]["max"], 2000)
+
+    def test_coordinated_omission(self):
+        # server stalls for 1 second, requests intended to be sent during
+        # the stall must report latency from intended send time
+        conn = FakeConnection(self.clock, 0.001)
+        generator = LoadGenerator(conn, "echo", rate=100, duration=2, maxOutstanding=1, clock=self.clock)
+        d = generator.run()
+        self.advance(0.5)
+        conn.serviceTime = 1
+        self.advance(0.01)
+        conn.serviceTime = 0.001
+        self.advance(2)
+        result = self.successResultOf(d)
+
+        self.assertEqual(result["sent"], 200)
+        self.assertTrue(result["latency_us"]["max"] >= 990000)
+        self.assertTrue(result["latency_us"]["p90"] > 100000)
+        self.assertTrue(result["service_latency_us"]["p90"] < 10000)
+
+    def test_drain_timeout(self):
+        conn = FakeConnection(self.clock, 100)
+        d = LoadGenerator(conn, "echo", rate=10, duration=1, drainTimeout=1, clock=self.clock).run()
+        self.advance(2.5, step=0.01)
+        result = self.successResultOf(d)
+
+        self.assertEqual(result["timeouts"], 10)
+        self.assertTrue(isSaturated(result))
+        self.clock.advance(1000)
+
+    def test_synchronous_error(self):
+        class Disconnected(object):
+            def createRequest(self, method, *params):
+                raise ConnectionError("Not connected")
+
+        generator = LoadGenerator(Disconnected(), "echo", rate=10, duration=1, maxOutstanding=2, clock=self.clock)
+        d = generator.run()
+        self.advance(1.1, step=0.01)
+        result = self.successResultOf(d)
+
+        self.assertEqual((result["sent"], result["errors"]), (10, 10))
+        self.assertEqual(generator.outstanding, 0)
+        self.assertEqual(generator._pending, {})
+
+    def test_ramp_knee(self):
+        conn = FakeConnection(self.clock, 0.004)
+        d = ramp(conn, "echo", (), [100, 200, 400], 1, drainTimeout=0.5, clock=self.clock)
+        self.advance(5)
+        results, knee = self.successResultOf(d)
+
+        self.assertEqual(knee, 200)
+        self.assertEqual([r["saturated"] for r, _ in results], [False, False, True])
+
+
+class PercentileDistributionTestCase(unittest.TestCase):
+    def test_format(self):
+        h = Histogram()
+        for value in range(1, 1001):
+            h.record(value * 1000)
+        text = percentileDistribution(h, scale=1000)
+        lines = text.splitlines()
+
+        self.assertEqual(lines[0].split(), ["Value", "Percentile", "TotalCount", "1/(1-Percentile)"])
+        self.assertEqual(lines[2].split()[1], "0.000000000000")
+        self.assertEqual(lines[-3].split()[1:3], ["1.000000000000", "1000"])
+        self.assertIn("Total count    =         1000", lines[-1])
@@ -0,0 +1,88 @@
+import msgpack
+from twisted.internet import defer
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmsgpackrpc.core import NO_REQUESTS
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST, MSGTYPE_RESPONSE
+from txmsgpackrpc.slowlog import SlowRequestLog
+
+from tests import helpers
+from tests.helpers import connect, messages
+
+
+class Echo(helpers.Echo):
+    def __init__(self):
+        self.pending = []
+
+    def remote_wait(self):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+
+class LowMemoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = Echo()
+        self.packer = msgpack.Packer(encoding="utf-8")
+
+    def _connect(self, **kwargs):
+        return connect(self.server.getStreamFactory(lowMemory=True, **kwargs))
+
+    def test_idle(self):
+        proto1, _ = self._connect()
+        proto2, _ = self._connect()
+        self.assertIdentical(proto1._packer, proto2._packer)
+        self.assertIdentical(proto1._unpacker, None)
+        self.assertIdentical(proto1._incoming_requests, NO_REQUESTS)
+        self.assertIdentical(proto1._outgoing_requests, NO_REQUESTS)
+
+    def test_release(self):
+        proto, transport = self._connect()
+        data = self.packer.pack((MSGTYPE_REQUEST, 1, "echo", ("x" * 1000,)))
+
+        # partial message keeps unpacker
+        proto.dataReceived(data[:10])
+        self.assertNotIdentical(proto._unpacker, None)
+        proto.dataReceived(data[10:] + data[:5])
+        self.assertNotIdentical(proto._unpacker, None)
+        proto.dataReceived(data[5:])
+        self.assertIdentical(proto._unpacker, None)
+        self.assertEqual(messages(transport),
+                         [[MSGTYPE_RESPONSE, 1, None, "x" * 1000]] * 2)
+        self.assertIdentical(proto._incoming_requests, NO_REQUESTS)
+
+    def test_pendingRequest(self):
+        proto, transport = self._connect()
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "wait", ())))
+        self.assertEqual(list(proto._incoming_requests), [1])
+
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 2, "echo", (1,))))
+        self.assertEqual(messages(transport), [[MSGTYPE_RESPONSE, 2, None, 1]])
+        self.assertEqual(list(proto._incoming_requests), [1])
+
+        self.server.pending.pop().callback("done")
+        self.assertEqual(messages(transport), [[MSGTYPE_RESPONSE, 1, None, "done"]])
+        self.assertIdentical(proto._incoming_requests, NO_REQUESTS)
+
+    def test_slowLog(self):
+        proto, transport = self._connect(slowLog=SlowRequestLog(threshold=0))
+        data = self.packer.pack((MSGTYPE_REQUEST, 1, "echo", ("x",)))
+        proto.dataReceived(data)
+        self.assertIdentical(proto._unpacker, None)
+        proto.dataReceived(data + data[:3])
+        self.assertEqual(proto._unpackedOffset, len(data))
+        proto.dataReceived(data[3:])
+        self.assertIdentical(proto._unpacker, None)
+        self.assertEqual(proto._unpackedOffset, 0)
+        self.assertEqual(len(messages(transport)), 3)
+
+    def test_client(self):
+        factory = MsgpackClientFactory()
+        proto = factory.protocol(factory, lowMemory=True)
+        proto.makeConnection(proto_helpers.StringTransport())
+        d = proto.createRequest("echo", ("x",))
+        self.assertNotIdentical(proto._outgoing_requests, NO_REQUESTS)
+        proto.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, 1, None, "x")))
+        self.assertEqual(self.successResultOf(d), "x")
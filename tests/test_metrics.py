@@ -0,0 +1,104 @@
+import msgpack
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.metrics import Histogram, Metrics, ROLE_CLIENT, ROLE_SERVER
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST, MSGTYPE_RESPONSE
+
+from tests.helpers import Echo, FakeTimer
+
+
+class HistogramTestCase(unittest.TestCase):
+    def test_exact_small_values(self):
+        h = Histogram()
+        for value in range(1, 101):
+            h.record(value)
+        self.assertEqual(h.count, 100)
+        self.assertEqual(h.percentile(50), 50)
+        self.assertEqual(h.percentiles((50, 99, 100)), [50, 99, 100])
+        self.assertEqual(h.mean(), 50.5)
+
+    def test_relative_error(self):
+        h = Histogram(significantBits=7)
+        for value in (1000, 123456, 98765432):
+            h.reset()
+            h.record(value)
+            lowest, highest = h.bucketRange(h.bucketIndex(value))
+            self.assertTrue(lowest <= value <= highest)
+            self.assertTrue(float(highest - lowest) / value < 2 ** -6)
+
+    def test_merge(self):
+        a, b = Histogram(), Histogram()
+        a.record(10)
+        b.record(5000)
+        a.merge(b)
+        self.assertEqual((a.count, a.min, a.max), (2, 10, 5000))
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.metrics = Metrics(timer=self.timer)
+        self.packer = msgpack.Packer(encoding="utf-8")
+
+    def _serverProtocol(self, **kwargs):
+        factory = Echo().getStreamFactory(metrics=self.metrics, **kwargs)
+        proto = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        return proto, transport
+
+    def test_server(self):
+        proto, transport = self._serverProtocol()
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "echo", ("x",))))
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 2, "fail", ())))
+
+        stats = self.metrics.snapshot()
+        self.assertEqual(stats[ROLE_SERVER]["echo"]["calls"], 1)
+        self.assertEqual(stats[ROLE_SERVER]["echo"]["errors"], 0)
+        self.assertEqual(stats[ROLE_SERVER]["fail"]["errors"], 1)
+        self.assertEqual(stats["in_flight"][ROLE_SERVER], 0)
+        self.assertEqual(stats["bytes_out"], len(transport.value()))
+        self.assertTrue(stats["bytes_in"] > 0)
+
+    def test_client(self):
+        factory = MsgpackClientFactory(metrics=self.metrics)
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+
+        d = proto.createRequest("echo", ("x",))
+        self.assertEqual(self.metrics.inFlight[ROLE_CLIENT], 1)
+        self.timer.now += 0.25
+        proto.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, 1, None, "x")))
+
+        self.assertEqual(self.successResultOf(d), "x")
+        stats = self.metrics.snapshot()[ROLE_CLIENT]["echo"]
+        self.assertEqual(stats["calls"], 1)
+        self.assertAlmostEqual(stats["latency"]["max"], 0.25, places=2)
+        self.assertEqual(self.metrics.inFlight[ROLE_CLIENT], 0)
+
+    def test_clientWriteFails(self):
+        factory = MsgpackClientFactory(metrics=self.metrics)
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+
+        self.assertRaises(Exception, proto.createRequest, "echo", (object(),))
+        stats = self.metrics.snapshot()[ROLE_CLIENT]["echo"]
+        self.assertEqual((stats["calls"], stats["errors"]), (1, 1))
+        self.assertEqual(self.metrics.inFlight[ROLE_CLIENT], 0)
+
+    def test_stats_method(self):
+        proto, transport = self._serverProtocol(exposeStats=True)
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "__stats__", ())))
+        response = msgpack.loads(transport.value(), encoding="utf-8")
+        self.assertEqual(response[2], None)
+        self.assertIn("__stats__", response[3][ROLE_SERVER])
+
+    def test_prometheus(self):
+        proto, _ = self._serverProtocol()
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "echo", ("x",))))
+        text = self.metrics.toPrometheus()
+        self.assertIn('txmsgpackrpc_requests_total{role="server",method="echo"} 1\n', text)
+        self.assertIn('txmsgpackrpc_latency_seconds{role="server",method="echo",quantile="0.99"}', text)
+        self.assertIn('# TYPE txmsgpackrpc_in_flight gauge\n', text)
@@ -0,0 +1,62 @@
+import socket
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import DatagramProtocol
+from twisted.trial import unittest
+
+from txmsgpackrpc import client, mmsg
+
+from tests.helpers import Echo
+
+
+class Collector(DatagramProtocol):
+    def __init__(self, expected):
+        self.received = []
+        self.expected = expected
+        self.done = defer.Deferred()
+
+    def datagramReceived(self, data, addr):
+        self.received.append((data, addr))
+        if len(self.received) == self.expected:
+            self.done.callback(self.received)
+
+
+class BatchedIOTestCase(unittest.TestCase):
+    if not mmsg.isSupported():
+        skip = "recvmmsg/sendmmsg not available"
+
+    def test_address(self):
+        for addr, family in ((("127.0.0.1", 8000), socket.AF_INET), (("::1", 8000), socket.AF_INET6)):
+            self.assertEqual(mmsg.decodeAddress(mmsg.encodeAddress(addr, family)), addr)
+
+    @defer.inlineCallbacks
+    def test_batch(self):
+        collector = Collector(100)
+        port = mmsg.listenUDP(0, collector, interface="127.0.0.1", batchSize=16)
+        self.addCleanup(port.stopListening)
+        self.assertIsInstance(port, mmsg.Port)
+
+        sender = mmsg.listenUDP(0, DatagramProtocol(), interface="127.0.0.1", batchSize=16)
+        self.addCleanup(sender.stopListening)
+        address = ("127.0.0.1", port.getHost().port)
+        for i in range(100):
+            sender.write(str(i).encode(), address)
+        # datagrams are queued until the next reactor iteration
+        self.assertEqual(sender.datagramsSent, 96)
+
+        received = yield collector.done
+        self.assertEqual([data for data, _ in received], [str(i).encode() for i in range(100)])
+        self.assertEqual(set(addr for _, addr in received), set([("127.0.0.1", sender.getHost().port)]))
+        self.assertEqual(sender.sendCalls, 7)
+        self.assertTrue(port.recvCalls < port.datagramsReceived)
+
+    @defer.inlineCallbacks
+    def test_rpc(self):
+        port = mmsg.listenUDP(0, Echo().getDatagramProtocol(), interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+
+        conn = yield client.connect_UDP("127.0.0.1", port.getHost().port, waitTimeout=5)
+        self.addCleanup(conn.closeConnection)
+        results = yield defer.gatherResults([conn.createRequest("echo", i) for i in range(50)])
+        self.assertEqual(results, list(range(50)))
+        self.assertEqual(port.datagramsSent, 50)
@@ -0,0 +1,80 @@
+import msgpack
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.handler import PooledConnectionHandler
+from txmsgpackrpc.protocol import MSGTYPE_RESPONSE
+
+
+class PoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.packer = msgpack.Packer(encoding="utf-8")
+
+    def _pool(self, **config):
+        config.setdefault('poolsize', 2)
+        factory = MsgpackClientFactory(handler=PooledConnectionHandler, handlerConfig=config)
+        protos = []
+        for _ in range(config['poolsize']):
+            proto = factory.buildProtocol(None)
+            proto.makeConnection(proto_helpers.StringTransport())
+            protos.append(proto)
+        return factory.handler, protos
+
+    def _requests(self, proto):
+        unpacker = msgpack.Unpacker(encoding="utf-8")
+        unpacker.feed(proto.transport.value())
+        proto.transport.clear()
+        return [msg[1] for msg in unpacker]
+
+    def _respond(self, proto, msgid):
+        proto.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, msgid, None, msgid)))
+
+    def test_maxConcurrent(self):
+        handler, (proto1, proto2) = self._pool(maxConcurrentPerConnection=2)
+        results = []
+        for i in range(6):
+            handler.createRequest("echo", i).addCallback(results.append)
+        msgids1, msgids2 = self._requests(proto1), self._requests(proto2)
+        self.assertEqual((len(msgids1), len(msgids2)), (2, 2))
+        self.assertEqual(handler.queued, 2)
+        self.assertEqual(handler.active, {proto1: 2, proto2: 2})
+
+        # waiting requests take freed connections in FIFO order
+        self._respond(proto2, msgids2[0])
+        self.assertEqual(len(self._requests(proto2)), 1)
+        self.assertEqual(handler.queued, 1)
+        self._respond(proto1, msgids1[0])
+        self.assertEqual(len(self._requests(proto1)), 1)
+        self.assertEqual(handler.queued, 0)
+        self.assertEqual(sorted(results), sorted([msgids1[0], msgids2[0]]))
+
+        # capacity freed when nothing waits goes to the next request
+        self._respond(proto1, msgids1[1])
+        handler.createRequest("echo", 6)
+        self.assertEqual(handler.active, {proto1: 2, proto2: 2})
+
+    def test_isolated(self):
+        handler, protos = self._pool(isolated=True)
+        for i in range(3):
+            handler.createRequest("echo", i)
+        self.assertEqual([len(self._requests(proto)) for proto in protos], [1, 1])
+        self.assertEqual(handler.queued, 1)
+
+    def test_lostConnection(self):
+        handler, (proto1, proto2) = self._pool(maxConcurrentPerConnection=1)
+        failures = []
+        for i in range(2):
+            handler.createRequest("echo", i).addErrback(failures.append)
+        waiting = handler.createRequest("echo", 3)
+        proto1.connectionLost()
+        self.assertEqual(len(failures), 1)
+        self.assertNotIn(proto1, handler.active)
+        self.assertNoResult(waiting)
+        self.assertEqual(handler.queued, 1)
+
+    def test_notification(self):
+        handler, protos = self._pool(maxConcurrentPerConnection=1)
+        for i in range(4):
+            handler.createNotification("event", [i])
+        self.assertEqual(handler.active, {protos[0]: 0, protos[1]: 0})
@@ -0,0 +1,90 @@
+import base64
+import functools
+import marshal
+import time
+
+import msgpack
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task
+
+from txmsgpackrpc.profiler import MethodProfiler
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST
+from txmsgpackrpc.server import MsgpackRPCServer
+
+
+class Server(MsgpackRPCServer):
+    def remote_work(self, n):
+        return sum(range(n))
+
+    def remote_sleep(self, seconds):
+        time.sleep(seconds)
+
+    remote_nap = functools.partial(time.sleep)
+
+
+class ProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.profiler = MethodProfiler(clock=self.clock, sampleInterval=0.001)
+        factory = Server().getStreamFactory(profiler=self.profiler)
+        self.proto = factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.transport)
+        self.packer = msgpack.Packer(encoding="utf-8")
+        self.unpacker = msgpack.Unpacker(encoding="utf-8")
+
+    def _send(self, msgid, method, *params):
+        self.proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, msgid, method, params)))
+
+    def _responses(self):
+        self.unpacker.feed(self.transport.value())
+        self.transport.clear()
+        return dict((msgid, (error, result)) for _, msgid, error, result in self.unpacker)
+
+    def test_cprofile_calls(self):
+        self._send(1, "__profile__", "work", "cprofile", None, 2)
+        self._send(2, "work", 1000)
+        self.assertNotIn(1, self._responses())
+        self._send(3, "work", 1000)
+
+        error, result = self._responses()[1]
+        self.assertEqual(error, None)
+        self.assertEqual(result["calls"], 2)
+        self.assertIn("remote_work", result["report"])
+        stats = marshal.loads(base64.b64decode(result["pstats"]))
+        self.assertTrue(any(key[2] == "remote_work" for key in stats))
+        self.assertFalse(self.profiler.isProfiling())
+
+    def test_duration(self):
+        self._send(1, "__profile__", "work", "cprofile", 5)
+        self._send(2, "work", 10)
+        self.clock.advance(5)
+        error, result = self._responses()[1]
+        self.assertEqual(result["calls"], 1)
+
+    def test_sampling(self):
+        self._send(1, "__profile__", "sleep", "sampling", None, 1)
+        self._send(2, "sleep", 0.05)
+
+        error, result = self._responses()[1]
+        self.assertEqual(error, None)
+        self.assertTrue(result["samples"] > 0)
+        self.assertIn("remote_sleep", result["stacks"])
+
+    def test_sampling_partial(self):
+        self._send(1, "__profile__", "nap", "sampling", None, 1)
+        self._send(2, "nap", 0.05)
+
+        responses = self._responses()
+        self.assertEqual(responses[2], (None, None))
+        error, result = responses[1]
+        self.assertEqual(error, None)
+        self.assertTrue(result["samples"] > 0)
+
+    def test_already_profiling(self):
+        self._send(1, "__profile__", "work")
+        self._send(2, "__profile__", "work")
+        error, result = self._responses()[2]
+        self.assertIn("already being profiled", error)
+        self.profiler.stopProfiling()
@@ -0,0 +1,117 @@
+import msgpack
+from twisted.trial import unittest
+
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.handler import PooledConnectionHandler
+from txmsgpackrpc.protocol import MSGTYPE_NOTIFICATION, MSGTYPE_REQUEST, MSGTYPE_RESPONSE
+from txmsgpackrpc.pubsub import (DISCONNECT, EVENT_METHOD, SUBSCRIBE_METHOD, UNSUBSCRIBE_METHOD,
+                                 Broker, Subscriber)
+
+from tests.helpers import Echo, connect, messages
+
+
+class BrokerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = Echo()
+        self.server.broker = Broker(maxQueue=2)
+        self.factory = self.server.getStreamFactory()
+        self.packer = msgpack.Packer(encoding="utf-8")
+
+    def _connect(self):
+        return connect(self.factory)
+
+    def _subscribe(self, proto, transport, topic, msgid=1, method=SUBSCRIBE_METHOD):
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, msgid, method, [topic])))
+        return messages(transport)
+
+    def test_publish(self):
+        proto1, transport1 = self._connect()
+        proto2, transport2 = self._connect()
+        self.assertEqual(self._subscribe(proto1, transport1, "prices"), [[MSGTYPE_RESPONSE, 1, None, True]])
+        self.assertEqual(self._subscribe(proto1, transport1, "prices", 2), [[MSGTYPE_RESPONSE, 2, None, False]])
+        self._subscribe(proto2, transport2, "prices")
+        self._subscribe(proto2, transport2, "news", 2)
+
+        self.assertEqual(self.server.publish("prices", {"x": 1}), 2)
+        self.assertEqual(self.server.publish("weather", 1), 0)
+        event = [MSGTYPE_NOTIFICATION, EVENT_METHOD, ["prices", {"x": 1}]]
+        self.assertEqual(messages(transport1), [event])
+        self.assertEqual(messages(transport2), [event])
+
+        self._subscribe(proto2, transport2, "prices", 3, UNSUBSCRIBE_METHOD)
+        self.server.publish("prices", 2)
+        self.assertEqual(len(messages(transport1)), 1)
+        self.assertEqual(messages(transport2), [])
+
+        proto2.connectionLost()
+        self.assertEqual(self.server.broker.subscribers("news"), 0)
+        self.assertEqual(self.server.broker.subscribers("prices"), 1)
+
+    def test_slowSubscriber(self):
+        proto, transport = self._connect()
+        self._subscribe(proto, transport, "prices")
+        channel = self.server.broker._channels[proto]
+        self.assertIdentical(transport.producer, channel)
+
+        channel.pauseProducing()
+        for i in range(4):
+            self.server.publish("prices", i)
+        self.assertEqual(transport.value(), b"")
+        self.assertEqual(self.server.broker.dropped, 2)
+
+        channel.resumeProducing()
+        self.assertEqual([m[2][1] for m in messages(transport)], [2, 3])
+        self.server.publish("prices", 4)
+        self.assertEqual(len(messages(transport)), 1)
+
+    def test_disconnect(self):
+        self.server.broker = Broker(maxQueue=1, overflow=DISCONNECT)
+        self.factory = self.server.getStreamFactory()
+        proto, transport = self._connect()
+        self._subscribe(proto, transport, "prices")
+
+        self.server.broker._channels[proto].pauseProducing()
+        self.assertEqual(self.server.publish("prices", 1), 1)
+        self.assertEqual(self.server.publish("prices", 2), 0)
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(self.server.broker.disconnected, 1)
+        self.assertEqual(self.server.broker.subscribers("prices"), 0)
+
+    def test_noBroker(self):
+        self.assertRaises(ValueError, Echo().publish, "prices", 1)
+
+
+class SubscriberTestCase(unittest.TestCase):
+    def setUp(self):
+        self.subscriber = Subscriber()
+        self.factory = MsgpackClientFactory(handler=PooledConnectionHandler, handlerConfig={'poolsize': 2},
+                                            subscriber=self.subscriber)
+        self.packer = msgpack.Packer(encoding="utf-8")
+        self.events = []
+
+    def _connect(self):
+        return connect(self.factory)
+
+    def test_subscribe(self):
+        callback = lambda topic, message: self.events.append((topic, message))
+        # subscribed when connection is made
+        self.successResultOf(self.subscriber.subscribe("prices", callback))
+        proto1, transport1 = self._connect()
+        proto2, transport2 = self._connect()
+        self.assertEqual(messages(transport1), [[MSGTYPE_REQUEST, 1, SUBSCRIBE_METHOD, ["prices"]]])
+        self.assertEqual(messages(transport2), [])
+        proto1.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, 1, None, True)))
+
+        proto1.dataReceived(self.packer.pack((MSGTYPE_NOTIFICATION, EVENT_METHOD, ["prices", 10])))
+        self.assertEqual(self.events, [("prices", 10)])
+
+        # topics are subscribed again on remaining connection
+        proto1.connectionLost()
+        self.assertEqual(messages(transport2), [[MSGTYPE_REQUEST, 1, SUBSCRIBE_METHOD, ["prices"]]])
+
+        d = self.subscriber.unsubscribe("prices", callback)
+        self.assertEqual(messages(transport2), [[MSGTYPE_REQUEST, 2, UNSUBSCRIBE_METHOD, ["prices"]]])
+        proto2.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, 2, None, True)))
+        self.assertEqual(self.successResultOf(d), True)
+        proto2.dataReceived(self.packer.pack((MSGTYPE_NOTIFICATION, EVENT_METHOD, ["prices", 11])))
+        self.assertEqual(self.events, [("prices", 10)])
@@ -0,0 +1,107 @@
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmsgpackrpc.error import ConnectionError
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.handler import PooledConnectionHandler, RequestQueue
+from txmsgpackrpc.metrics import Metrics
+
+
+class RequestQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = Metrics()
+        self.queue = RequestQueue(maxSize=3, timeout=5, metrics=self.metrics, clock=self.clock)
+
+    def test_bounded(self):
+        ds = [self.queue.wait() for _ in range(4)]
+        self.failureResultOf(ds[3], ConnectionError)
+        self.assertEqual((len(self.queue), self.queue.rejected), (3, 1))
+        self.assertEqual((self.metrics.queued, self.metrics.queueRejected), (3, 1))
+
+        self.queue.popleft().callback(None)
+        self.successResultOf(ds[0])
+        self.assertEqual(self.metrics.queued, 2)
+
+    def test_timeout(self):
+        first = self.queue.wait()
+        self.clock.advance(2)
+        second = self.queue.wait()
+        # one timer for the oldest request
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(3)
+        self.failureResultOf(first, ConnectionError)
+        self.assertNoResult(second)
+        self.clock.advance(2)
+        self.failureResultOf(second, ConnectionError)
+        self.assertEqual((self.queue.expired, self.metrics.queueExpired, self.metrics.queued), (2, 2, 0))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_popCancelsTimer(self):
+        self.queue.wait()
+        self.queue.popleft().callback(None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancel(self):
+        first, second = self.queue.wait(), self.queue.wait()
+        first.cancel()
+        self.failureResultOf(first, defer.CancelledError)
+        self.assertEqual((len(self.queue), self.metrics.queued), (1, 1))
+        self.assertIdentical(self.queue.popleft(), second)
+
+        third = self.queue.wait()
+        third.cancel()
+        self.failureResultOf(third, defer.CancelledError)
+        self.assertEqual((len(self.queue), self.metrics.queued), (0, 0))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_popSkipsCalled(self):
+        first, second = self.queue.wait(), self.queue.wait()
+        first.callback(None)
+        self.assertIdentical(self.queue.popleft(), second)
+        self.assertIdentical(self.queue.popleft(), None)
+        self.assertEqual(self.metrics.queued, 0)
+
+
+class HandlerQueueTestCase(unittest.TestCase):
+    def test_simple(self):
+        metrics = Metrics()
+        factory = MsgpackClientFactory(handlerConfig={'maxQueued': 2}, metrics=metrics)
+        handler = factory.handler
+        ds = [handler.createRequest("echo", i) for i in range(3)]
+        self.failureResultOf(ds[2], ConnectionError)
+        self.assertEqual((handler.queued, metrics.snapshot()["queued"]), (2, 2))
+
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        self.assertEqual((handler.queued, metrics.queued), (0, 0))
+        self.assertNotEqual(proto.transport.value(), b"")
+
+    def test_pooled(self):
+        factory = MsgpackClientFactory(handler=PooledConnectionHandler,
+                                       handlerConfig={'poolsize': 2, 'maxQueued': 1})
+        handler = factory.handler
+        first = handler.createRequest("echo", 1)
+        self.failureResultOf(handler.createRequest("echo", 2), ConnectionError)
+        self.assertEqual(handler.queued, 1)
+
+        handler.disconnect()
+        self.failureResultOf(first, ConnectionError)
+        self.assertEqual(handler.queued, 0)
+
+    def test_pooledCancel(self):
+        factory = MsgpackClientFactory(handler=PooledConnectionHandler,
+                                       handlerConfig={'poolsize': 1, 'maxConcurrentPerConnection': 1})
+        handler = factory.handler
+        cancelled = handler.createRequest("echo", 1)
+        cancelled.cancel()
+        self.failureResultOf(cancelled, defer.CancelledError)
+        self.assertEqual(handler.queued, 0)
+
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        self.assertEqual(handler.active, {proto: 0})
+        handler.createRequest("echo", 2)
+        self.assertEqual(handler.active, {proto: 1})
@@ -0,0 +1,111 @@
+import msgpack
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task
+from twisted.internet.address import UNIXAddress
+
+from txmsgpackrpc.error import RateLimitExceeded, ResponseError, packError, unpackError
+from txmsgpackrpc.factory import MsgpackServerFactory
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST, MSGTYPE_RESPONSE, MSGTYPE_NOTIFICATION
+from txmsgpackrpc.ratelimit import ExpiringTable, RateLimiter
+
+from tests.helpers import Echo
+
+
+class ExpiringTableTestCase(unittest.TestCase):
+    def test_expire(self):
+        table = ExpiringTable(maxsize=10, ttl=5)
+        table.set('a', 1, now=0)
+        table.set('b', 2, now=3)
+        self.assertEqual(table.get('a', now=4), 1)
+        self.assertEqual(table.get('b', now=9), None)
+        self.assertEqual(table.expire(now=20), 1)
+        self.assertEqual(len(table), 0)
+
+    def test_evict_least_recently_used(self):
+        table = ExpiringTable(maxsize=2, ttl=60)
+        table.set('a', 1, now=0)
+        table.set('b', 2, now=0)
+        table.get('a', now=1)
+        table.set('c', 3, now=2)
+        self.assertIn('a', table)
+        self.assertNotIn('b', table)
+        self.assertIn('c', table)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_peer_limit(self):
+        limiter = RateLimiter(rate=1, burst=2, clock=self.clock)
+        self.assertTrue(limiter.allow('10.0.0.1', 'echo'))
+        self.assertTrue(limiter.allow('10.0.0.1', 'echo'))
+        self.assertFalse(limiter.allow('10.0.0.1', 'echo'))
+        self.assertTrue(limiter.allow('10.0.0.2', 'echo'))
+        self.clock.advance(1)
+        self.assertTrue(limiter.allow('10.0.0.1', 'echo'))
+        self.assertEqual(limiter.rejected, 1)
+        self.assertEqual(limiter.rejectedByMethod['echo'], 1)
+
+    def test_method_limit(self):
+        limiter = RateLimiter(methodLimits={'expensive': 1}, clock=self.clock)
+        self.assertTrue(limiter.allow('10.0.0.1', 'expensive'))
+        self.assertFalse(limiter.allow('10.0.0.1', 'expensive'))
+        self.assertTrue(limiter.allow('10.0.0.1', 'echo'))
+        self.assertTrue(limiter.allow('10.0.0.2', 'expensive'))
+
+    def test_rejected_method_does_not_consume_peer_token(self):
+        limiter = RateLimiter(rate=1, burst=1, methodLimits={'expensive': (1, 1)}, clock=self.clock)
+        self.assertTrue(limiter.allow('10.0.0.1', 'expensive'))
+        self.clock.advance(1)
+        limiter.methodLimits['expensive'] = (0, 0)
+        self.assertFalse(limiter.allow('10.0.0.1', 'expensive'))
+        self.assertTrue(limiter.allow('10.0.0.1', 'echo'))
+
+
+class RateLimitedProtocolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.limiter = RateLimiter(rate=1, burst=1, clock=task.Clock())
+        factory = Echo().getStreamFactory(rateLimiter=self.limiter)
+        self.proto = factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.transport)
+        self.packer = msgpack.Packer(encoding="utf-8")
+
+    def _request(self, msgid):
+        self.transport.clear()
+        self.proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, msgid, "echo", ("x",))))
+        return msgpack.loads(self.transport.value(), encoding="utf-8")
+
+    def test_reject(self):
+        self.assertEqual(self._request(1), [MSGTYPE_RESPONSE, 1, None, "x"])
+
+        msgType, msgid, error, result = self._request(2)
+        self.assertEqual(error, ["RateLimitExceeded", "Rate limit exceeded for method echo"])
+        self.assertIsInstance(unpackError(error), RateLimitExceeded)
+        self.assertEqual(self.limiter.rejected, 1)
+
+    def test_malformedNotification(self):
+        self.proto.dataReceived(self.packer.pack((MSGTYPE_NOTIFICATION, "echo")))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(self.transport.value(), b"")
+
+    def test_unixPeers(self):
+        factory = Echo().getStreamFactory(rateLimiter=self.limiter)
+        keys = set()
+        for _ in range(2):
+            proto = factory.buildProtocol(None)
+            proto.makeConnection(proto_helpers.StringTransport(peerAddress=UNIXAddress(None)))
+            keys.add(proto.getPeerKey(None))
+            proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "echo", ("x",))))
+            self.assertEqual(msgpack.loads(proto.transport.value(), encoding="utf-8"),
+                             [MSGTYPE_RESPONSE, 1, None, "x"])
+        self.assertEqual(len(keys), 2)
+
+
+class TypedErrorTestCase(unittest.TestCase):
+    def test_untyped(self):
+        self.assertEqual(packError(ValueError("x")), None)
+        ex = unpackError("failure")
+        self.assertIs(type(ex), ResponseError)
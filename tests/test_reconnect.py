@@ -0,0 +1,108 @@
+import random
+
+from twisted.internet import task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from txmsgpackrpc.error import ConnectionError
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.handler import PooledConnectionHandler
+
+from tests.helpers import Connector, connect, messages
+
+
+class ReconnectTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = MsgpackClientFactory(handler=PooledConnectionHandler, handlerConfig={'poolsize': 3})
+        self.factory.clock = self.clock
+        self.reason = failure.Failure(ConnectionError("lost"))
+        self.patch(random, "uniform", lambda low, high: high / 2.0)
+
+    def _connect(self):
+        return connect(self.factory)[0]
+
+    def test_fullJitter(self):
+        connector = Connector()
+        self.factory.clientConnectionFailed(connector, self.reason)
+        self.assertEqual([call.getTime() for call in self.clock.getDelayedCalls()], [0.5])
+        self.clock.advance(0.5)
+        self.assertEqual(connector.attempts, 1)
+
+        self.factory.clientConnectionFailed(connector, self.reason)
+        self.assertAlmostEqual(self.clock.getDelayedCalls()[0].getTime(), 0.5 + self.factory.factor / 2)
+
+    def test_stagger(self):
+        connectors = [Connector() for _ in range(3)]
+        for connector in connectors:
+            self.factory.clientConnectionLost(connector, self.reason)
+        times = sorted(call.getTime() for call in self.clock.getDelayedCalls())
+        for earlier, later in zip(times, times[1:]):
+            self.assertTrue(later - earlier >= self.factory.reconnectStagger)
+
+        self.factory.stopTrying()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_spreadRequests(self):
+        ds = [self.factory.handler.createRequest("echo", i) for i in range(6)]
+        self.assertEqual(self.factory.handler.queued, 6)
+
+        # every returned connection gets its share of waiting requests
+        protos = [self._connect()]
+        self.assertEqual(self.factory.handler.queued, 4)
+        protos.append(self._connect())
+        self.assertEqual(self.factory.handler.queued, 2)
+        protos.append(self._connect())
+        self.assertEqual(self.factory.handler.queued, 0)
+        self.assertEqual([len(messages(proto.transport)) for proto in protos], [2, 2, 2])
+
+    def test_spreadTimeout(self):
+        ds = [self.factory.handler.createRequest("echo", i) for i in range(3)]
+        proto = self._connect()
+        self.assertEqual(self.factory.handler.queued, 2)
+
+        self.assertEqual(len(messages(proto.transport)), 1)
+
+        # the rest of the pool didn't come back
+        self.clock.advance(self.factory.handler.spreadTimeout)
+        self.assertEqual(len(messages(proto.transport)), 2)
+        self.assertEqual(self.factory.handler.queued, 0)
+
+    def test_heldBackDoesntBlock(self):
+        handler = self.factory.handler
+        handler.poolsize = 2
+        handler._waitingRequests.maxSize = 8
+        ds = [handler.createRequest("echo", i) for i in range(6)]
+        proto = self._connect()
+        self.assertEqual(len(messages(proto.transport)), 3)
+        self.assertEqual(handler.queued, 3)
+
+        # new requests don't wait behind requests held back for the other connection
+        for i in range(6):
+            handler.createRequest("echo", i)
+        self.assertEqual(len(messages(proto.transport)), 6)
+        self.assertEqual(handler.queued, 3)
+
+        proto2 = self._connect()
+        self.assertEqual(len(messages(proto2.transport)), 3)
+        self.assertEqual(handler.queued, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_heldBackCapacity(self):
+        handler = self.factory.handler
+        handler.maxConcurrentPerConnection = 1
+        ds = [handler.createRequest("echo", i) for i in range(4)]
+        proto = self._connect()
+        self.assertEqual(len(messages(proto.transport)), 1)
+
+        # two are held back for the missing connections, the last one waits
+        # for free capacity
+        self.assertEqual((handler.queued, handler._heldBack), (3, 2))
+        handler.createRequest("echo", 4)
+        self.assertEqual(handler.queued, 4)
+
+    def test_giveUp(self):
+        d = self.factory.handler.createRequest("echo", 1)
+        self.factory.maxRetries = 0
+        self.factory.clientConnectionFailed(Connector(), self.reason)
+        self.failureResultOf(d, ConnectionError)
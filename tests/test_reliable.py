@@ -0,0 +1,82 @@
+import msgpack
+from twisted.internet import task
+from twisted.trial import unittest
+
+from txmsgpackrpc.error import TimeoutError
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST, MSGTYPE_RESPONSE, MsgpackDatagramProtocol
+from txmsgpackrpc.reliable import ResponseCache
+from txmsgpackrpc.server import MsgpackRPCServer
+
+from tests.helpers import FakeDatagramTransport
+
+
+class Counter(MsgpackRPCServer):
+    def __init__(self):
+        self.value = 0
+
+    def remote_increment(self):
+        self.value += 1
+        return self.value
+
+
+class ReliableDatagramTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.packer = msgpack.Packer(encoding="utf-8")
+        self.unpacker = msgpack.Unpacker(encoding="utf-8")
+
+    def _client(self, **kwargs):
+        proto = MsgpackDatagramProtocol(address=("127.0.0.1", 9000), clock=self.clock, **kwargs)
+        proto.transport = FakeDatagramTransport()
+        proto.startProtocol()
+        return proto
+
+    def test_retransmit(self):
+        proto = self._client(timeout=10, retransmitInterval=1)
+        d = proto.createRequest("increment")
+        request = proto.transport.written[0][0]
+
+        for _ in range(3):
+            self.clock.advance(0.5)
+        self.assertEqual(len(proto.transport.written), 2)
+        self.assertEqual(proto.transport.written[1][0], request)
+
+        # intervals 1, 2, 4 fit into timeout, the next one would not
+        self.clock.pump([0.5] * 14)
+        self.assertEqual(len(proto.transport.written), 4)
+        self.assertEqual(proto.retransmits, 3)
+
+        proto.datagramReceived(self.packer.pack((MSGTYPE_RESPONSE, 1, None, 1)), ("127.0.0.1", 9000))
+        self.assertEqual(self.successResultOf(d), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_timeout(self):
+        proto = self._client(timeout=3, retransmitInterval=1)
+        d = proto.createRequest("increment")
+        self.clock.pump([1, 1, 1])
+        self.failureResultOf(d, TimeoutError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(proto.retransmits, 1)
+
+    def test_duplicate_suppression(self):
+        server = Counter()
+        cache = ResponseCache(clock=self.clock)
+        proto = server.getDatagramProtocol(responseCache=cache, clock=self.clock)
+        proto.transport = FakeDatagramTransport()
+        proto.startProtocol()
+
+        peer = ("127.0.0.1", 5000)
+        request = self.packer.pack((MSGTYPE_REQUEST, 7, "increment", ()))
+        proto.datagramReceived(request, peer)
+        proto.datagramReceived(request, peer)
+        proto.datagramReceived(request, ("127.0.0.1", 5001))
+
+        self.assertEqual(server.value, 2)
+        self.assertEqual(cache.duplicates, 1)
+        responses = [data for data, _ in proto.transport.written]
+        self.assertEqual(responses[0], responses[1])
+        self.unpacker.feed(responses[2])
+        self.assertEqual(next(self.unpacker), [MSGTYPE_RESPONSE, 7, None, 2])
+
+    def test_multicast_rejects_retransmit(self):
+        self.assertRaises(ValueError, Counter().getMulticastProtocol, "228.0.0.5", retransmitInterval=1)
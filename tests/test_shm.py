@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+
+import msgpack
+from twisted.internet import defer, reactor
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmsgpackrpc import client, shm
+from txmsgpackrpc.shm import RingReader, RingWriter, SharedMemoryServerFactory
+
+from tests.helpers import Echo
+
+
+class RingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_wrap(self):
+        ring = RingWriter(100, self.directory)
+        self.addCleanup(ring.close)
+        # ring file is never reachable by path
+        self.assertEqual(os.listdir(self.directory), [])
+        reader = RingReader(ring.fileno)
+        self.addCleanup(reader.close)
+
+        self.assertEqual(ring.write(b"a" * 40), 0)
+        self.assertEqual(ring.write(b"b" * 40), 40)
+        self.assertIdentical(ring.write(b"c" * 40), None)
+        ring.release(0)
+        self.assertEqual(ring.write(b"c" * 40), 0)
+        self.assertIdentical(ring.write(b"d" * 10), None)
+        self.assertEqual(bytes(reader.read(0, 40)), b"c" * 40)
+        self.assertRaises(ValueError, ring.release, 0)
+        ring.release(40)
+        ring.release(0)
+        self.assertEqual(len(ring), 0)
+        self.assertEqual(ring.write(b"e" * 100), 0)
+        self.assertIdentical(ring.write(b"f" * 101), None)
+
+    def test_rejectFifo(self):
+        path = os.path.join(self.directory, "fifo")
+        os.mkfifo(path)
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.addCleanup(os.close, fd)
+        self.assertRaises(ValueError, RingReader, fd)
+
+    def test_rejectUnsealed(self):
+        if shm._F_GET_SEALS is None:
+            raise unittest.SkipTest("file seals are not supported")
+        with open(os.path.join(self.directory, "ring"), "wb+") as f:
+            f.truncate(100)
+            self.assertRaises(ValueError, RingReader, f.fileno())
+
+
+class SharedMemoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    @defer.inlineCallbacks
+    def test_echo(self):
+        factory = Echo().getStreamFactory(SharedMemoryServerFactory, threshold=1024, ringSize=256 * 1024,
+                                          directory=self.directory)
+        port = reactor.listenUNIX(os.path.join(self.directory, "rpc.sock"), factory)
+        self.addCleanup(port.stopListening)
+
+        conn = yield client.connect_UNIX(os.path.join(self.directory, "rpc.sock"), connectTimeout=5, maxRetries=0,
+                                         sharedMemory=True, sharedMemoryThreshold=1024, ringSize=256 * 1024)
+        self.addCleanup(conn.disconnect)
+        # rings are attached during the first round trip
+        yield conn.createRequest("echo", "y")
+
+        value = u"x" * (64 * 1024)
+        results = yield defer.gatherResults([conn.createRequest("echo", value), conn.createRequest("echo", "y"),
+                                             conn.createRequest("echo", value)])
+        self.assertEqual(results, [value, "y", value])
+
+        # message larger than ring is sent inline
+        large = u"z" * (512 * 1024)
+        result = yield conn.createRequest("echo", large)
+        self.assertEqual(result, large)
+
+        server, = factory.connections
+        self.assertEqual(server.framesReceived, 2)
+        self.assertEqual(server.framesSent, 2)
+        self.assertEqual(len(server._ring), 0)
+        self.assertEqual(sorted(os.listdir(self.directory)), ["rpc.sock"])
+
+    def test_attachWithoutDescriptor(self):
+        factory = Echo().getStreamFactory(SharedMemoryServerFactory)
+        proto = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        proto.dataReceived(msgpack.packb(msgpack.ExtType(shm.SHM_ATTACH, msgpack.packb(["/etc/passwd", 100]))))
+        self.assertIdentical(proto._peerRing, None)
+        self.assertEqual(transport.value(), b"")
@@ -0,0 +1,100 @@
+import msgpack
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST, MSGTYPE_RESPONSE
+from txmsgpackrpc.server import MsgpackRPCServer
+from txmsgpackrpc.slowlog import SlowRequestLog
+
+from tests.helpers import FakeTimer
+
+
+class Server(MsgpackRPCServer):
+    def __init__(self, timer):
+        self.timer = timer
+
+    def remote_slow(self, seconds):
+        self.timer.now += seconds
+        return "done"
+
+
+class SlowRequestLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.records = []
+        self.slowLog = SlowRequestLog(threshold=0.5, captureRate=1.0, writer=self.records.append,
+                                      timer=self.timer)
+        self.packer = msgpack.Packer(encoding="utf-8")
+
+    def tearDown(self):
+        self.slowLog.close()
+
+    def test_server(self):
+        factory = Server(self.timer).getStreamFactory(slowLog=self.slowLog)
+        proto = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+
+        proto.dataReceived(self.packer.pack((MSGTYPE_REQUEST, 1, "slow", (0.1,))))
+        request = self.packer.pack((MSGTYPE_REQUEST, 2, "slow", (1,)))
+        proto.dataReceived(request)
+        self.slowLog.flush()
+
+        self.assertEqual(len(self.records), 1)
+        record = self.records[0]
+        self.assertEqual(record["method"], "slow")
+        self.assertEqual(record["msgid"], 2)
+        self.assertEqual(record["peer"], "192.168.1.1")
+        self.assertEqual(record["request_size"], len(request))
+        self.assertEqual(record["params"], "[1]")
+        self.assertEqual(record["result"], "'done'")
+        self.assertEqual(record["timing"]["execute"], 1)
+        self.assertEqual(record["timing"]["total"], 1)
+
+    def test_client(self):
+        factory = MsgpackClientFactory(slowLog=self.slowLog)
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+
+        d = proto.createRequest("remote", ("x",))
+        self.timer.now += 2
+        response = self.packer.pack((MSGTYPE_RESPONSE, 1, None, "y"))
+        proto.dataReceived(response)
+        self.assertEqual(self.successResultOf(d), "y")
+        self.slowLog.flush()
+
+        record = self.records[0]
+        self.assertEqual(record["role"], "client")
+        self.assertEqual(record["response_size"], len(response))
+        self.assertEqual(record["timing"]["execute"], 2)
+
+    def test_queue_full(self):
+        slowLog = SlowRequestLog(threshold=0, maxQueue=1, writer=self.records.append, timer=self.timer)
+        slowLog._queue.put(None)
+        timing = slowLog.startRequest("client", "m", 1, None)
+        timing.messageWritten(0, 0, 1)
+        timing.finished = 1
+        slowLog.finishRequest(timing)
+        self.assertEqual(slowLog.dropped, 1)
+
+    def test_capture_only_slow(self):
+        formatted = []
+
+        class Params(object):
+            def __repr__(self):
+                formatted.append(True)
+                return "params"
+
+        timing = self.slowLog.startRequest("client", "m", 1, None, params=Params())
+        timing.messageWritten(0, 0, 1)
+        timing.finished = 0.1
+        self.slowLog.finishRequest(timing)
+        self.assertEqual(formatted, [])
+
+        timing = self.slowLog.startRequest("client", "m", 2, None, params=Params())
+        timing.messageWritten(0, 0, 1)
+        timing.finished = 1
+        self.slowLog.finishRequest(timing)
+        self.slowLog.flush()
+        self.assertEqual(self.records[0]["params"], "params")
@@ -0,0 +1,77 @@
+import msgpack
+from twisted.trial import unittest
+
+from txmsgpackrpc.core import packMsgid
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.handler import PooledConnectionHandler
+from txmsgpackrpc.protocol import MSGTYPE_REQUEST, MSGTYPE_RESPONSE
+
+from tests.helpers import Recorder, connect
+
+
+class MethodStubTestCase(unittest.TestCase):
+    def setUp(self):
+        self.packer = msgpack.Packer(encoding="utf-8")
+
+    def test_same_bytes(self):
+        factory = MsgpackClientFactory()
+        proto, transport = connect(factory)
+
+        echo = factory.handler.method("echo")
+        d1 = echo("x", {"a": [1, 2]})
+        d2 = echo(u"žluťoučký")
+        self.assertEqual(transport.value(),
+                         self.packer.pack((MSGTYPE_REQUEST, 1, "echo", ("x", {"a": [1, 2]}))) +
+                         self.packer.pack((MSGTYPE_REQUEST, 2, "echo", (u"žluťoučký",))))
+        self.assertIs(echo.connection, proto)
+        self.assertEqual(list(echo.encoded.values()), [self.packer.pack("echo")])
+
+        proto.dataReceived(self.packer.pack((MSGTYPE_RESPONSE, 2, None, "y")))
+        self.assertEqual(self.successResultOf(d2), "y")
+        self.assertNoResult(d1)
+
+    def test_reconnect(self):
+        factory = MsgpackClientFactory()
+        echo = factory.handler.method("echo")
+        d = echo("x")
+        self.assertNoResult(d)
+
+        proto, transport = connect(factory)
+        self.assertIs(echo.connection, proto)
+        proto.connectionLost()
+        self.failureResultOf(d)
+
+        echo("y")
+        proto2, transport2 = connect(factory)
+        self.assertIs(echo.connection, proto2)
+        self.assertEqual(transport2.value(), self.packer.pack((MSGTYPE_REQUEST, 1, "echo", ("y",))))
+
+    def test_pool(self):
+        factory = MsgpackClientFactory(handler=PooledConnectionHandler, handlerConfig={"poolsize": 2})
+        connections = [connect(factory) for _ in range(2)]
+
+        echo = factory.handler.method("echo")
+        for i in range(4):
+            echo(i)
+        for _, transport in connections:
+            self.assertEqual(len(transport.value()), 2 * len(self.packer.pack((MSGTYPE_REQUEST, 1, "echo", (0,)))))
+        self.assertIs(echo.connection, None)
+
+    def test_interceptors(self):
+        recorder = Recorder()
+        factory = MsgpackClientFactory(interceptors=[recorder])
+        proto, transport = connect(factory)
+
+        factory.handler.method("echo")("x")
+        self.assertEqual(recorder.calls, ["echo"])
+        self.assertEqual(transport.value(), self.packer.pack((MSGTYPE_REQUEST, 1, "echo", ("x",))))
+
+    def test_serialization_error(self):
+        factory = MsgpackClientFactory()
+        connect(factory)
+        d = factory.handler.method("echo")(object())
+        self.failureResultOf(d)
+
+    def test_pack_msgid(self):
+        for msgid in (0, 1, 127, 128, 255, 256, 65535, 65536, 2 ** 32 - 1):
+            self.assertEqual(packMsgid(msgid), self.packer.pack(msgid))
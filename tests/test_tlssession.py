@@ -0,0 +1,93 @@
+import os
+
+from twisted.internet import defer, reactor, task, tcp
+from twisted.trial import unittest
+
+from txmsgpackrpc import client
+
+from tests.helpers import Echo
+
+try:
+    from twisted.internet import ssl
+    from twisted.test import __file__ as twistedTests
+
+    from txmsgpackrpc.tlssession import TLSSessionCache
+except ImportError:
+    ssl = None
+
+
+class TLSSessionCacheTestCase(unittest.TestCase):
+    if ssl is None:
+        skip = "pyOpenSSL is not installed"
+
+    def listen(self, **kwargs):
+        with open(os.path.join(os.path.dirname(twistedTests), "server.pem"), "rb") as f:
+            cert = ssl.PrivateCertificate.loadPEM(f.read())
+        options = ssl.CertificateOptions(privateKey=cert.privateKey.original, certificate=cert.original, **kwargs)
+        port = reactor.listenSSL(0, Echo().getStreamFactory(), options, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        return port.getHost().port
+
+    @defer.inlineCallbacks
+    def disconnect(self, conn):
+        # TLS connections are closed after exchange of close_notify alerts
+        yield conn.disconnect()
+        for _ in range(100):
+            selectables = reactor.getReaders() + reactor.getWriters()
+            if not any(isinstance(s, tcp.Client) for s in selectables):
+                break
+            yield task.deferLater(reactor, 0.05, lambda: None)
+
+    @defer.inlineCallbacks
+    def waitForHandshakes(self, cache, count):
+        for _ in range(100):
+            if cache.handshakes >= count:
+                break
+            yield task.deferLater(reactor, 0.05, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_pool(self):
+        port = self.listen(enableSessionTickets=True)
+        conn = yield client.connect_pool("127.0.0.1", port, poolsize=3, connectTimeout=5, maxRetries=0, ssl=True)
+        self.addCleanup(self.disconnect, conn)
+        cache = conn.factory.tlsSessions
+        yield self.waitForHandshakes(cache, 3)
+
+        self.assertEqual((cache.handshakes, cache.resumed), (3, 2))
+        self.assertEqual(cache.durations.count, 3)
+        result = yield conn.createRequest("echo", "hello")
+        self.assertEqual(result, "hello")
+
+    @defer.inlineCallbacks
+    def test_reconnect(self):
+        port = self.listen(enableSessionTickets=True)
+        conn = yield client.connect("127.0.0.1", port, connectTimeout=5, ssl=True)
+        self.addCleanup(self.disconnect, conn)
+        yield conn.createRequest("echo", 1)
+        cache = conn.factory.tlsSessions
+
+        conn.connection.transport.loseConnection()
+        yield self.waitForHandshakes(cache, 2)
+        self.assertEqual(cache.snapshot()["resumed"], 1)
+
+    @defer.inlineCallbacks
+    def test_noTickets(self):
+        # Twisted servers don't resume sessions by default, the pool connects
+        # the rest of connections when waiting for session times out
+        port = self.listen()
+        self.patch(client, "SESSION_WAIT_TIMEOUT", 0.1)
+        cache = TLSSessionCache()
+        conn = yield client.connect_pool("127.0.0.1", port, poolsize=2, connectTimeout=5, maxRetries=0,
+                                         ssl=True, ssl_SessionCache=cache)
+        self.addCleanup(self.disconnect, conn)
+        yield self.waitForHandshakes(cache, 2)
+        self.assertEqual((cache.handshakes, cache.full), (2, 2))
+
+    def test_waitTimeout(self):
+        clock = task.Clock()
+        cache = TLSSessionCache(clock=clock)
+        d = cache.waitForSession(1)
+        self.assertNoResult(d)
+        clock.advance(1)
+        self.assertIdentical(self.successResultOf(d), None)
+        self.assertEqual(cache._waiting, [])
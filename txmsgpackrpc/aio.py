@@ -0,0 +1,654 @@
+"""
+asyncio backend of txmsgpackrpc.
+
+Protocol of this module shares message handling with Twisted protocols
+(see L{txmsgpackrpc.core}), but completes requests with C{asyncio.Future}
+and exposes coroutine API::
+
+    from txmsgpackrpc import aio
+
+    class EchoServer(aio.MsgpackRPCServer):
+        async def remote_echo(self, value):
+            return value
+
+    async def main():
+        server = await EchoServer().serve('127.0.0.1', 8000)
+        client = await aio.connect_pool('127.0.0.1', 8000, poolsize=4)
+        print(await client.createRequest('echo', 'hello'))
+
+Remote methods may be plain functions or coroutines. The module requires
+Python 3.5 or newer, uvloop is used when L{installUvloop} is called and the
+package is installed.
+"""
+import asyncio
+import collections
+import functools
+import inspect
+import logging
+import random
+import traceback
+
+from txmsgpackrpc.core import (MSGTYPE_REQUEST, MSGTYPE_RESPONSE, MSGTYPE_NOTIFICATION,
+                               RequestTable, createPacker, createUnpacker, packMessage,
+                               unpackRequest, unpackResponse, unpackNotification,
+                               lookupMethod, invokeMethod, errorValue)
+from txmsgpackrpc.error import ConnectionError, InvalidRequest, TimeoutError, unpackError
+
+
+logger = logging.getLogger('txmsgpackrpc.aio')
+
+
+def installUvloop():
+    """
+    Set uvloop event loop policy. Returns False if uvloop is not installed.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+class MsgpackAsyncProtocol(asyncio.Protocol):
+    """
+    msgpack rpc client/server stream protocol for asyncio
+    """
+    def __init__(self, handler=None, sendErrors=False, timeout=None, packerEncoding="utf-8",
+                 unpackerEncoding="utf-8", useList=True, connectionHandler=None):
+        """
+        @param handler: object of RPC server that will process requests and notifications.
+        @type handler: C{aio.MsgpackRPCServer}
+        @param sendErrors: forward any uncaught Exception details to remote peer.
+        @type sendErrors: C{bool}.
+        @param timeout: number of seconds the protocol waits for response of request.
+        @type timeout: C{float}
+        @param packerEncoding: encoding used to encode Python str and unicode. Default is 'utf-8'.
+        @type packerEncoding: C{str}
+        @param unpackerEncoding: encoding used for decoding msgpack bytes. Default is 'utf-8'.
+        @type unpackerEncoding: C{str}.
+        @param useList: If true, unpack msgpack array to Python list.  Otherwise, unpack to Python tuple.
+        @type useList: C{bool}.
+        @param connectionHandler: object notified by C{addConnection} and C{delConnection}
+            when connection is made and lost.
+        """
+        self.handler = handler
+        self.timeout = timeout
+        self.connectionHandler = connectionHandler
+        self.transport = None
+        self.connected = 0
+        self._sendErrors = sendErrors
+        self._packer = createPacker(packerEncoding)
+        self._unpacker = createUnpacker(unpackerEncoding, useList)
+        self._outgoing_requests = RequestTable()
+        self._incoming_requests = {}
+        self._pendingTimeouts = {}
+        self._closed = None
+
+    def isConnected(self):
+        return self.connected == 1
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connected = 1
+        self._closed = asyncio.get_event_loop().create_future()
+        if self.connectionHandler is not None:
+            self.connectionHandler.addConnection(self)
+
+    def connection_lost(self, exc):
+        self.connected = 0
+        self.transport = None
+
+        reason = ConnectionError("Connection lost: %s" % exc if exc is not None else "Connection closed")
+        for future in self._outgoing_requests.popAll():
+            if not future.done():
+                future.set_exception(reason)
+        for dc in self._pendingTimeouts.values():
+            dc.cancel()
+        self._pendingTimeouts.clear()
+        for task in list(self._incoming_requests.values()):
+            task.cancel()
+        self._incoming_requests.clear()
+
+        if self.connectionHandler is not None:
+            self.connectionHandler.delConnection(self)
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def data_received(self, data):
+        try:
+            self._unpacker.feed(data)
+            for message in self._unpacker:
+                self.messageReceived(message)
+        except Exception:
+            logger.exception('Failed to process received data')
+
+    def messageReceived(self, message):
+        if message[0] == MSGTYPE_REQUEST:
+            return self.requestReceived(message)
+        if message[0] == MSGTYPE_RESPONSE:
+            return self.responseReceived(message)
+        if message[0] == MSGTYPE_NOTIFICATION:
+            return self.notificationReceived(message)
+
+        raise NotImplementedError("Msgpack received a message of type '%s', "
+                                  "and no method has been specified to "
+                                  "handle this." % message[0])
+
+    def createRequest(self, method, *params):
+        """
+        Create new RPC request. Returns C{asyncio.Future} of result of RPC
+        method.
+
+        Possible exceptions:
+        * C{error.ConnectionError}: protocol is not connected or connection was lost
+        * C{error.ResponseError}: remote method returned error value
+        * C{error.TimeoutError}: timeout expired during request processing
+
+        @param method: RPC method name
+        @type method: C{str}
+        @param params: RPC method parameters
+        @type params: C{tuple}
+        @return Returns Future that resolves to result of RPC method.
+        @rtype C{asyncio.Future}
+        """
+        if not self.isConnected():
+            raise ConnectionError("Not connected")
+        msgid = self._outgoing_requests.nextMsgid()
+        self.writeMessage((MSGTYPE_REQUEST, msgid, method, params))
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._outgoing_requests[msgid] = future
+        if self.timeout:
+            self._pendingTimeouts[msgid] = loop.call_later(self.timeout, self.timeoutRequest, msgid)
+        return future
+
+    def createNotification(self, method, params):
+        """
+        Send RPC notification.
+
+        @param method: RPC method name
+        @type method: C{str}
+        @param params: RPC method parameters
+        @type params: C{tuple} or C{list}
+        """
+        if not self.isConnected():
+            raise ConnectionError("Not connected")
+        if not type(params) in (list, tuple):
+            params = (params,)
+        self.writeMessage((MSGTYPE_NOTIFICATION, method, params))
+
+    def writeMessage(self, message):
+        self.transport.write(packMessage(self._packer, message, self._sendErrors))
+
+    def getRemoteMethod(self, methodName):
+        if self.handler is None:
+            raise InvalidRequest("Cannot call RPC method on client")
+        return lookupMethod(self.handler, methodName, self._sendErrors)
+
+    def callRemoteMethod(self, msgid, methodName, params):
+        method = self.getRemoteMethod(methodName)
+        return invokeMethod(method, methodName, msgid, params, self._sendErrors)
+
+    def requestReceived(self, message):
+        msgid, methodName, params = unpackRequest(message, self._sendErrors)
+
+        if msgid in self._incoming_requests:
+            raise InvalidRequest("Request with msgid '%s' already exists" % msgid)
+
+        try:
+            result = self.callRemoteMethod(msgid, methodName, params)
+        except Exception as e:
+            return self.respondError(msgid, e)
+
+        if not inspect.isawaitable(result):
+            return self.respond(msgid, result)
+
+        task = asyncio.ensure_future(result)
+        self._incoming_requests[msgid] = task
+        task.add_done_callback(functools.partial(self._requestDone, msgid))
+
+    def _requestDone(self, msgid, task):
+        if self._incoming_requests.pop(msgid, None) is None or task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            self.respondError(msgid, exc)
+        else:
+            self.respond(msgid, task.result())
+
+    def respond(self, msgid, result):
+        if self.isConnected():
+            self.writeMessage((MSGTYPE_RESPONSE, msgid, None, result))
+
+    def respondError(self, msgid, exc):
+        tb = None
+        if self._sendErrors:
+            tb = ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        if self.isConnected():
+            self.writeMessage((MSGTYPE_RESPONSE, msgid, errorValue(exc, self._sendErrors, tb), None))
+
+    def responseReceived(self, message):
+        msgid, error, result = unpackResponse(message, self._sendErrors)
+
+        future = self._outgoing_requests.pop(msgid, None)
+        if future is None:
+            # Response can be delivered after timeout
+            return
+        dc = self._pendingTimeouts.pop(msgid, None)
+        if dc is not None:
+            dc.cancel()
+        if future.done():
+            return
+
+        if error is not None:
+            future.set_exception(unpackError(error))
+        else:
+            future.set_result(result)
+
+    def notificationReceived(self, message):
+        try:
+            methodName, params = unpackNotification(message)
+            result = self.callRemoteMethod(None, methodName, params)
+        except Exception:
+            # Log the error - there's no way to return it for a notification
+            logger.exception('Failed to process notification')
+            return
+
+        if inspect.isawaitable(result):
+            asyncio.ensure_future(result).add_done_callback(self._notificationDone)
+
+    def _notificationDone(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Notification failed', exc_info=task.exception())
+
+    def timeoutRequest(self, msgid):
+        self._pendingTimeouts.pop(msgid, None)
+        future = self._outgoing_requests.pop(msgid, None)
+        if future is not None and not future.done():
+            future.set_exception(TimeoutError("Request timed out"))
+
+    def closeConnection(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    async def waitClosed(self):
+        if self._closed is not None:
+            await asyncio.shield(self._closed)
+
+
+class _ReconnectingConnector(object):
+    """
+    Keeps C{count} connections to server and reconnects lost connections with
+    exponential backoff, the first attempt after connection is lost or fails
+    waits C{initialDelay}. Established connections are passed to connection
+    handler by protocols.
+    """
+    initialDelay = 1.0
+    factor = 2.7182818284590451
+    jitter = 0.11962656472
+    maxDelay = 12
+
+    def __init__(self, connect, handler, count, connectTimeout, maxRetries, protocolOptions):
+        self.connect = connect
+        self.handler = handler
+        self.count = count
+        self.connectTimeout = connectTimeout
+        self.maxRetries = maxRetries
+        self.protocolOptions = protocolOptions
+        self.continueTrying = 1
+        self.failed = 0
+        self._tasks = set()
+
+    def start(self):
+        for _ in range(self.count):
+            self._spawn()
+
+    def _spawn(self):
+        task = asyncio.ensure_future(self._keepConnected())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def buildProtocol(self):
+        return MsgpackAsyncProtocol(connectionHandler=self.handler, **self.protocolOptions)
+
+    async def _keepConnected(self):
+        retries = 0
+        delay = self.initialDelay
+        while self.continueTrying:
+            try:
+                _, protocol = await asyncio.wait_for(self.connect(self.buildProtocol), self.connectTimeout)
+            except Exception as e:
+                retries += 1
+                if self.maxRetries is not None and retries > self.maxRetries:
+                    self.connectionFailed(e)
+                    return
+            else:
+                retries = 0
+                delay = self.initialDelay
+                await protocol.waitClosed()
+                if not self.continueTrying:
+                    return
+
+            # server that accepts and closes connections isn't hammered either
+            await asyncio.sleep(random.normalvariate(delay, delay * self.jitter) if self.jitter else delay)
+            delay = min(delay * self.factor, self.maxDelay)
+
+    def connectionFailed(self, reason):
+        # give up when all connections exhausted their retries
+        self.failed += 1
+        if self.failed >= self.count:
+            self.continueTrying = 0
+            self.handler.callbackWaitingForConnection(
+                lambda f: f.done() or f.set_exception(ConnectionError("Connection failed: %s" % reason)))
+
+    def stopTrying(self):
+        self.continueTrying = 0
+        for task in list(self._tasks):
+            task.cancel()
+
+
+class AsyncConnectionHandler(object):
+    """
+    Connection handler of one reconnecting connection. If connection is not
+    established user requests and notifications wait until new connection is
+    made or error is detected.
+    """
+    def __init__(self):
+        self.connector = None
+        self.connection = None
+        self._waitingForConnection = set()
+
+    def addConnection(self, connection):
+        self.connection = connection
+        self.callbackWaitingForConnection(lambda f: f.done() or f.set_result(self))
+
+    def delConnection(self, connection):
+        if self.connection is connection:
+            self.connection = None
+
+    def waitForConnection(self):
+        if not self.connector.continueTrying:
+            raise ConnectionError("Not connected")
+        future = asyncio.get_event_loop().create_future()
+        if self.connection is not None and self.connection.connected:
+            future.set_result(self)
+        else:
+            self._waitingForConnection.add(future)
+        return future
+
+    def callbackWaitingForConnection(self, func):
+        while self._waitingForConnection:
+            func(self._waitingForConnection.pop())
+
+    async def getConnection(self):
+        while self.connection is None or not self.connection.connected:
+            await self.waitForConnection()
+        return self.connection
+
+    async def createRequest(self, method, *params):
+        """
+        Call RPC method and return its result. If connection is not
+        established, request waits until new connection is made or error is
+        detected. See L{MsgpackAsyncProtocol.createRequest}.
+        """
+        connection = await self.getConnection()
+        return await connection.createRequest(method, *params)
+
+    async def createNotification(self, method, params):
+        """
+        Send RPC notification. If connection is not established, notification
+        waits until new connection is made or error is detected.
+        """
+        connection = await self.getConnection()
+        connection.createNotification(method, params)
+
+    async def disconnect(self):
+        self.connector.stopTrying()
+        self.callbackWaitingForConnection(lambda f: f.done() or f.set_exception(ConnectionError("Not connected")))
+        connection = self.connection
+        if connection is not None and connection.connected:
+            connection.closeConnection()
+            await connection.waitClosed()
+
+
+class AsyncPooledConnectionHandler(AsyncConnectionHandler):
+    """
+    Connection handler of pool of reconnecting connections. Requests are
+    distributed among established connections in round-robin order, unless
+    the pool is isolated, in which case every connection serves one request
+    at a time.
+    """
+    def __init__(self, isolated=False):
+        super(AsyncPooledConnectionHandler, self).__init__()
+        self.isolated = isolated
+        self.pool = []
+        self.size = 0
+        self._idle = collections.deque()
+        self._waitingForIdle = collections.deque()
+
+    def addConnection(self, connection):
+        self.pool.append(connection)
+        self.size = len(self.pool)
+        self.connection = connection
+        self._putConnection(connection)
+        self.callbackWaitingForConnection(lambda f: f.done() or f.set_result(self))
+
+    def delConnection(self, connection):
+        try:
+            self.pool.remove(connection)
+        except ValueError:
+            pass
+        self.size = len(self.pool)
+        if self.connection is connection:
+            self.connection = self.pool[-1] if self.pool else None
+
+    def _putConnection(self, connection):
+        if not connection.connected:
+            return
+        while self._waitingForIdle:
+            future = self._waitingForIdle.popleft()
+            if not future.done():
+                future.set_result(connection)
+                return
+        self._idle.append(connection)
+
+    async def getConnection(self):
+        while True:
+            if not self.size:
+                await self.waitForConnection()
+                continue
+            if self._idle:
+                connection = self._idle.popleft()
+            else:
+                future = asyncio.get_event_loop().create_future()
+                self._waitingForIdle.append(future)
+                connection = await future
+            if not connection.connected:
+                logger.debug('Discarding dead connection.')
+                continue
+            if not self.isolated:
+                self._idle.append(connection)
+            return connection
+
+    async def _send(self, msgType, method, params):
+        connection = await self.getConnection()
+        try:
+            return await getattr(connection, msgType)(method, *params)
+        finally:
+            if self.isolated:
+                self._putConnection(connection)
+
+    async def createRequest(self, method, *params):
+        """
+        Call RPC method using connection of the pool and return its result.
+        See L{MsgpackAsyncProtocol.createRequest}.
+        """
+        return await self._send('createRequest', method, params)
+
+    async def createNotification(self, method, params):
+        """
+        Send RPC notification using connection of the pool.
+        """
+        connection = await self.getConnection()
+        try:
+            connection.createNotification(method, params)
+        finally:
+            if self.isolated:
+                self._putConnection(connection)
+
+    async def disconnect(self):
+        self.connector.stopTrying()
+        self.callbackWaitingForConnection(lambda f: f.done() or f.set_exception(ConnectionError("Not connected")))
+        for future in self._waitingForIdle:
+            if not future.done():
+                future.set_exception(ConnectionError("Not connected"))
+        self._waitingForIdle.clear()
+        pool = list(self.pool)
+        for connection in pool:
+            connection.closeConnection()
+        for connection in pool:
+            await connection.waitClosed()
+
+
+async def _start(handler, connect, count, connectTimeout, waitTimeout, maxRetries):
+    connector = _ReconnectingConnector(connect, handler, count, connectTimeout, maxRetries, {'timeout': waitTimeout})
+    handler.connector = connector
+    connector.start()
+    await handler.waitForConnection()
+    return handler
+
+
+async def connect(host, port, connectTimeout=None, waitTimeout=None, maxRetries=5, ssl=None):
+    """
+    Connect RPC server via TCP or SSL. Returns C{AsyncConnectionHandler}
+    or raises C{ConnectionError} if all connection attempts fail.
+
+    @param host: host name.
+    @type host: C{str}
+    @param port: port number.
+    @type port: C{int}
+    @param connectTimeout: number of seconds to wait before assuming
+        the connection has failed.
+    @type connectTimeout: C{float}
+    @param waitTimeout: number of seconds to wait for response of request.
+    @type waitTimeout: C{float}
+    @param maxRetries: maximum number of consecutive unsuccessful connection
+        attempts, after which no further connection attempts will be made.
+        None means no maximum. Default is 5.
+    @type maxRetries: C{int}
+    @param ssl: C{ssl.SSLContext} or True to use default SSL context.
+    @return connection handler
+    @rtype C{AsyncConnectionHandler}
+    """
+    loop = asyncio.get_event_loop()
+    return await _start(AsyncConnectionHandler(),
+                        lambda factory: loop.create_connection(factory, host, port, ssl=ssl),
+                        1, connectTimeout, waitTimeout, maxRetries)
+
+
+async def connect_pool(host, port, poolsize=10, isolated=False, connectTimeout=None, waitTimeout=None,
+                       maxRetries=5, ssl=None):
+    """
+    Connect RPC server via pool of TCP or SSL connections. Returns
+    C{AsyncPooledConnectionHandler} after the first connection is
+    established or raises C{ConnectionError} if all connection attempts
+    fail.
+
+    @param host: host name.
+    @type host: C{str}
+    @param port: port number.
+    @type port: C{int}
+    @param poolsize: number of connections in the pool. Default is 10.
+    @type poolsize: C{int}
+    @param isolated: every connection serves one request at a time.
+        Default is False.
+    @type isolated: C{bool}
+    @param connectTimeout: number of seconds to wait before assuming
+        the connection has failed.
+    @type connectTimeout: C{float}
+    @param waitTimeout: number of seconds to wait for response of request.
+    @type waitTimeout: C{float}
+    @param maxRetries: maximum number of consecutive unsuccessful connection
+        attempts of each connection. Default is 5.
+    @type maxRetries: C{int}
+    @param ssl: C{ssl.SSLContext} or True to use default SSL context.
+    @return connection handler
+    @rtype C{AsyncPooledConnectionHandler}
+    """
+    loop = asyncio.get_event_loop()
+    return await _start(AsyncPooledConnectionHandler(isolated),
+                        lambda factory: loop.create_connection(factory, host, port, ssl=ssl),
+                        poolsize, connectTimeout, waitTimeout, maxRetries)
+
+
+async def connect_UNIX(address, connectTimeout=None, waitTimeout=None, maxRetries=5):
+    """
+    Connect RPC server via UNIX socket. Returns C{AsyncConnectionHandler}
+    or raises C{ConnectionError} if all connection attempts fail.
+
+    @param address: path to a unix socket on the filesystem.
+    @type address: C{str}
+    @param connectTimeout: number of seconds to wait before assuming
+        the connection has failed.
+    @type connectTimeout: C{float}
+    @param waitTimeout: number of seconds to wait for response of request.
+    @type waitTimeout: C{float}
+    @param maxRetries: maximum number of consecutive unsuccessful connection
+        attempts. Default is 5.
+    @type maxRetries: C{int}
+    @return connection handler
+    @rtype C{AsyncConnectionHandler}
+    """
+    loop = asyncio.get_event_loop()
+    return await _start(AsyncConnectionHandler(),
+                        lambda factory: loop.create_unix_connection(factory, address),
+                        1, connectTimeout, waitTimeout, maxRetries)
+
+
+class MsgpackRPCServer(object):
+    """
+    msgpack-rpc server for asyncio. Subclass this, implement your own
+    methods. It will expose all methods that start with 'remote_' (without
+    the 'remote_' part). Methods may be coroutines.
+    """
+    def getProtocolFactory(self, protocol_class=MsgpackAsyncProtocol, **kwargs):
+        """
+        Return factory of protocols for C{loop.create_server} and similar.
+
+        @param protocol_class: protocol class to be instantiated. Default is C{MsgpackAsyncProtocol}.
+        @type protocol_class: C{type}.
+        @param kwargs: options passed to protocol.
+        """
+        kwargs.setdefault('sendErrors', True)
+        return functools.partial(protocol_class, handler=self, **kwargs)
+
+    async def serve(self, host, port, ssl=None, **kwargs):
+        """
+        Listen on TCP or SSL socket. Returns C{asyncio.Server}.
+
+        @param host: interface to listen on.
+        @type host: C{str}
+        @param port: port number, 0 to choose free port.
+        @type port: C{int}
+        @param ssl: C{ssl.SSLContext} of SSL server.
+        @param kwargs: options passed to protocol.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.create_server(self.getProtocolFactory(**kwargs), host, port, ssl=ssl)
+
+    async def serve_UNIX(self, address, **kwargs):
+        """
+        Listen on UNIX socket. Returns C{asyncio.Server}.
+
+        @param address: path to a unix socket on the filesystem.
+        @type address: C{str}
+        @param kwargs: options passed to protocol.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.create_unix_server(self.getProtocolFactory(**kwargs), address)
+
+
+__all__ = ['MsgpackAsyncProtocol', 'AsyncConnectionHandler', 'AsyncPooledConnectionHandler',
+           'MsgpackRPCServer', 'connect', 'connect_pool', 'connect_UNIX', 'installUvloop']
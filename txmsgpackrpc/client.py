@@ -6,20 +6,34 @@ from twisted.internet import defer, reactor
 from txmsgpackrpc.factory  import MsgpackClientFactory
 from txmsgpackrpc.handler  import PooledConnectionHandler
 from txmsgpackrpc.protocol import MsgpackDatagramProtocol, MsgpackMulticastDatagramProtocol
+from txmsgpackrpc.shm      import DEFAULT_RING_SIZE, DEFAULT_THRESHOLD, SharedMemoryClientFactory
 
 
-def __connect(host, port, factory, connectTimeout, ssl, ssl_CertificateOptions):
+# seconds the pool waits for TLS session of its first connection before it
+# connects the rest without it
+SESSION_WAIT_TIMEOUT = 1
+
+
+def __sessionCache(factory, ssl_CertificateOptions, ssl_SessionCache):
+    if ssl_SessionCache is None:
+        from txmsgpackrpc.tlssession import TLSSessionCache
+        ssl_SessionCache = TLSSessionCache(ssl_CertificateOptions or None)
+    factory.tlsSessions = ssl_SessionCache
+    return ssl_SessionCache
+
+
+def __connect(host, port, factory, connectTimeout, ssl, tlsSessions):
     if not ssl:
         reactor.connectTCP(host, port, factory, timeout=connectTimeout)
     else:
-        if not ssl_CertificateOptions:
-            from twisted.internet import ssl
-            ssl_CertificateOptions = ssl.CertificateOptions()
-        reactor.connectSSL(host, port, factory, ssl_CertificateOptions, timeout=connectTimeout)
+        # reconnects reuse the same session cache
+        reactor.connectSSL(host, port, factory, tlsSessions, timeout=connectTimeout)
 
 
 def connect(host, port, connectTimeout=None, waitTimeout=None, maxRetries=5,
-            ssl=False, ssl_CertificateOptions=None):
+            ssl=False, ssl_CertificateOptions=None, ssl_SessionCache=None,
+            metrics=None, interceptors=None, slowLog=None, subscriber=None, rpcHandler=None,
+            keepaliveInterval=None, keepaliveTimeout=None, maxQueued=None, queueTimeout=None):
     """
     Connect RPC server via TCP or SSL. Returns C{t.i.d.Deferred} that will
     callback with C{handler.SimpleConnectionHandler} object or errback with
@@ -45,15 +59,63 @@ def connect(host, port, connectTimeout=None, waitTimeout=None, maxRetries=5,
         server TLS connection used with OpenSSL. If None is passed, function
         create default options object. Default is None.
     @type ssl_CertificateOptions: C{CertificateOptions}
+    @param ssl_SessionCache: cache of TLS session resumed by connections
+        and their reconnects, it counts handshakes and measures their
+        durations. If None is passed, function creates cache of
+        C{ssl_CertificateOptions}. The cache is available as C{tlsSessions}
+        of factory of returned handler. Default is None.
+    @type ssl_SessionCache: C{tlssession.TLSSessionCache}
+    @param metrics: collector of metrics of requests. Default is None.
+    @type metrics: C{metrics.Metrics}
+    @param interceptors: interceptors of requests, the first one is the
+        outermost. Default is None.
+    @type interceptors: C{list} or C{interceptor.InterceptorChain}
+    @param slowLog: log of requests that exceed latency threshold.
+        Default is None.
+    @type slowLog: C{slowlog.SlowRequestLog}
+    @param subscriber: client side of publish/subscribe receiving
+        messages of subscribed topics. Default is None.
+    @type subscriber: C{pubsub.Subscriber}
+    @param rpcHandler: object serving RPC methods called by server over
+        the same connection, it exposes methods that start with 'remote_'
+        like C{server.MsgpackRPCServer}. Default is None.
+    @param keepaliveInterval: number of seconds between keepalive probes
+        of the server, which detect dead connections and measure their
+        round-trip time. Default is None, i.e. no probes.
+    @type keepaliveInterval: C{int} or C{float}
+    @param keepaliveTimeout: number of seconds to wait for answer of
+        keepalive probe before connection is reconnected. Default is
+        C{keepaliveInterval}.
+    @type keepaliveTimeout: C{int} or C{float}
+    @param maxQueued: maximum number of requests waiting for connection
+        while the client is disconnected, the following ones fail with
+        C{ConnectionError}. Default is None, i.e. unbounded.
+    @type maxQueued: C{int}
+    @param queueTimeout: maximum number of seconds a request waits for
+        connection before it fails with C{ConnectionError}. Default is
+        None, i.e. until connection is made or all attempts fail.
+    @type queueTimeout: C{int} or C{float}
     @return Deferred that callbacks with C{handler.SimpleConnectionHandler}
         object or errbacks with C{ConnectionError}.
     @rtype C{t.i.d.Deferred}
     """
-    factory = MsgpackClientFactory(connectTimeout=connectTimeout,
-                                   waitTimeout=waitTimeout)
+    factory = MsgpackClientFactory(handlerConfig={'maxQueued': maxQueued, 'queueTimeout': queueTimeout},
+                                   connectTimeout=connectTimeout,
+                                   waitTimeout=waitTimeout,
+                                   metrics=metrics,
+                                   interceptors=interceptors,
+                                   slowLog=slowLog,
+                                   subscriber=subscriber,
+                                   rpcHandler=rpcHandler,
+                                   keepaliveInterval=keepaliveInterval,
+                                   keepaliveTimeout=keepaliveTimeout)
     factory.maxRetries = maxRetries
 
-    __connect(host, port, factory, connectTimeout, ssl, ssl_CertificateOptions)
+    tlsSessions = None
+    if ssl:
+        tlsSessions = __sessionCache(factory, ssl_CertificateOptions, ssl_SessionCache)
+
+    __connect(host, port, factory, connectTimeout, ssl, tlsSessions)
 
     d = factory.handler.waitForConnection()
     d.addCallback(lambda conn: factory.handler)
@@ -61,9 +123,11 @@ def connect(host, port, connectTimeout=None, waitTimeout=None, maxRetries=5,
     return d
 
 
-def connect_pool(host, port, poolsize=10, isolated=False,
+def connect_pool(host, port, poolsize=10, isolated=False, maxConcurrentPerConnection=None,
                  connectTimeout=None, waitTimeout=None, maxRetries=5,
-                 ssl=False, ssl_CertificateOptions=None):
+                 ssl=False, ssl_CertificateOptions=None, ssl_SessionCache=None,
+                 metrics=None, interceptors=None, slowLog=None, subscriber=None, rpcHandler=None,
+                 keepaliveInterval=None, keepaliveTimeout=None, maxQueued=None, queueTimeout=None):
     """
     Connect RPC server via TCP or SSL using connection pool. Returns
     C{t.i.d.Deferred} that will callback with C{handler.PooledConnectionHandler}
@@ -79,6 +143,11 @@ def connect_pool(host, port, poolsize=10, isolated=False,
     @param isolated: when True the connection pool allow only one request per
         connection. Default is False.
     @type isolated: C{bool}
+    @param maxConcurrentPerConnection: maximum number of requests in
+        progress on one connection, requests over the limit of all
+        connections wait in FIFO order. Default is None, i.e. unlimited, or
+        1 if C{isolated} is True.
+    @type maxConcurrentPerConnection: C{int}
     @param connectTimeout: number of seconds to wait before assuming
         the connection has failed.
     @type connectTimeout: C{int}
@@ -95,19 +164,77 @@ def connect_pool(host, port, poolsize=10, isolated=False,
         server TLS connection used with OpenSSL. If None is passed, function
         create default options object. Default is None.
     @type ssl_CertificateOptions: C{CertificateOptions}
+    @param ssl_SessionCache: cache of TLS session resumed by connections
+        and their reconnects, it counts handshakes and measures their
+        durations. If None is passed, function creates cache of
+        C{ssl_CertificateOptions}. The cache is available as C{tlsSessions}
+        of factory of returned handler. Default is None.
+    @type ssl_SessionCache: C{tlssession.TLSSessionCache}
+    @param metrics: collector of metrics of requests. Default is None.
+    @type metrics: C{metrics.Metrics}
+    @param interceptors: interceptors of requests, the first one is the
+        outermost. Default is None.
+    @type interceptors: C{list} or C{interceptor.InterceptorChain}
+    @param slowLog: log of requests that exceed latency threshold.
+        Default is None.
+    @type slowLog: C{slowlog.SlowRequestLog}
+    @param subscriber: client side of publish/subscribe receiving
+        messages of subscribed topics. Default is None.
+    @type subscriber: C{pubsub.Subscriber}
+    @param rpcHandler: object serving RPC methods called by server over
+        the same connection, it exposes methods that start with 'remote_'
+        like C{server.MsgpackRPCServer}. Default is None.
+    @param keepaliveInterval: number of seconds between keepalive probes
+        of the server, which detect dead connections and measure their
+        round-trip time. Default is None, i.e. no probes.
+    @type keepaliveInterval: C{int} or C{float}
+    @param keepaliveTimeout: number of seconds to wait for answer of
+        keepalive probe before connection is reconnected. Default is
+        C{keepaliveInterval}.
+    @type keepaliveTimeout: C{int} or C{float}
+    @param maxQueued: maximum number of requests waiting for connection
+        while the client is disconnected, the following ones fail with
+        C{ConnectionError}. Default is None, i.e. unbounded.
+    @type maxQueued: C{int}
+    @param queueTimeout: maximum number of seconds a request waits for
+        connection before it fails with C{ConnectionError}. Default is
+        None, i.e. until connection is made or all attempts fail.
+    @type queueTimeout: C{int} or C{float}
     @return Deferred that callbacks with C{handler.PooledConnectionHandler}
         object or errbacks with C{ConnectionError}.
     @rtype C{t.i.d.Deferred}
     """
     factory = MsgpackClientFactory(handler=PooledConnectionHandler,
                                    handlerConfig={'poolsize': poolsize,
-                                                  'isolated': isolated},
+                                                  'isolated': isolated,
+                                                  'maxConcurrentPerConnection': maxConcurrentPerConnection,
+                                                  'maxQueued': maxQueued,
+                                                  'queueTimeout': queueTimeout},
                                    connectTimeout=connectTimeout,
-                                   waitTimeout=waitTimeout)
+                                   waitTimeout=waitTimeout,
+                                   metrics=metrics,
+                                   interceptors=interceptors,
+                                   slowLog=slowLog,
+                                   subscriber=subscriber,
+                                   rpcHandler=rpcHandler,
+                                   keepaliveInterval=keepaliveInterval,
+                                   keepaliveTimeout=keepaliveTimeout)
     factory.maxRetries = maxRetries
 
-    for _ in range(poolsize):
-        __connect(host, port, factory, connectTimeout, ssl, ssl_CertificateOptions)
+    if not ssl:
+        for _ in range(poolsize):
+            __connect(host, port, factory, connectTimeout, ssl, None)
+    else:
+        # the first connection negotiates session, the rest resume it
+        tlsSessions = __sessionCache(factory, ssl_CertificateOptions, ssl_SessionCache)
+        __connect(host, port, factory, connectTimeout, ssl, tlsSessions)
+
+        def connectRest(session):
+            if factory.continueTrying:
+                for _ in range(poolsize - 1):
+                    __connect(host, port, factory, connectTimeout, ssl, tlsSessions)
+
+        tlsSessions.waitForSession(SESSION_WAIT_TIMEOUT).addCallback(connectRest)
 
     d = factory.handler.waitForConnection()
     d.addCallback(lambda conn: factory.handler)
@@ -115,7 +242,9 @@ def connect_pool(host, port, poolsize=10, isolated=False,
     return d
 
 
-def connect_UDP(host, port, waitTimeout=None):
+def connect_UDP(host, port, waitTimeout=None,
+                retransmitInterval=None, retransmitBackoff=2, maxRetransmits=5, mtu=None,
+                metrics=None, interceptors=None, slowLog=None):
     """
     Connect RPC server via UDP. Returns C{t.i.d.Deferred} that will
     callback with C{protocol.MsgpackDatagramProtocol} object.
@@ -126,18 +255,45 @@ def connect_UDP(host, port, waitTimeout=None):
     @type port: C{int}
     @param waitTimeout: number of seconds the protocol waits for response.
     @type waitTimeout: C{int}
+    @param retransmitInterval: number of seconds after which unanswered
+        request is sent again. Default is None, i.e. no retransmission.
+        Servers should use C{reliable.ResponseCache} to not execute
+        retransmitted requests twice.
+    @type retransmitInterval: C{float}
+    @param retransmitBackoff: multiplier of retransmission interval after
+        each retransmission. Default is 2.
+    @type retransmitBackoff: C{float}
+    @param maxRetransmits: maximum number of retransmissions of one request
+        within C{waitTimeout}. Default is 5.
+    @type maxRetransmits: C{int}
+    @param mtu: maximum size of datagram in bytes, larger messages are sent
+        in fragments. Default is None, i.e. no fragmentation.
+    @type mtu: C{int}
+    @param metrics: collector of metrics of requests. Default is None.
+    @type metrics: C{metrics.Metrics}
+    @param interceptors: interceptors of requests, the first one is the
+        outermost. Default is None.
+    @type interceptors: C{list} or C{interceptor.InterceptorChain}
+    @param slowLog: log of requests that exceed latency threshold.
+        Default is None.
+    @type slowLog: C{slowlog.SlowRequestLog}
     @return Deferred that callbacks with C{protocol.MsgpackDatagramProtocol}
         object or errbacks with C{ConnectionError}.
     @rtype C{t.i.d.Deferred}
     """
-    protocol = MsgpackDatagramProtocol(address=(host, port), timeout=waitTimeout)
+    protocol = MsgpackDatagramProtocol(address=(host, port), timeout=waitTimeout,
+                                       retransmitInterval=retransmitInterval,
+                                       retransmitBackoff=retransmitBackoff,
+                                       maxRetransmits=maxRetransmits, mtu=mtu,
+                                       metrics=metrics, interceptors=interceptors, slowLog=slowLog)
 
     reactor.listenUDP(0, protocol)
 
     return defer.succeed(protocol)
 
 
-def connect_multicast(group, port, ttl=1, waitTimeout=None):
+def connect_multicast(group, port, ttl=1, waitTimeout=None, mtu=None, completion=None,
+                      metrics=None, interceptors=None, slowLog=None):
     """
     Connect RPC servers via multicast UDP. Returns C{t.i.d.Deferred} that will
     callback with C{protocol.MsgpackMulticastDatagramProtocol} object.
@@ -150,12 +306,28 @@ def connect_multicast(group, port, ttl=1, waitTimeout=None):
     @type ttl: C{int}
     @param waitTimeout: number of seconds the protocol waits for response.
     @type waitTimeout: C{int}
+    @param mtu: maximum size of datagram in bytes, larger messages are sent
+        in fragments. Default is None, i.e. no fragmentation.
+    @type mtu: C{int}
+    @param completion: policy deciding when request is complete, e.g.
+        C{completion.FirstResponses(3)}. Default is None, i.e. protocol
+        collects responses until C{waitTimeout} expires.
+    @type completion: C{completion.CompletionPolicy}
+    @param metrics: collector of metrics of requests. Default is None.
+    @type metrics: C{metrics.Metrics}
+    @param interceptors: interceptors of requests, the first one is the
+        outermost. Default is None.
+    @type interceptors: C{list} or C{interceptor.InterceptorChain}
+    @param slowLog: log of requests that exceed latency threshold.
+        Default is None.
+    @type slowLog: C{slowlog.SlowRequestLog}
     @return Deferred that callbacks with
         C{protocol.MsgpackMulticastDatagramProtocol} object or errbacks
         with C{ConnectionError}.
     @rtype C{t.i.d.Deferred}
     """
-    protocol = MsgpackMulticastDatagramProtocol(group, ttl, port, timeout=waitTimeout)
+    protocol = MsgpackMulticastDatagramProtocol(group, ttl, port, timeout=waitTimeout, mtu=mtu, completion=completion,
+                                                metrics=metrics, interceptors=interceptors, slowLog=slowLog)
 
     reactor.listenMulticast(0, protocol, listenMultiple=True)
 
@@ -164,7 +336,10 @@ def connect_multicast(group, port, ttl=1, waitTimeout=None):
 
 if sys.version_info.major < 3 or twisted.__version__ >= '15.3.0':  # Twisted <15.3.0 doesn't support UNIX sockets for Python 3
 
-    def connect_UNIX(address, connectTimeout=None, waitTimeout=None, maxRetries=5):
+    def connect_UNIX(address, connectTimeout=None, waitTimeout=None, maxRetries=5,
+                     sharedMemory=False, ringSize=DEFAULT_RING_SIZE, sharedMemoryThreshold=DEFAULT_THRESHOLD,
+                     metrics=None, interceptors=None, slowLog=None, subscriber=None, rpcHandler=None,
+                     keepaliveInterval=None, keepaliveTimeout=None, maxQueued=None, queueTimeout=None):
         """
         Connect RPC server via UNIX socket. Returns C{t.i.d.Deferred} that will
         callback with C{handler.SimpleConnectionHandler} object or errback with
@@ -182,12 +357,73 @@ if sys.version_info.major < 3 or twisted.__version__ >= '15.3.0':  # Twisted <15
             attempts, after which no further connection attempts will be made. If
             this is not explicitly set, no maximum is applied. Default is 5.
         @type maxRetries: C{int}
+        @param sharedMemory: pass large messages through shared-memory ring,
+            server must use C{shm.SharedMemoryServerFactory}. Default is False.
+        @type sharedMemory: C{bool}
+        @param ringSize: size of ring of outgoing messages in bytes.
+            Default is 64 MB.
+        @type ringSize: C{int}
+        @param sharedMemoryThreshold: minimal size of message in bytes that
+            is passed through ring. Default is 64 kB.
+        @type sharedMemoryThreshold: C{int}
+        @param metrics: collector of metrics of requests. Default is None.
+        @type metrics: C{metrics.Metrics}
+        @param interceptors: interceptors of requests, the first one is the
+            outermost. Default is None.
+        @type interceptors: C{list} or C{interceptor.InterceptorChain}
+        @param slowLog: log of requests that exceed latency threshold.
+            Default is None.
+        @type slowLog: C{slowlog.SlowRequestLog}
+        @param subscriber: client side of publish/subscribe receiving
+            messages of subscribed topics. Default is None.
+        @type subscriber: C{pubsub.Subscriber}
+        @param rpcHandler: object serving RPC methods called by server over
+            the same connection, it exposes methods that start with 'remote_'
+            like C{server.MsgpackRPCServer}. Default is None.
+        @param keepaliveInterval: number of seconds between keepalive probes
+            of the server, which detect dead connections and measure their
+            round-trip time. Default is None, i.e. no probes.
+        @type keepaliveInterval: C{int} or C{float}
+        @param keepaliveTimeout: number of seconds to wait for answer of
+            keepalive probe before connection is reconnected. Default is
+            C{keepaliveInterval}.
+        @type keepaliveTimeout: C{int} or C{float}
+        @param maxQueued: maximum number of requests waiting for connection
+            while the client is disconnected, the following ones fail with
+            C{ConnectionError}. Default is None, i.e. unbounded.
+        @type maxQueued: C{int}
+        @param queueTimeout: maximum number of seconds a request waits for
+            connection before it fails with C{ConnectionError}. Default is
+            None, i.e. until connection is made or all attempts fail.
+        @type queueTimeout: C{int} or C{float}
         @return Deferred that callbacks with C{handler.SimpleConnectionHandler}
             object or errbacks with C{ConnectionError}.
         @rtype C{t.i.d.Deferred}
         """
-        factory = MsgpackClientFactory(connectTimeout=connectTimeout,
-                                       waitTimeout=waitTimeout)
+        if sharedMemory:
+            factory = SharedMemoryClientFactory(handlerConfig={'maxQueued': maxQueued, 'queueTimeout': queueTimeout},
+                                                ringSize=ringSize,
+                                                threshold=sharedMemoryThreshold,
+                                                connectTimeout=connectTimeout,
+                                                waitTimeout=waitTimeout,
+                                                metrics=metrics,
+                                                interceptors=interceptors,
+                                                slowLog=slowLog,
+                                                subscriber=subscriber,
+                                                rpcHandler=rpcHandler,
+                                                keepaliveInterval=keepaliveInterval,
+                                                keepaliveTimeout=keepaliveTimeout)
+        else:
+            factory = MsgpackClientFactory(handlerConfig={'maxQueued': maxQueued, 'queueTimeout': queueTimeout},
+                                           connectTimeout=connectTimeout,
+                                           waitTimeout=waitTimeout,
+                                           metrics=metrics,
+                                           interceptors=interceptors,
+                                           slowLog=slowLog,
+                                           subscriber=subscriber,
+                                           rpcHandler=rpcHandler,
+                                           keepaliveInterval=keepaliveInterval,
+                                           keepaliveTimeout=keepaliveTimeout)
         factory.maxRetries = maxRetries
 
         reactor.connectUNIX(address, factory, timeout=connectTimeout)
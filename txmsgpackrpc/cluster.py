@@ -0,0 +1,211 @@
+from twisted.internet import defer
+from twisted.python import log
+
+from txmsgpackrpc.error import ConnectionError
+from txmsgpackrpc.factory import MsgpackClientFactory
+from txmsgpackrpc.handler import MethodStub, PooledConnectionHandler
+
+
+class EndpointConnectionHandler(PooledConnectionHandler):
+    """
+    Pool of connections to one endpoint of L{ClusterConnectionHandler}.
+    """
+    def __init__(self, factory, cluster, endpoint, poolsize=1):
+        super(EndpointConnectionHandler, self).__init__(factory, poolsize=poolsize)
+        self.cluster = cluster
+        self.endpoint = endpoint
+
+    def addConnection(self, connection):
+        super(EndpointConnectionHandler, self).addConnection(connection)
+        self.cluster.endpointConnected(self)
+
+
+class ClusterConnectionHandler(object):
+    """
+    Connection handler that keeps pool of connections to each of changing set
+    of endpoints and balances requests among connected endpoints in round
+    robin order. Endpoints are added and removed at runtime, e.g. by
+    C{discovery.Membership}. If no endpoint is connected, requests and
+    notifications wait until connection is made.
+    """
+    def __init__(self, poolsize=1, connectTimeout=None, waitTimeout=None, maxRetries=None,
+                 ssl=False, ssl_CertificateOptions=None, metrics=None, interceptors=None, slowLog=None,
+                 reactor=None):
+        """
+        @param poolsize: number of connections to each endpoint. Default is 1.
+        @type poolsize: C{int}
+        @param connectTimeout: number of seconds to wait before assuming
+            the connection has failed.
+        @type connectTimeout: C{int}
+        @param waitTimeout: number of seconds the protocol waits for activity
+            on a connection before reconnecting it.
+        @type waitTimeout: C{int}
+        @param maxRetries: maximum number of consecutive unsuccessful connection
+            attempts to one endpoint. Default is None, i.e. endpoint is
+            reconnected until it is removed.
+        @type maxRetries: C{int}
+        @param ssl: use SSL connections instead of TCP. Default is False.
+        @type ssl: C{bool}
+        @param ssl_CertificateOptions: the security properties of SSL
+            connections. Default is C{CertificateOptions()}.
+        @type ssl_CertificateOptions: C{CertificateOptions}
+        @param metrics: collector of metrics of requests. Default is None.
+        @type metrics: C{metrics.Metrics}
+        @param interceptors: interceptors of requests, the first one is the
+            outermost. Default is None.
+        @type interceptors: C{list} or C{interceptor.InterceptorChain}
+        @param slowLog: log of requests that exceed latency threshold.
+            Default is None.
+        @type slowLog: C{slowlog.SlowRequestLog}
+        @param reactor: reactor used to connect endpoints. Default is global
+            reactor.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.poolsize = poolsize
+        self.connectTimeout = connectTimeout
+        self.waitTimeout = waitTimeout
+        self.maxRetries = maxRetries
+        self.ssl = ssl
+        self.ssl_CertificateOptions = ssl_CertificateOptions
+        self.metrics = metrics
+        self.interceptors = interceptors
+        self.slowLog = slowLog
+        self.reactor = reactor
+
+        self.handlers = {}
+        self._next = 0
+        self._waitingForConnection = set()
+        self._closed = False
+
+    @property
+    def endpoints(self):
+        return sorted(self.handlers)
+
+    def addEndpoint(self, endpoint, info=None):
+        """
+        Start connecting to C{endpoint}. Adding known endpoint does nothing.
+
+        @param endpoint: (host, port) tuple.
+        @type endpoint: C{tuple}
+        @param info: announcement of endpoint, unused.
+        """
+        endpoint = tuple(endpoint)
+        if self._closed or endpoint in self.handlers:
+            return
+        factory = MsgpackClientFactory(handler=EndpointConnectionHandler,
+                                       handlerConfig={'cluster': self, 'endpoint': endpoint,
+                                                      'poolsize': self.poolsize},
+                                       connectTimeout=self.connectTimeout,
+                                       waitTimeout=self.waitTimeout,
+                                       metrics=self.metrics,
+                                       interceptors=self.interceptors,
+                                       slowLog=self.slowLog)
+        factory.maxRetries = self.maxRetries
+        self.handlers[endpoint] = factory.handler
+
+        host, port = endpoint
+        for _ in range(self.poolsize):
+            if not self.ssl:
+                self.reactor.connectTCP(host, port, factory, timeout=self.connectTimeout)
+            else:
+                options = self.ssl_CertificateOptions
+                if options is None:
+                    from twisted.internet import ssl
+                    options = ssl.CertificateOptions()
+                self.reactor.connectSSL(host, port, factory, options, timeout=self.connectTimeout)
+
+    def removeEndpoint(self, endpoint):
+        """
+        Close connections to C{endpoint} and stop reconnecting it. Requests
+        in progress are finished or failed by closed connections.
+
+        @return Deferred that callbacks when all connections are closed.
+        @rtype C{t.i.d.Deferred}
+        """
+        handler = self.handlers.pop(tuple(endpoint), None)
+        if handler is None:
+            return defer.succeed(None)
+        handler.factory.stopTrying()
+        return handler.disconnect()
+
+    def endpointConnected(self, handler):
+        if self.handlers.get(handler.endpoint) is not handler:
+            return
+        self.callbackWaitingForConnection(lambda d: d.callback(self))
+
+    def getHandler(self):
+        """
+        Return pool of the next connected endpoint, or None.
+        """
+        handlers = [h for h in self.handlers.values() if h.size]
+        if not handlers:
+            return None
+        self._next = (self._next + 1) % len(handlers)
+        return handlers[self._next]
+
+    def _send(self, msgType, method, params):
+        handler = self.getHandler()
+        if handler is not None:
+            return handler._send(msgType, method, params)
+        try:
+            d = self.waitForConnection()
+        except ConnectionError:
+            return defer.fail()
+        d.addCallback(lambda _: self._send(msgType, method, params))
+        return d
+
+    def createRequest(self, method, *params):
+        """
+        Create new RPC request on the next connected endpoint. See
+        C{handler.PooledConnectionHandler.createRequest}.
+        """
+        return self._send('createRequest', method, params)
+
+    def method(self, method):
+        """
+        Return callable L{MethodStub} of RPC method C{method}. Every call of
+        the stub is balanced among endpoints.
+
+        @param method: RPC method name
+        @type method: C{str}
+        @rtype C{MethodStub}
+        """
+        return MethodStub(self, method)
+
+    def callStub(self, stub, params):
+        return self._send('createPreparedRequest', stub, params)
+
+    def createNotification(self, method, params):
+        """
+        Create new RPC notification on the next connected endpoint. See
+        C{handler.PooledConnectionHandler.createNotification}.
+        """
+        return self._send('createNotification', method, params)
+
+    def waitForConnection(self):
+        if self._closed:
+            raise ConnectionError("Not connected")
+
+        if any(h.size for h in self.handlers.values()):
+            return defer.succeed(self)
+
+        d = defer.Deferred()
+        self._waitingForConnection.add(d)
+        return d
+
+    def callbackWaitingForConnection(self, func):
+        while self._waitingForConnection:
+            d = self._waitingForConnection.pop()
+            func(d)
+
+    def disconnect(self):
+        self._closed = True
+        ds = [self.removeEndpoint(endpoint) for endpoint in list(self.handlers)]
+        self.callbackWaitingForConnection(lambda d: d.errback(ConnectionError("Not connected")))
+        d = defer.gatherResults(ds, consumeErrors=True)
+        d.addErrback(log.err)
+        return d
+
+
+__all__ = ['ClusterConnectionHandler']
@@ -0,0 +1,83 @@
+class CompletionPolicy(object):
+    """
+    Policy deciding when multicast request is complete. Collected results
+    are delivered as soon as the policy is satisfied, otherwise when
+    request times out.
+
+    @ivar quietPeriod: number of seconds after the last response after which
+        request is complete, or None.
+    """
+    quietPeriod = None
+
+    def isSatisfied(self, responders):
+        """
+        Returns True if request is complete.
+
+        @param responders: addresses of peers that responded, in order of
+            responses.
+        @type responders: C{list}
+        @rtype C{bool}
+        """
+        return False
+
+
+class FirstResponses(CompletionPolicy):
+    """
+    Request is complete when C{count} responses are received.
+    """
+    def __init__(self, count):
+        if count < 1:
+            raise ValueError('Count of responses must be positive')
+        self.count = count
+
+    def isSatisfied(self, responders):
+        return len(responders) >= self.count
+
+    def __repr__(self):
+        return '<FirstResponses %d>' % self.count
+
+
+class FirstResponse(FirstResponses):
+    """
+    Request is complete when the first response is received.
+    """
+    def __init__(self):
+        super(FirstResponse, self).__init__(1)
+
+
+class KnownResponders(CompletionPolicy):
+    """
+    Request is complete when all known peers responded. Peers are given
+    either as (host, port) tuples or as hosts.
+    """
+    def __init__(self, peers):
+        self.peers = frozenset(tuple(peer) if isinstance(peer, list) else peer for peer in peers)
+        if not self.peers:
+            raise ValueError('At least one responder must be given')
+
+    def isSatisfied(self, responders):
+        responded = set()
+        for peer in responders:
+            responded.add(peer)
+            responded.add(peer[0])
+        return self.peers <= responded
+
+    def __repr__(self):
+        return '<KnownResponders %r>' % sorted(self.peers)
+
+
+class QuietPeriod(CompletionPolicy):
+    """
+    Request is complete when no response is received for C{seconds} after
+    the last one.
+    """
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError('Quiet period must be positive')
+        self.quietPeriod = seconds
+
+    def __repr__(self):
+        return '<QuietPeriod %s>' % self.quietPeriod
+
+
+__all__ = ['CompletionPolicy', 'FirstResponse', 'FirstResponses', 'KnownResponders', 'QuietPeriod']
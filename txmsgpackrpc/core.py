@@ -0,0 +1,282 @@
+"""
+I/O-free core of msgpack-rpc protocol shared by Twisted and asyncio backends.
+
+Functions of this module pack and unpack messages, validate their structure
+and invoke methods of RPC server objects. They don't depend on any event
+loop, so backends only move bytes between transports and the core, and
+complete requests with their own kind of promise (C{Deferred} or
+C{asyncio.Future}).
+"""
+import struct
+import sys
+from collections import namedtuple
+
+import msgpack
+
+from txmsgpackrpc.error import InvalidData, InvalidRequest, InvalidResponse, SerializationError, packError
+
+
+MSGTYPE_REQUEST=0
+MSGTYPE_RESPONSE=1
+MSGTYPE_NOTIFICATION=2
+
+# msgid is 32-bit unsigned integer
+MAX_MSGID = 0xFFFFFFFF
+
+# fixarray of 4 items followed by MSGTYPE_REQUEST
+REQUEST_HEADER = b'\x94\x00'
+
+_FIXINTS = [bytes(bytearray([i])) for i in range(0x80)]
+_UINT8 = struct.Struct('>BB')
+_UINT16 = struct.Struct('>BH')
+_UINT32 = struct.Struct('>BI')
+
+
+Context = namedtuple('Context', ['peer'])
+
+
+def createPacker(encoding="utf-8"):
+    return msgpack.Packer(encoding=encoding)
+
+
+_sharedPackers = {}
+
+
+def sharedPacker(encoding="utf-8"):
+    """
+    Return packer shared by all callers using the same encoding. Packing is
+    synchronous and packer resets its buffer after each message, so protocols
+    running in one thread can share it.
+    """
+    packer = _sharedPackers.get(encoding)
+    if packer is None:
+        packer = _sharedPackers[encoding] = createPacker(encoding)
+    return packer
+
+
+def createUnpacker(encoding="utf-8", useList=True):
+    return msgpack.Unpacker(encoding=encoding, unicode_errors='strict', use_list=useList)
+
+
+def unpackMessage(data, encoding="utf-8", useList=True):
+    """
+    Deserialize one complete message from bytes-like object, without
+    buffering it in unpacker.
+    """
+    return msgpack.unpackb(data, encoding=encoding, unicode_errors='strict', use_list=useList)
+
+
+def packMessage(packer, message, sendErrors=False):
+    """
+    Serialize message. Raises C{SerializationError} if message can't be
+    serialized, or original exception if C{sendErrors} is True.
+    """
+    try:
+        return packer.pack(message)
+    except Exception:
+        packer.reset()
+        if sendErrors:
+            raise
+        raise SerializationError("ERROR: Failed to write message: %s" % (message,))
+
+
+def packMsgid(msgid):
+    """
+    Serialize msgid as msgpack unsigned integer without packer.
+    """
+    if msgid < 0x80:
+        return _FIXINTS[msgid]
+    if msgid < 0x100:
+        return _UINT8.pack(0xcc, msgid)
+    if msgid < 0x10000:
+        return _UINT16.pack(0xcd, msgid)
+    return _UINT32.pack(0xce, msgid)
+
+
+def packRequest(packer, msgid, encodedMethod, params, sendErrors=False):
+    """
+    Serialize request whose method name was already serialized by
+    L{packMessage}. Only msgid and params are packed, the rest of the message
+    is copied from cached bytes.
+    """
+    try:
+        return b''.join((REQUEST_HEADER, packMsgid(msgid), encodedMethod, packer.pack(params)))
+    except Exception:
+        packer.reset()
+        if sendErrors:
+            raise
+        raise SerializationError("ERROR: Failed to write message: %s" % ((MSGTYPE_REQUEST, msgid, encodedMethod, params),))
+
+
+def unpackRequest(message, sendErrors=False):
+    """
+    Return tuple(msgid, method name, params) of request message.
+    """
+    try:
+        (msgType, msgid, methodName, params) = message
+    except ValueError:
+        if sendErrors:
+            raise
+        if not len(message) == 4:
+            raise InvalidData("Incorrect message length. Expected 4; received %s" % len(message))
+        raise InvalidData("Failed to unpack request.")
+    except Exception:
+        if sendErrors:
+            raise
+        raise InvalidData("Unexpected error. Failed to unpack request.")
+    return msgid, methodName, params
+
+
+def unpackResponse(message, sendErrors=False):
+    """
+    Return tuple(msgid, error, result) of response message.
+    """
+    try:
+        (msgType, msgid, error, result) = message
+    except Exception as e:
+        if sendErrors:
+            raise
+        raise InvalidResponse("Failed to unpack response: %s" % e)
+    return msgid, error, result
+
+
+def unpackNotification(message):
+    """
+    Return tuple(method name, params) of notification message.
+    """
+    (msgType, methodName, params) = message
+    return methodName, params
+
+
+def argumentNames(method):
+    """
+    Return names of arguments of C{method}, or empty tuple if they can't be
+    inspected. Decorated methods, e.g. by C{defer.inlineCallbacks}, are
+    inspected through their C{__wrapped__} function.
+    """
+    try:
+        while hasattr(method, '__wrapped__'):
+            method = method.__wrapped__
+        if sys.version_info.major == 2:
+            code = method.func_code
+            return code.co_varnames[:code.co_argcount]
+        code = method.__code__
+        return code.co_varnames[:code.co_argcount + code.co_kwonlyargcount]
+    except Exception:
+        return ()
+
+
+def acceptsMsgid(method):
+    """
+    Return True if C{method} has argument called msgid.
+    """
+    return 'msgid' in argumentNames(method)
+
+
+def passConnection(method):
+    """
+    Decorator of remote method that takes keyword argument C{connection},
+    the protocol the request was received by. Other arguments called
+    connection are ordinary parameters of the request.
+    """
+    method.passConnection = True
+    return method
+
+
+def lookupMethod(handler, methodName, sendErrors=False, builtinMethods=None):
+    """
+    Return method of RPC server object C{handler} (C{remote_<methodName>})
+    or reserved method of C{builtinMethods}.
+    """
+    try:
+        if builtinMethods is not None and methodName in builtinMethods:
+            return builtinMethods[methodName]
+        return getattr(handler, "remote_" + methodName)
+    except Exception:
+        if sendErrors:
+            raise
+        raise InvalidRequest("Client attempted to call unimplemented method: remote_%s" % methodName)
+
+
+def invokeMethod(method, methodName, msgid, params, sendErrors=False, connection=None):
+    """
+    Call C{method} with C{params}. If the method has a keyword argument
+    called msgid, then it is passed msgid of the request. If it is decorated
+    by L{passConnection}, then it is passed C{connection} the request was
+    received by, unless it is None.
+    """
+    try:
+        names = argumentNames(method)
+        if connection is not None and getattr(method, 'passConnection', False):
+            if 'msgid' in names:
+                return method(*params, msgid=msgid, connection=connection)
+            return method(*params, connection=connection)
+        if 'msgid' in names:
+            return method(*params, msgid=msgid)
+        return method(*params)
+    except TypeError:
+        if sendErrors:
+            raise
+        raise InvalidRequest("Wrong number of arguments for %s" % methodName)
+
+
+def errorValue(exc, sendErrors=False, traceback=None):
+    """
+    Return error value of response for exception C{exc}. Typed errors are
+    packed together with their type name, other errors are described by
+    C{traceback} if C{sendErrors} is True, otherwise by their message.
+    """
+    error = packError(exc)
+    if error is None:
+        if sendErrors and traceback is not None:
+            error = traceback
+        else:
+            error = str(exc)
+    return error
+
+
+class RequestTable(dict):
+    """
+    Table of outgoing requests waiting for response, maps msgid to object
+    that will be completed by the response.
+    """
+    def __init__(self):
+        super(RequestTable, self).__init__()
+        self.lastMsgid = 0
+
+    def nextMsgid(self):
+        msgid = self.lastMsgid + 1
+        if msgid > MAX_MSGID:
+            msgid = 1
+        self.lastMsgid = msgid
+        return msgid
+
+    def popAll(self):
+        """
+        Remove all requests and return list of their waiters.
+        """
+        waiters = list(self.values())
+        self.clear()
+        return waiters
+
+
+class _NoRequests(RequestTable):
+    """
+    Empty request table shared by protocols that haven't used their own table
+    yet. Lookups and removals behave as on any empty table, storing a request
+    is an error, owner must replace it with a new table first.
+    """
+    def __setitem__(self, msgid, value):
+        raise TypeError('Shared empty request table is read-only')
+
+    def nextMsgid(self):
+        raise TypeError('Shared empty request table is read-only')
+
+
+NO_REQUESTS = _NoRequests()
+
+
+__all__ = ['MSGTYPE_REQUEST', 'MSGTYPE_RESPONSE', 'MSGTYPE_NOTIFICATION', 'Context', 'RequestTable',
+           'NO_REQUESTS', 'createPacker', 'sharedPacker', 'createUnpacker', 'unpackMessage', 'packMessage',
+           'packRequest', 'unpackRequest', 'unpackResponse', 'unpackNotification', 'passConnection', 'lookupMethod',
+           'argumentNames', 'invokeMethod', 'errorValue']
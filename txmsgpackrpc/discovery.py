@@ -0,0 +1,273 @@
+"""
+Service discovery over multicast.
+
+Servers announce their endpoint, load and capabilities to multicast group by
+L{Announcer}. Clients listen to the group with L{DiscoveryProtocol}, which
+keeps live view of announced servers in L{Membership} and adds and removes
+endpoints of target client, e.g. C{cluster.ClusterConnectionHandler}.
+"""
+from twisted.internet import task
+from twisted.python import log
+
+from txmsgpackrpc.protocol import MsgpackMulticastDatagramProtocol
+
+
+ANNOUNCE_METHOD = '__announce__'
+
+
+class Member(object):
+    """
+    Announced server.
+
+    @ivar endpoint: (host, port) tuple of stream server.
+    @ivar load: load reported by server, or None.
+    @ivar capabilities: set of capabilities reported by server.
+    @ivar lastSeen: time of the last announcement.
+    """
+    __slots__ = ('endpoint', 'load', 'capabilities', 'lastSeen')
+
+    def __init__(self, endpoint, load, capabilities, lastSeen):
+        self.endpoint = endpoint
+        self.load = load
+        self.capabilities = capabilities
+        self.lastSeen = lastSeen
+
+    def __repr__(self):
+        return '<Member %s:%d load=%r>' % (self.endpoint[0], self.endpoint[1], self.load)
+
+
+class Membership(object):
+    """
+    Live view of announced servers. Servers that don't announce themselves
+    for C{expireAfter} seconds or announce they are leaving are removed.
+    Added and removed endpoints are passed to C{target} by its methods
+    C{addEndpoint(endpoint, member)} and C{removeEndpoint(endpoint)}.
+    """
+    def __init__(self, target=None, expireAfter=3, capabilities=(), clock=None):
+        """
+        @param target: client whose endpoints are maintained, e.g.
+            C{cluster.ClusterConnectionHandler}. Default is None.
+        @param expireAfter: number of seconds after which silent server is
+            removed. Should be a few announcement intervals. Default is 3.
+        @type expireAfter: C{int} or C{float}
+        @param capabilities: capabilities that server must announce to be
+            member. Default is any server.
+        @type capabilities: C{list}
+        @param clock: provider of C{IReactorTime}. Default is reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.target = target
+        self.expireAfter = expireAfter
+        self.capabilities = frozenset(capabilities)
+        self.clock = clock
+        self.members = {}
+        self._expireCall = None
+
+    def __len__(self):
+        return len(self.members)
+
+    def start(self):
+        """
+        Start periodic expiration of silent servers.
+        """
+        if self._expireCall is None:
+            self._expireCall = task.LoopingCall(self.expire)
+            self._expireCall.clock = self.clock
+            self._expireCall.start(self.expireAfter / 2.0, now=False)
+
+    def stop(self):
+        if self._expireCall is not None:
+            self._expireCall.stop()
+            self._expireCall = None
+
+    def announced(self, info, source=None):
+        """
+        Process announcement of server.
+
+        @param info: announcement with keys C{host}, C{port}, C{load},
+            C{capabilities} and C{leaving}.
+        @type info: C{dict}
+        @param source: address announcement was received from. Used as host
+            of servers that don't announce it.
+        @type source: C{tuple}
+        """
+        host = info.get('host') or (source and source[0])
+        port = info.get('port')
+        if not host or not isinstance(port, int):
+            log.msg('Invalid announcement %r from %r' % (info, source))
+            return
+        endpoint = (host, port)
+
+        capabilities = frozenset(info.get('capabilities') or ())
+        if info.get('leaving') or not self.capabilities <= capabilities:
+            self.remove(endpoint)
+            return
+
+        now = self.clock.seconds()
+        member = self.members.get(endpoint)
+        if member is not None:
+            member.load = info.get('load')
+            member.capabilities = capabilities
+            member.lastSeen = now
+            return
+
+        member = self.members[endpoint] = Member(endpoint, info.get('load'), capabilities, now)
+        if self.target is not None:
+            self.target.addEndpoint(endpoint, member)
+
+    def remove(self, endpoint):
+        if self.members.pop(endpoint, None) is not None and self.target is not None:
+            self.target.removeEndpoint(endpoint)
+
+    def expire(self):
+        deadline = self.clock.seconds() - self.expireAfter
+        for endpoint, member in list(self.members.items()):
+            if member.lastSeen < deadline:
+                self.remove(endpoint)
+
+
+class DiscoveryProtocol(MsgpackMulticastDatagramProtocol):
+    """
+    Multicast protocol that receives announcements of servers and feeds
+    them to L{Membership}.
+    """
+    def __init__(self, group, membership, ttl=1, **kwargs):
+        """
+        @param group: IP of multicast group that will be joined.
+        @type group: C{str}
+        @param membership: view of announced servers.
+        @type membership: L{Membership}
+        @param ttl: time to live of multicast packets.
+        @type ttl: C{int}
+        @param kwargs: other options of C{protocol.MsgpackMulticastDatagramProtocol}.
+        """
+        super(DiscoveryProtocol, self).__init__(group, ttl, **kwargs)
+        self.membership = membership
+
+    def notificationReceived(self, message, context=None):
+        if len(message) == 3 and message[1] == ANNOUNCE_METHOD:
+            try:
+                info, = message[2]
+                self.membership.announced(info, context and context.peer)
+            except Exception:
+                log.err()
+            return None
+        return super(DiscoveryProtocol, self).notificationReceived(message, context)
+
+    def startProtocol(self):
+        super(DiscoveryProtocol, self).startProtocol()
+        self.membership.start()
+
+    def stopProtocol(self):
+        self.membership.stop()
+        super(DiscoveryProtocol, self).stopProtocol()
+
+
+class Announcer(object):
+    """
+    Periodically announces endpoint of server to multicast group.
+    """
+    def __init__(self, protocol, endpoint, interval=1, load=None, capabilities=(), clock=None):
+        """
+        @param protocol: multicast protocol whose client context is the
+            group, e.g. returned by C{client.connect_multicast}.
+        @type protocol: C{protocol.MsgpackMulticastDatagramProtocol}
+        @param endpoint: (host, port) tuple of stream server. Empty host is
+            replaced by source address of announcements.
+        @type endpoint: C{tuple}
+        @param interval: number of seconds between announcements. Default is 1.
+        @type interval: C{int} or C{float}
+        @param load: callable returning current load of server, e.g. number
+            of its connections. Default is None.
+        @type load: C{callable}
+        @param capabilities: capabilities of server. Default is none.
+        @type capabilities: C{list}
+        @param clock: provider of C{IReactorTime}. Default is reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.protocol = protocol
+        self.endpoint = endpoint
+        self.interval = interval
+        self.load = load
+        self.capabilities = list(capabilities)
+        self.clock = clock
+        self._call = None
+
+    def announcement(self, leaving=False):
+        host, port = self.endpoint
+        info = {'host': host or None, 'port': port, 'capabilities': self.capabilities}
+        if self.load is not None:
+            info['load'] = self.load()
+        if leaving:
+            info['leaving'] = True
+        return info
+
+    def announce(self, leaving=False):
+        if not self.protocol.isConnected():
+            return
+        try:
+            self.protocol.createNotification(ANNOUNCE_METHOD, [self.announcement(leaving)])
+        except Exception:
+            log.err()
+
+    def start(self):
+        """
+        Start announcing, the first announcement is sent immediately.
+        """
+        if self._call is None:
+            self._call = task.LoopingCall(self.announce)
+            self._call.clock = self.clock
+            self._call.start(self.interval, now=True)
+
+    def stop(self):
+        """
+        Stop announcing and announce that server is leaving, so clients
+        remove it immediately.
+        """
+        if self._call is not None:
+            self._call.stop()
+            self._call = None
+            self.announce(leaving=True)
+
+
+def listenDiscovery(group, port, target, expireAfter=3, capabilities=(), ttl=1, reactor=None):
+    """
+    Join multicast group and maintain endpoints of C{target} announced to it.
+
+    @param group: IP of multicast group.
+    @type group: C{str}
+    @param port: port of multicast group.
+    @type port: C{int}
+    @param target: client with methods C{addEndpoint} and C{removeEndpoint},
+        e.g. C{cluster.ClusterConnectionHandler}.
+    @return protocol whose C{membership} is view of announced servers.
+    @rtype L{DiscoveryProtocol}
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    membership = Membership(target, expireAfter=expireAfter, capabilities=capabilities, clock=reactor)
+    protocol = DiscoveryProtocol(group, membership, ttl=ttl)
+    reactor.listenMulticast(port, protocol, listenMultiple=True)
+    return protocol
+
+
+def startAnnouncing(group, port, endpoint, interval=1, load=None, capabilities=(), ttl=1, reactor=None):
+    """
+    Announce C{endpoint} to multicast group. See L{Announcer}.
+
+    @rtype L{Announcer}
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    protocol = MsgpackMulticastDatagramProtocol(group, ttl, port)
+    reactor.listenMulticast(0, protocol, listenMultiple=True)
+    announcer = Announcer(protocol, endpoint, interval=interval, load=load, capabilities=capabilities,
+                          clock=reactor)
+    announcer.start()
+    return announcer
+
+
+__all__ = ['Announcer', 'Membership', 'DiscoveryProtocol', 'listenDiscovery', 'startAnnouncing',
+           'ANNOUNCE_METHOD']
@@ -0,0 +1,329 @@
+"""
+Graceful shutdown of servers.
+
+C{MsgpackServerFactory.drain} stops listening ports, sends notification
+C{__goaway__} to every connection and closes each connection as soon as the
+requests it received are answered. Connections still busy when the deadline
+expires are aborted. Clients stop sending requests into connection that
+received C{__goaway__}, close it when their own requests are answered and
+reconnect without backoff, i.e. to another server or to the successor
+process.
+
+Listening TCP sockets can be handed to the successor process over UNIX
+socket, so connections are accepted all the time of a deploy. The old
+process calls L{handOverListeners}, the new one L{takeOverListeners}, then
+the old one drains its connections::
+
+    # old process
+    d = handOverListeners('/run/server.handoff', [port])
+    d.addCallback(lambda _: factory.drain(timeout=30, ports=[port]))
+
+    # new process
+    ports = yield takeOverListeners('/run/server.handoff', factory)
+
+The handoff socket is accessible only to the owner of the process and, where
+the platform reports credentials of UNIX socket peers, processes of other
+users are refused.
+
+Twisted shuts a listening TCP socket down when its port stops listening,
+which would stop the socket in the successor process as well. Handed over
+ports are told not to do it by private attribute C{_shouldShutdown} of
+C{twisted.internet.tcp.Port}, ports without the attribute can't be handed
+over.
+"""
+import errno
+import os
+import socket
+import stat
+import struct
+
+from twisted.internet import defer, protocol
+from twisted.internet.address import IPv4Address, IPv6Address
+from twisted.internet.interfaces import IFileDescriptorReceiver
+from twisted.python import log
+from zope.interface import implementer
+
+
+GOAWAY_METHOD = '__goaway__'
+
+_FAMILIES = {b'4': socket.AF_INET, b'6': socket.AF_INET6}
+
+
+class Drain(object):
+    """
+    Graceful shutdown of connections of one server factory.
+
+    @ivar closed: number of connections closed after their requests were
+        answered.
+    @ivar aborted: number of connections aborted when deadline expired.
+    """
+    def __init__(self, factory, timeout, clock=None):
+        """
+        @param factory: drained factory.
+        @type factory: C{factory.MsgpackServerFactory}
+        @param timeout: number of seconds connections have to finish their
+            requests.
+        @type timeout: C{int} or C{float}
+        @param clock: provider of C{IReactorTime}. Default is reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.factory = factory
+        self.timeout = timeout
+        self.clock = clock
+        self.closed = 0
+        self.aborted = 0
+        self._deadline = None
+        self._waiting = []
+
+    def start(self, ports=()):
+        """
+        Stop listening C{ports} and ask all connections to go away.
+
+        @param ports: listening ports of the factory.
+        @type ports: iterable of C{IListeningPort}
+        """
+        for port in ports:
+            port.stopListening()
+        self._deadline = self.clock.callLater(self.timeout, self.expired)
+        for connection in list(self.factory.connections):
+            self.connectionMade(connection)
+        self._checkDone()
+
+    def wait(self):
+        """
+        Return Deferred that callbacks when all connections are closed.
+        """
+        d = defer.Deferred()
+        if self._deadline is not None and not self.factory.connections:
+            d.callback(None)
+        else:
+            self._waiting.append(d)
+        return d
+
+    def connectionMade(self, connection):
+        d = defer.maybeDeferred(connection.createNotification, GOAWAY_METHOD, [])
+        # peer that doesn't read anymore is aborted by deadline
+        d.addErrback(lambda f: None)
+        self._closeWhenIdle(connection)
+
+    def _closeWhenIdle(self, connection):
+        if not connection.connected:
+            return
+        d = connection.waitForRequests()
+        if d.called:
+            self.closed += 1
+            connection.closeConnection()
+        else:
+            # requests received in the meantime are waited for too
+            d.addCallback(lambda _: self._closeWhenIdle(connection))
+
+    def connectionLost(self, connection):
+        self._checkDone()
+
+    def _checkDone(self):
+        if self.factory.connections or self._deadline is None:
+            return
+        if self._deadline.active():
+            self._deadline.cancel()
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def expired(self):
+        connections = list(self.factory.connections)
+        if connections:
+            log.msg('Aborting %d connections with unfinished requests' % len(connections))
+        for connection in connections:
+            self.aborted += 1
+            transport = connection.transport
+            if hasattr(transport, 'abortConnection'):
+                transport.abortConnection()
+            else:
+                transport.loseConnection()
+
+
+def _family(port):
+    host = port.getHost()
+    if not hasattr(port, '_shouldShutdown'):
+        raise ValueError('Cannot hand over listener of %r, it would shut the socket down' % (host,))
+    if isinstance(host, IPv6Address):
+        return b'6'
+    if isinstance(host, IPv4Address):
+        return b'4'
+    raise ValueError('Cannot hand over listener of %r' % (host,))
+
+
+def _removeStaleSocket(path):
+    """
+    Remove UNIX socket C{path} left by crashed process, i.e. nobody listens
+    on it. Other files and sockets in use are left for bind to fail.
+    """
+    try:
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            return
+    except OSError:
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error as e:
+        if e.errno == errno.ECONNREFUSED:
+            os.unlink(path)
+    finally:
+        probe.close()
+
+
+def _peerUid(transport):
+    """
+    Return user id of process on the other end of UNIX socket, or None if
+    the platform doesn't tell.
+    """
+    try:
+        credentials = transport.getHandle().getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                       struct.calcsize('3i'))
+    except (AttributeError, socket.error):
+        return None
+    pid, uid, gid = struct.unpack('3i', credentials)
+    return uid
+
+
+class _HandOverProtocol(protocol.Protocol):
+    sent = False
+
+    def connectionMade(self):
+        uid = _peerUid(self.transport)
+        if uid is not None and uid != os.getuid():
+            log.msg('Refusing to hand over listeners to process of user %d' % uid)
+            self.transport.loseConnection()
+            return
+        for port in self.factory.ports:
+            self.transport.sendFileDescriptor(port.fileno())
+            self.transport.write(_family(port))
+            # successor shares the socket, closing our descriptor must not
+            # shut it down (private attribute, checked by _family)
+            port._shouldShutdown = False
+        self.sent = True
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self.sent:
+            self.factory.handedOver()
+
+
+class _HandOverFactory(protocol.Factory):
+    protocol = _HandOverProtocol
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.deferred = defer.Deferred()
+        self.listeningPort = None
+
+    def buildProtocol(self, addr):
+        if self.deferred is None:
+            # listeners were handed over already
+            return None
+        return protocol.Factory.buildProtocol(self, addr)
+
+    def handedOver(self):
+        if self.deferred is None:
+            return
+        d, self.deferred = self.deferred, None
+        self.listeningPort.stopListening()
+        d.callback(len(self.ports))
+
+
+def handOverListeners(path, ports, reactor=None):
+    """
+    Listen on UNIX socket C{path} and send listening sockets of C{ports} to
+    the first process of the same user that connects to it (see
+    L{takeOverListeners}). The socket is created with mode 0600, stale
+    socket left by crashed process is removed.
+
+    Returns Deferred that callbacks with number of sockets when they are
+    sent. Ports keep accepting connections until they are stopped, e.g. by
+    C{MsgpackServerFactory.drain}.
+
+    @param path: path of UNIX socket.
+    @type path: C{str}
+    @param ports: listening TCP ports.
+    @type ports: C{list} of C{IListeningPort}
+    @param reactor: provider of C{IReactorUNIX}. Default is reactor.
+    @rtype C{t.i.d.Deferred}
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    ports = list(ports)
+    for port in ports:
+        _family(port)
+    factory = _HandOverFactory(ports)
+    _removeStaleSocket(path)
+    factory.listeningPort = reactor.listenUNIX(path, factory, mode=0o600)
+    return factory.deferred
+
+
+@implementer(IFileDescriptorReceiver)
+class _TakeOverProtocol(protocol.Protocol):
+    def __init__(self):
+        self.descriptors = []
+        self.families = b''
+
+    def fileDescriptorReceived(self, descriptor):
+        self.descriptors.append(descriptor)
+
+    def dataReceived(self, data):
+        self.families += data
+
+    def connectionLost(self, reason):
+        self.factory.received(self.descriptors, self.families)
+
+
+class _TakeOverFactory(protocol.ClientFactory):
+    protocol = _TakeOverProtocol
+
+    def __init__(self, serverFactory, reactor):
+        self.serverFactory = serverFactory
+        self.reactor = reactor
+        self.deferred = defer.Deferred()
+
+    def received(self, descriptors, families):
+        ports = []
+        try:
+            for i, descriptor in enumerate(descriptors):
+                family = _FAMILIES[families[i:i + 1]]
+                ports.append(self.reactor.adoptStreamPort(descriptor, family, self.serverFactory))
+        except Exception:
+            self.deferred.errback()
+        else:
+            self.deferred.callback(ports)
+        finally:
+            for descriptor in descriptors:
+                os.close(descriptor)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.deferred.errback(reason)
+
+
+def takeOverListeners(path, factory, reactor=None):
+    """
+    Connect to UNIX socket C{path} of L{handOverListeners} and listen on
+    the received sockets with C{factory}.
+
+    Returns Deferred that callbacks with list of new listening ports.
+
+    @param path: path of UNIX socket.
+    @type path: C{str}
+    @param factory: factory of server connections.
+    @type factory: C{factory.MsgpackServerFactory}
+    @param reactor: provider of C{IReactorUNIX} and C{IReactorSocket}.
+        Default is reactor.
+    @rtype C{t.i.d.Deferred}
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    takeOver = _TakeOverFactory(factory, reactor)
+    reactor.connectUNIX(path, takeOver)
+    return takeOver.deferred
+
+
+__all__ = ['GOAWAY_METHOD', 'Drain', 'handOverListeners', 'takeOverListeners']
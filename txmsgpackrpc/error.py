@@ -28,3 +28,37 @@ class TimeoutError(MsgpackError):
 
 class SerializationError(MsgpackError):
     pass
+
+
+class RateLimitExceeded(ResponseError):
+    pass
+
+
+# Errors that are sent to remote peer together with their type name, so they
+# can be raised as the same exception on the other side.
+TYPED_ERRORS = dict((cls.__name__, cls) for cls in (RateLimitExceeded,))
+
+
+def packError(exc):
+    """
+    Return error value of response for typed error C{exc} or None if C{exc}
+    is not typed error.
+    """
+    name = type(exc).__name__
+    if TYPED_ERRORS.get(name) is type(exc):
+        return [name, str(exc)]
+    return None
+
+
+def unpackError(error):
+    """
+    Create exception from error value of response.
+    """
+    if isinstance(error, (list, tuple)) and len(error) == 2:
+        name = error[0]
+        if isinstance(name, bytes):
+            name = name.decode('utf-8', 'replace')
+        cls = TYPED_ERRORS.get(name)
+        if cls is not None:
+            return cls(error[1])
+    return ResponseError(error)
@@ -1,48 +1,199 @@
 from __future__ import print_function
 
 import logging
+import random
+
 from twisted.internet import protocol
 from twisted.python   import log
 
+from txmsgpackrpc.drain import GOAWAY_METHOD, Drain
+from txmsgpackrpc.interceptor import buildChain, extendChain
+from txmsgpackrpc.keepalive import PING_METHOD, ping
 from txmsgpackrpc.protocol import MsgpackStreamProtocol
+from txmsgpackrpc.pubsub   import EVENT_METHOD
 from txmsgpackrpc.handler  import SimpleConnectionHandler
 
 
 class MsgpackServerFactory(protocol.Factory):
     protocol = MsgpackStreamProtocol
 
-    def __init__(self, handler):
+    def __init__(self, handler, rateLimiter=None, metrics=None, exposeStats=False, interceptors=None,
+                 profiler=None, slowLog=None, lowMemory=False, broker=None):
+        """
+        @param handler: object of RPC server that will process requests and notifications.
+        @type handler: C{server.MsgpackRPCServer}
+        @param rateLimiter: limiter of requests shared by all connections.
+        @type rateLimiter: C{ratelimit.RateLimiter}
+        @param metrics: collector of metrics shared by all connections.
+        @type metrics: C{metrics.Metrics}
+        @param exposeStats: serve snapshot of C{metrics} by reserved RPC method C{__stats__}. Default is False.
+        @type exposeStats: C{bool}
+        @param interceptors: interceptors of incoming calls, the first one is the outermost.
+        @type interceptors: C{list} or C{interceptor.InterceptorChain}
+        @param profiler: profiler controlled by reserved RPC method C{__profile__}.
+        @type profiler: C{profiler.MethodProfiler}
+        @param slowLog: log of requests that exceed latency threshold.
+        @type slowLog: C{slowlog.SlowRequestLog}
+        @param lowMemory: reduce memory of idle connections, see C{protocol.MsgpackBaseProtocol}.
+            Default is False.
+        @type lowMemory: C{bool}
+        @param broker: topics of publish/subscribe served by reserved RPC methods C{__subscribe__} and
+            C{__unsubscribe__}. Default is None.
+        @type broker: C{pubsub.Broker}
+        """
         self.handler = handler
+        self.rateLimiter = rateLimiter
+        self.metrics = metrics
+        self.exposeStats = exposeStats
+        self.interceptors = buildChain(interceptors)
+        if profiler is not None:
+            self.interceptors = extendChain(self.interceptors, profiler)
+        self.profiler = profiler
+        self.slowLog = slowLog
+        self.lowMemory = lowMemory
+        self.broker = broker
         self.connections = set()
+        self._drain = None
 
     def buildProtocol(self, addr):
-        p = self.protocol(self, sendErrors=True)
+        p = self.protocol(self, sendErrors=True, rateLimiter=self.rateLimiter,
+                          metrics=self.metrics, exposeStats=self.exposeStats,
+                          interceptors=self.interceptors, profiler=self.profiler,
+                          slowLog=self.slowLog, lowMemory=self.lowMemory)
         return p
 
+    @property
+    def draining(self):
+        return self._drain is not None
+
+    def drain(self, timeout=30, ports=(), clock=None):
+        """
+        Shut the server down gracefully: stop listening C{ports}, send
+        notification C{__goaway__} to all connections, close every connection
+        when requests it received are answered and abort connections that
+        don't finish them in C{timeout} seconds.
+
+        Returns Deferred that callbacks when all connections are closed.
+
+        @param timeout: number of seconds connections have to finish their
+            requests. Default is 30.
+        @type timeout: C{int} or C{float}
+        @param ports: listening ports of the factory.
+        @type ports: iterable of C{IListeningPort}
+        @param clock: provider of C{IReactorTime}. Default is reactor.
+        @rtype C{t.i.d.Deferred}
+        """
+        if self._drain is None:
+            self._drain = Drain(self, timeout, clock)
+            self._drain.start(ports)
+        return self._drain.wait()
+
     def addConnection(self, connection):
         self.connections.add(connection)
+        if self._drain is not None:
+            # accepted before listening stopped
+            self._drain.connectionMade(connection)
 
     def delConnection(self, connection):
         self.connections.remove(connection)
+        if self.broker is not None:
+            self.broker.connectionLost(connection)
+        if self._drain is not None:
+            self._drain.connectionLost(connection)
 
     def getRemoteMethod(self, protocol, methodName):
-        return getattr(self.handler, "remote_" + methodName)
+        try:
+            return getattr(self.handler, "remote_" + methodName)
+        except AttributeError:
+            if methodName == PING_METHOD:
+                return ping
+            if self.broker is None:
+                raise
+            return self.broker.remoteMethod(protocol, methodName)
 
 
 class MsgpackClientFactory(protocol.ReconnectingClientFactory):
     maxDelay = 12
     protocol = MsgpackStreamProtocol
+    # cache of TLS session of SSL connections, set by client.connect*
+    tlsSessions = None
+    # minimal number of seconds between reconnects of connections of one pool
+    reconnectStagger = 0.05
 
-    def __init__(self, handler=SimpleConnectionHandler, connectTimeout=None, waitTimeout=None, handlerConfig={}):
+    def __init__(self, handler=SimpleConnectionHandler, connectTimeout=None, waitTimeout=None, handlerConfig={},
+                 metrics=None, interceptors=None, slowLog=None, subscriber=None, rpcHandler=None,
+                 keepaliveInterval=None, keepaliveTimeout=None):
         self.connectTimeout = connectTimeout
         self.waitTimeout = waitTimeout
+        self.metrics = metrics
+        self.interceptors = buildChain(interceptors)
+        self.slowLog = slowLog
+        self.subscriber = subscriber
+        self.rpcHandler = rpcHandler
+        self.keepaliveInterval = keepaliveInterval
+        self.keepaliveTimeout = keepaliveTimeout
         self.handler = handler(self, **handlerConfig)
+        self._retryCalls = set()
+        self._nextReconnect = 0
+        # connections that received __goaway__ and wait for their requests
+        self._leaving = set()
+        self._moved = 0
 
     def buildProtocol(self, addr):
         self.resetDelay()
-        p = self.protocol(self, timeout=self.waitTimeout)
+        p = self.protocol(self, timeout=self.waitTimeout, metrics=self.metrics,
+                          interceptors=self.interceptors, slowLog=self.slowLog,
+                          keepaliveInterval=self.keepaliveInterval, keepaliveTimeout=self.keepaliveTimeout,
+                          clock=self.clock)
         return p
 
+    def retry(self, connector=None):
+        """
+        Reconnect C{connector} after random delay between zero and current
+        backoff delay ("full jitter"), so clients of restarted server don't
+        reconnect at the same time. All connections of the pool share one
+        factory, their reconnects are at least C{reconnectStagger} seconds
+        apart.
+        """
+        if not self.continueTrying:
+            return
+
+        if connector is None:
+            if self.connector is None:
+                raise ValueError("no connector to retry")
+            connector = self.connector
+
+        self.retries += 1
+        if self.maxRetries is not None and (self.retries > self.maxRetries):
+            return
+
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        now = self.clock.seconds()
+        ceiling = self.delay
+        if self._moved:
+            # server went away gracefully, its successor accepts already
+            self._moved -= 1
+            ceiling = self.reconnectStagger
+        delay = max(random.uniform(0, ceiling), self._nextReconnect - now)
+        self._nextReconnect = now + delay + self.reconnectStagger
+
+        def reconnector():
+            self._retryCalls.discard(call)
+            connector.connect()
+
+        call = self._callID = self.clock.callLater(delay, reconnector)
+        self._retryCalls.add(call)
+
+        self.delay = min(self.delay * self.factor, self.maxDelay)
+
+    def stopTrying(self):
+        while self._retryCalls:
+            self._retryCalls.pop().cancel()
+        self._callID = None
+        protocol.ReconnectingClientFactory.stopTrying(self)
+
     def clientConnectionFailed(self, connector, reason):
         # log.msg("clientConnectionFailed", logLevel=logging.DEBUG)
         connector.timeout = self.connectTimeout
@@ -62,13 +213,46 @@ class MsgpackClientFactory(protocol.ReconnectingClientFactory):
             self.handler.callbackWaitingForConnection(lambda d: d.errback(reason))
 
     def addConnection(self, connection):
+        # subscriptions are renewed before handler lets users send requests
+        if self.subscriber is not None:
+            self.subscriber.connectionMade(connection)
         self.handler.addConnection(connection)
 
     def delConnection(self, connection):
+        if connection in self._leaving:
+            # handler forgot it when server asked to go away
+            self._leaving.discard(connection)
+            self._moved += 1
+            return
+        self._forgetConnection(connection)
+
+    def _forgetConnection(self, connection):
         self.handler.delConnection(connection)
+        if self.subscriber is not None:
+            self.subscriber.connectionLost(connection)
+
+    def goaway(self, protocol):
+        """
+        Server of C{protocol} is shutting down. No more requests are sent
+        into the connection, it is closed when its requests are answered and
+        reconnected without backoff.
+        """
+        if protocol in self._leaving or not protocol.connected:
+            return
+        self._leaving.add(protocol)
+        self._forgetConnection(protocol)
+        protocol.waitForResponses().addCallback(lambda _: protocol.closeConnection())
 
     def getRemoteMethod(self, protocol, methodName):
-        raise NotImplementedError('Cannot call RPC method on client')
+        if self.subscriber is not None and methodName == EVENT_METHOD:
+            return self.subscriber.eventReceived
+        if methodName == PING_METHOD:
+            return ping
+        if methodName == GOAWAY_METHOD:
+            return lambda: self.goaway(protocol)
+        if self.rpcHandler is None:
+            raise NotImplementedError('Cannot call RPC method on client without rpcHandler')
+        return getattr(self.rpcHandler, "remote_" + methodName)
 
 
 __all__ = ['MsgpackServerFactory', 'MsgpackClientFactory']
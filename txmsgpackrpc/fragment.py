@@ -0,0 +1,119 @@
+import struct
+
+from txmsgpackrpc.ratelimit import ExpiringTable
+
+
+# 0xc1 is never used by msgpack, so datagram starting with it can't be
+# mistaken for a message
+FRAGMENT_MARKER = 0xc1
+
+# marker, message id, fragment index, number of fragments
+FRAGMENT_HEADER = struct.Struct('>BIHH')
+
+MAX_FRAGMENTS = 0xFFFF
+
+
+def fragment(data, messageId, mtu):
+    """
+    Split serialized message to datagrams of at most C{mtu} bytes including
+    fragment header.
+
+    @param data: serialized message.
+    @type data: C{bytes}
+    @param messageId: identifier of message unique for the sender.
+    @type messageId: C{int}
+    @param mtu: maximum size of datagram in bytes.
+    @type mtu: C{int}
+    @return list of datagrams
+    @rtype C{list}
+    """
+    chunkSize = mtu - FRAGMENT_HEADER.size
+    if chunkSize <= 0:
+        raise ValueError('MTU %d is lower than size of fragment header' % mtu)
+    count = (len(data) + chunkSize - 1) // chunkSize
+    if count > MAX_FRAGMENTS:
+        raise ValueError('Message of %d bytes needs more than %d fragments' % (len(data), MAX_FRAGMENTS))
+    pack = FRAGMENT_HEADER.pack
+    return [pack(FRAGMENT_MARKER, messageId, index, count) + data[index * chunkSize:(index + 1) * chunkSize]
+            for index in range(count)]
+
+
+def isFragment(datagram):
+    return datagram[:1] == b'\xc1'
+
+
+class Reassembler(object):
+    """
+    Buffer of fragments of incomplete messages. Number of incomplete messages
+    is limited by C{maxsize}, messages whose fragments don't arrive in
+    C{timeout} seconds are dropped, and least recently updated messages are
+    evicted when the buffer is full.
+    """
+    def __init__(self, maxsize=1000, timeout=5, maxMessageSize=16 * 1024 * 1024, clock=None):
+        """
+        @param maxsize: maximum number of incomplete messages. Default is 1000.
+        @type maxsize: C{int}
+        @param timeout: number of seconds to wait for missing fragments.
+            Default is 5.
+        @type timeout: C{int} or C{float}
+        @param maxMessageSize: maximum size of reassembled message in bytes,
+            fragments of larger messages are dropped. Default is 16 MB.
+        @type maxMessageSize: C{int}
+        @param clock: provider of C{IReactorTime}. Default is reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.maxMessageSize = maxMessageSize
+        self.reassembled = 0
+        self.invalid = 0
+        self._table = ExpiringTable(maxsize, timeout)
+
+    def __len__(self):
+        return len(self._table)
+
+    def feed(self, peer, datagram):
+        """
+        Store fragment received from C{peer}. Returns reassembled message when
+        its last missing fragment is received, otherwise None.
+        """
+        try:
+            _, messageId, index, count = FRAGMENT_HEADER.unpack_from(datagram)
+        except struct.error:
+            self.invalid += 1
+            return None
+        chunk = datagram[FRAGMENT_HEADER.size:]
+        if index >= count:
+            self.invalid += 1
+            return None
+
+        key = (peer, messageId)
+        now = self.clock.seconds()
+        entry = self._table.get(key, now)
+        if entry is None:
+            if count == 1:
+                return chunk
+            entry = [count, {}, 0]
+            self._table.set(key, entry, now)
+        elif entry[0] != count:
+            self.invalid += 1
+            return None
+
+        chunks = entry[1]
+        if index not in chunks:
+            chunks[index] = chunk
+            entry[2] += len(chunk)
+            if entry[2] > self.maxMessageSize:
+                self._table.pop(key)
+                self.invalid += 1
+                return None
+
+        if len(chunks) < count:
+            return None
+
+        self._table.pop(key)
+        self.reassembled += 1
+        return b''.join(chunks[i] for i in range(count))
+
+
+__all__ = ['fragment', 'isFragment', 'Reassembler', 'FRAGMENT_MARKER']
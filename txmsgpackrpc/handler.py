@@ -1,25 +1,199 @@
+from collections import deque
+
 from twisted.internet import defer
 from twisted.python import log
 
 from txmsgpackrpc.error import ConnectionError
 
 
+class MethodStub(object):
+    """
+    Callable stub of one RPC method returned by C{method} of connection
+    handlers and datagram protocols. Name of the method is serialized only
+    once for each packer encoding, so requests pack only msgid and params.
+    The stub remembers connection of the last request and reuses it while it
+    is the current connection of the handler, i.e. until it is lost or its
+    server asks clients to go away. Connection handlers that balance requests
+    among more connections check connection out for every call.
+
+    Calling the stub is equivalent to C{handler.createRequest(method, *params)}.
+    """
+    __slots__ = ('handler', 'method', 'connection', 'encoded')
+
+    def __init__(self, handler, method):
+        self.handler = handler
+        self.method = method
+        self.connection = None
+        self.encoded = {}
+
+    def __call__(self, *params):
+        connection = self.connection
+        if connection is not None and connection is self.handler.connection and connection.connected:
+            try:
+                return connection.createPreparedRequest(self, params)
+            except Exception:
+                return defer.fail()
+        return self.handler.callStub(self, params)
+
+    def __repr__(self):
+        return '<MethodStub %s of %r>' % (self.method, self.handler)
+
+
+class RequestQueue(object):
+    """
+    FIFO queue of requests waiting for connection. Requests that would
+    exceed C{maxSize} fail immediately, requests that wait longer than
+    C{timeout} fail when it expires, both with C{ConnectionError}.
+
+    All requests wait for the same time, so they expire in order of
+    arrival and one timer for the oldest request is enough. Cancelled
+    requests leave the queue.
+
+    @ivar rejected: number of requests that failed because queue was full.
+    @ivar expired: number of requests that failed because of timeout.
+    """
+    def __init__(self, maxSize=None, timeout=None, metrics=None, clock=None):
+        """
+        @param maxSize: maximum number of waiting requests. Default is None,
+            i.e. unbounded.
+        @type maxSize: C{int}
+        @param timeout: maximum number of seconds a request waits.
+            Default is None, i.e. until connection is made or all
+            connection attempts fail.
+        @type timeout: C{int} or C{float}
+        @param metrics: collector of metrics whose C{queued} gauge is
+            updated. Default is None.
+        @type metrics: C{metrics.Metrics}
+        @param clock: provider of C{IReactorTime}. Default is reactor.
+        """
+        self.maxSize = maxSize
+        self.timeout = timeout
+        self.metrics = metrics
+        self.clock = clock
+        self.rejected = 0
+        self.expired = 0
+        self._waiting = deque()
+        self._expireCall = None
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def wait(self):
+        """
+        Return Deferred that fires when the request is popped from queue,
+        or fails with C{ConnectionError} if it can't wait.
+        """
+        if self.maxSize is not None and len(self._waiting) >= self.maxSize:
+            self.rejected += 1
+            if self.metrics is not None:
+                self.metrics.queueRejected += 1
+            return defer.fail(ConnectionError("Too many requests waiting for connection"))
+
+        d = defer.Deferred(self._cancel)
+        deadline = None
+        if self.timeout is not None:
+            if self.clock is None:
+                from twisted.internet import reactor
+                self.clock = reactor
+            deadline = self.clock.seconds() + self.timeout
+            if self._expireCall is None:
+                self._expireCall = self.clock.callLater(self.timeout, self._expire)
+        self._waiting.append((d, deadline))
+        if self.metrics is not None:
+            self.metrics.queued += 1
+        return d
+
+    def popleft(self):
+        """
+        Remove the oldest waiting request from queue and return its
+        Deferred, or None if no request waits.
+        """
+        waiting = self._waiting
+        d = None
+        while waiting:
+            d, _ = waiting.popleft()
+            if self.metrics is not None:
+                self.metrics.queued -= 1
+            if not d.called:
+                break
+            # fired by its owner while it was waiting
+            d = None
+        if not waiting:
+            self._cancelExpire()
+        return d
+
+    def _cancel(self, d):
+        waiting = self._waiting
+        for i, (queued, _) in enumerate(waiting):
+            if queued is d:
+                del waiting[i]
+                if self.metrics is not None:
+                    self.metrics.queued -= 1
+                break
+        if not waiting:
+            self._cancelExpire()
+
+    def _cancelExpire(self):
+        if self._expireCall is not None:
+            self._expireCall.cancel()
+            self._expireCall = None
+
+    def _expire(self):
+        self._expireCall = None
+        waiting = self._waiting
+        now = self.clock.seconds()
+        while waiting and waiting[0][1] <= now:
+            d, _ = waiting.popleft()
+            if self.metrics is not None:
+                self.metrics.queued -= 1
+            if d.called:
+                continue
+            self.expired += 1
+            if self.metrics is not None:
+                self.metrics.queueExpired += 1
+            d.errback(ConnectionError("Timeout while waiting for connection"))
+        if waiting and self._expireCall is None:
+            self._expireCall = self.clock.callLater(waiting[0][1] - now, self._expire)
+
+
 class SimpleConnectionHandler(object):
     """
     Connection handler that handles connections established by reconnecting
     factory. If connection is not established user requests and notifications
     wait until new connection is made or error is detected.
     """
-    def __init__(self, factory):
+    def __init__(self, factory, maxQueued=None, queueTimeout=None):
+        """
+        @param factory: reconnecting factory of the connection.
+        @type factory: C{factory.MsgpackClientFactory}
+        @param maxQueued: maximum number of requests waiting for connection,
+            the following ones fail with C{ConnectionError}. Default is None,
+            i.e. unbounded.
+        @type maxQueued: C{int}
+        @param queueTimeout: maximum number of seconds a request waits for
+            connection before it fails with C{ConnectionError}. Default is
+            None, i.e. until connection is made or all attempts fail.
+        @type queueTimeout: C{int} or C{float}
+        """
         self.factory = factory
         self.connection = None
         self._waitingForConnection = set()
+        self._waitingRequests = RequestQueue(maxQueued, queueTimeout, factory.metrics, factory.clock)
+
+    @property
+    def queued(self):
+        """
+        Number of requests waiting for connection.
+        """
+        return len(self._waitingRequests)
 
     def getConnection(self):
         if self.connection and self.connection.connected:
             return defer.succeed(self.connection)
         else:
-            d = self.waitForConnection()
+            if not self.factory.continueTrying:
+                raise ConnectionError("Not connected")
+            d = self._waitingRequests.wait()
             d.addCallback(lambda handler: handler.getConnection())
             return d
 
@@ -46,6 +220,26 @@ class SimpleConnectionHandler(object):
         d.addCallback(lambda conn: conn.createRequest(method, params))
         return d
 
+    def method(self, method):
+        """
+        Return callable L{MethodStub} of RPC method C{method}. Calls of the
+        stub are equivalent to L{createRequest}, but they don't serialize
+        method name again and reuse established connection.
+
+        @param method: RPC method name
+        @type method: C{str}
+        @rtype C{MethodStub}
+        """
+        return MethodStub(self, method)
+
+    def callStub(self, stub, params):
+        def callback(conn):
+            stub.connection = conn
+            return conn.createPreparedRequest(stub, params)
+        d = self.getConnection()
+        d.addCallback(callback)
+        return d
+
     def createNotification(self, method, params):
         """
         Create new RPC notification. If connection is not established, request
@@ -73,7 +267,8 @@ class SimpleConnectionHandler(object):
         self.callbackWaitingForConnection(lambda d: d.callback(self))
 
     def delConnection(self, connection):
-        self.connection = None
+        if self.connection is connection:
+            self.connection = None
 
     def waitForConnection(self):
         if not self.factory.continueTrying:
@@ -90,6 +285,11 @@ class SimpleConnectionHandler(object):
         while self._waitingForConnection:
             d = self._waitingForConnection.pop()
             func(d)
+        waiting = self._waitingRequests
+        while waiting:
+            d = waiting.popleft()
+            if d is not None:
+                func(d)
 
     def disconnect(self):
         self.factory.continueTrying = 0
@@ -106,50 +306,146 @@ class PooledConnectionHandler(object):
     Connection handler that handles connections in pool that are established by
     reconnecting factory. If connection is not established user requests and
     notifications wait until new connection is made or error is detected.
+    Requests waiting for empty pool are spread across connections as they
+    come back, every returned connection releases its share of them.
+
+    Every connection carries at most C{maxConcurrentPerConnection} requests
+    at once. Requests are checked out to connections in round robin order,
+    when all connections are saturated they wait in FIFO order.
     """
-    def __init__(self, factory, poolsize=10, isolated=False):
+    # number of seconds after which requests held back for connections that
+    # didn't come back are released to connections of the pool
+    spreadTimeout = 1
+
+    def __init__(self, factory, poolsize=10, isolated=False, maxQueued=None, queueTimeout=None,
+                 maxConcurrentPerConnection=None):
+        """
+        @param factory: reconnecting factory of connections of the pool.
+        @type factory: C{factory.MsgpackClientFactory}
+        @param poolsize: number of connections in the pool. Default is 10.
+        @type poolsize: C{int}
+        @param isolated: when True the pool allows only one request per
+            connection. Default is False.
+        @type isolated: C{bool}
+        @param maxQueued: maximum number of requests waiting for connection
+            while the pool is empty or saturated, the following ones fail with
+            C{ConnectionError}. Default is None, i.e. unbounded.
+        @type maxQueued: C{int}
+        @param queueTimeout: maximum number of seconds a request waits for
+            connection before it fails with C{ConnectionError}. Default is
+            None, i.e. until connection is made or all attempts fail.
+        @type queueTimeout: C{int} or C{float}
+        @param maxConcurrentPerConnection: maximum number of requests in
+            progress on one connection. Default is None, i.e. unlimited, or
+            1 if C{isolated} is True.
+        @type maxConcurrentPerConnection: C{int}
+        """
+        if isolated and maxConcurrentPerConnection is None:
+            maxConcurrentPerConnection = 1
         self.factory = factory
         self.poolsize = poolsize
         self.isolated = isolated
+        self.maxConcurrentPerConnection = maxConcurrentPerConnection
 
         self.size = 0
         self.pool = []
-        self.connectionQueue = defer.DeferredQueue()
+        # number of requests in progress on each connection of the pool
+        self.active = {}
 
+        self._next = 0
         self._waitingForConnection = set()
         self._waitingForEmptyPool = set()
+        self._waitingRequests = RequestQueue(maxQueued, queueTimeout, factory.metrics, factory.clock)
+        self._spreadCall = None
+        # number of requests at the head of queue held back for missing
+        # connections of the pool
+        self._heldBack = 0
+
+    @property
+    def queued(self):
+        """
+        Number of requests waiting for connection while the pool is empty
+        or saturated.
+        """
+        return len(self._waitingRequests)
+
+    def _available(self):
+        pool = self.pool
+        active = self.active
+        limit = self.maxConcurrentPerConnection
+        for _ in range(len(pool)):
+            self._next = (self._next + 1) % len(pool)
+            conn = pool[self._next]
+            if conn.connected and (limit is None or active[conn] < limit):
+                return conn
+        return None
+
+    def _checkout(self):
+        # requests that wait already go first, except the ones held back for
+        # connections that didn't come back yet
+        if len(self._waitingRequests) > self._heldBack:
+            return None
+        conn = self._available()
+        if conn is not None:
+            self.active[conn] += 1
+        return conn
 
-    @defer.inlineCallbacks
     def getConnection(self):
+        """
+        Check out connection of the pool that is under its limit of
+        concurrent requests. Returns Deferred that callbacks with the
+        connection when one is available. Return the connection by
+        L{releaseConnection} when its request is finished.
+        """
         if not self.factory.continueTrying and not self.size:
-            raise ConnectionError("Not connected")
+            return defer.fail(ConnectionError("Not connected"))
+        conn = self._checkout()
+        if conn is not None:
+            return defer.succeed(conn)
+        return self._waitingRequests.wait()
 
-        while True:
-            conn = yield self.connectionQueue.get()
-            if not conn.connected:
-                log.msg("Discarding dead connection.")
-            else:
-                if not self.isolated:
-                    self.connectionQueue.put(conn)
-                defer.returnValue(conn)
+    def releaseConnection(self, connection):
+        """
+        Return connection checked out by L{getConnection}. The first waiting
+        request takes it, if there is any.
+        """
+        active = self.active
+        if connection not in active:
+            # connection was lost and removed from the pool
+            return
+        active[connection] -= 1
+        if connection.connected:
+            d = self._popWaiting()
+            if d is not None:
+                active[connection] += 1
+                d.callback(connection)
+
+    def _release(self, result, connection):
+        self.releaseConnection(connection)
+        return result
+
+    def _sendOn(self, connection, msgType, method, params):
+        try:
+            d = getattr(connection, msgType)(method, params)
+        except:
+            self.releaseConnection(connection)
+            raise
+        if d is None:
+            # notifications don't wait for anything
+            self.releaseConnection(connection)
+            return None
+        d.addBoth(self._release, connection)
+        return d
 
     def _send(self, msgType, method, params):
-        d = self.getConnection()
-        def callback(connection):
+        conn = self._checkout()
+        if conn is not None:
             try:
-                func = getattr(connection, msgType)
-                d = func(method, params)
-            except:
-                self.connectionQueue.put(connection)
-                raise
-
-            def put_back(reply):
-                self.connectionQueue.put(connection)
-                return reply
-
-            d.addBoth(put_back)
-            return d
-        d.addCallback(callback)
+                return self._sendOn(conn, msgType, method, params)
+            except Exception:
+                return defer.fail()
+        d = self.getConnection()
+        d.addCallback(self._sendOn, msgType, method, params)
         return d
 
     def createRequest(self, method, *params):
@@ -174,6 +470,21 @@ class PooledConnectionHandler(object):
         """
         return self._send('createRequest', method, params)
 
+    def method(self, method):
+        """
+        Return callable L{MethodStub} of RPC method C{method}. Calls of the
+        stub are equivalent to L{createRequest}, but they don't serialize
+        method name again. Every call checks out connection from the pool.
+
+        @param method: RPC method name
+        @type method: C{str}
+        @rtype C{MethodStub}
+        """
+        return MethodStub(self, method)
+
+    def callStub(self, stub, params):
+        return self._send('createPreparedRequest', stub, params)
+
     def createNotification(self, method, params):
         """
         Create new RPC notification. If there is no established connection in
@@ -195,11 +506,63 @@ class PooledConnectionHandler(object):
         return self._send('createNotification', method, params)
 
     def addConnection(self, connection):
-        self.connectionQueue.put(connection)
         self.pool.append(connection)
         self.size = len(self.pool)
+        self.active[connection] = 0
 
-        self.callbackWaitingForConnection(lambda d: d.callback(self))
+        while self._waitingForConnection:
+            d = self._waitingForConnection.pop()
+            d.callback(self)
+        self._spreadWaitingRequests(connection)
+
+    def _popWaiting(self):
+        d = self._waitingRequests.popleft()
+        if self._heldBack:
+            self._heldBack -= 1
+        return d
+
+    def _spreadWaitingRequests(self, connection):
+        waiting = self._waitingRequests
+        self._heldBack = 0
+        # share of the connection and the connections that are still missing
+        missing = max(0, self.poolsize - self.size)
+        share = -(-len(waiting) // (missing + 1))
+        limit = self.maxConcurrentPerConnection
+        if limit is not None:
+            share = min(share, limit - self.active[connection])
+        for _ in range(share):
+            d = waiting.popleft()
+            if d is None:
+                break
+            self.active[connection] += 1
+            d.callback(connection)
+
+        # the rest is held back for missing connections as far as they can
+        # carry it, new requests don't wait behind it
+        self._heldBack = len(waiting) if limit is None else min(len(waiting), missing * limit)
+        if not self._heldBack:
+            if self._spreadCall is not None:
+                self._spreadCall.cancel()
+                self._spreadCall = None
+        elif self._spreadCall is None:
+            clock = self.factory.clock
+            if clock is None:
+                from twisted.internet import reactor as clock
+            self._spreadCall = clock.callLater(self.spreadTimeout, self._releaseWaitingRequests)
+
+    def _releaseWaitingRequests(self):
+        self._spreadCall = None
+        self._heldBack = 0
+        waiting = self._waitingRequests
+        while waiting:
+            conn = self._available()
+            if conn is None:
+                break
+            d = waiting.popleft()
+            if d is None:
+                break
+            self.active[conn] += 1
+            d.callback(conn)
 
     def delConnection(self, connection):
         try:
@@ -208,6 +571,7 @@ class PooledConnectionHandler(object):
             log.err("Cannot remove connection from pool: %s" % str(e))
 
         self.size = len(self.pool)
+        self.active.pop(connection, None)
 
         if not self.size and self._waitingForEmptyPool:
             while self._waitingForEmptyPool:
@@ -240,6 +604,15 @@ class PooledConnectionHandler(object):
         while self._waitingForConnection:
             d = self._waitingForConnection.pop()
             func(d)
+        if self._spreadCall is not None:
+            self._spreadCall.cancel()
+            self._spreadCall = None
+        self._heldBack = 0
+        waiting = self._waitingRequests
+        while waiting:
+            d = waiting.popleft()
+            if d is not None:
+                func(d)
 
     def disconnect(self):
         self.factory.continueTrying = 0
@@ -254,4 +627,4 @@ class PooledConnectionHandler(object):
         return self.waitForEmptyPool()
 
 
-__all__ = ['SimpleConnectionHandler', 'PooledConnectionHandler']
+__all__ = ['SimpleConnectionHandler', 'PooledConnectionHandler', 'MethodStub', 'RequestQueue']
@@ -0,0 +1,133 @@
+from functools import partial
+
+from twisted.internet import defer
+
+
+class Call(object):
+    """
+    RPC call passed through chain of interceptors. Interceptors may replace
+    C{method} and C{params} before they proceed with the call.
+
+    @ivar role: C{'server'} for incoming calls, C{'client'} for outgoing ones.
+    @ivar method: RPC method name.
+    @ivar params: RPC method parameters.
+    @ivar context: C{protocol.Context} of datagram protocols, None for streams.
+    @ivar msgid: message ID of incoming request, None for notifications and
+        outgoing calls.
+    @ivar notification: True if call is notification that expects no result.
+    @ivar protocol: protocol that handles the call.
+    """
+    __slots__ = ('role', 'method', 'params', 'context', 'msgid', 'notification', 'protocol')
+
+    def __init__(self, role, method, params, context=None, msgid=None, notification=False, protocol=None):
+        self.role = role
+        self.method = method
+        self.params = params
+        self.context = context
+        self.msgid = msgid
+        self.notification = notification
+        self.protocol = protocol
+
+    def __repr__(self):
+        return '<Call %s %s%r>' % (self.role, self.method, tuple(self.params))
+
+
+class Interceptor(object):
+    """
+    Base class of interceptors. Subclasses override L{intercept}.
+    """
+    def intercept(self, call, proceed):
+        """
+        Intercept RPC call. Implementation must call C{proceed(call)} to pass
+        the call to next interceptor, or return its own result instead. The
+        C{proceed} returns Deferred of the outcome of the call, so interceptor
+        can observe or modify the result by adding callbacks.
+
+        @param call: intercepted call.
+        @type call: L{Call}
+        @param proceed: continuation of the chain.
+        @type proceed: C{callable}
+        @return result of the call or Deferred.
+        """
+        return proceed(call)
+
+
+class InterceptorChain(object):
+    """
+    Ordered chain of interceptors. The first interceptor is the outermost
+    one, i.e. it sees the call first and its outcome last.
+    """
+    def __init__(self, interceptors=()):
+        """
+        @param interceptors: interceptors in order of invocation.
+        @type interceptors: C{list} of L{Interceptor} or callables
+            accepting arguments C{(call, proceed)}.
+        """
+        self.interceptors = []
+        for interceptor in interceptors:
+            self.append(interceptor)
+
+    def __len__(self):
+        return len(self.interceptors)
+
+    def __iter__(self):
+        return iter(self.interceptors)
+
+    def __contains__(self, interceptor):
+        if isinstance(interceptor, Interceptor):
+            interceptor = interceptor.intercept
+        return interceptor in self.interceptors
+
+    def append(self, interceptor):
+        self.insert(len(self.interceptors), interceptor)
+
+    def insert(self, index, interceptor):
+        if isinstance(interceptor, Interceptor):
+            interceptor = interceptor.intercept
+        self.interceptors.insert(index, interceptor)
+
+    def execute(self, call, terminal):
+        """
+        Pass the call through all interceptors and then to C{terminal}.
+
+        @param call: the call.
+        @type call: L{Call}
+        @param terminal: function that performs the call.
+        @type terminal: C{callable}
+        @return Deferred that fires with outcome of the call.
+        @rtype C{t.i.d.Deferred}
+        """
+        return self._proceed(terminal, 0, call)
+
+    def _proceed(self, terminal, index, call):
+        if index == len(self.interceptors):
+            return defer.maybeDeferred(terminal, call)
+        proceed = partial(self._proceed, terminal, index + 1)
+        return defer.maybeDeferred(self.interceptors[index], call, proceed)
+
+
+def buildChain(interceptors):
+    """
+    Return L{InterceptorChain} for C{interceptors} or None if there is none,
+    so that protocols pay nothing without interceptors. Chain objects are
+    returned as they are, so they can be shared and modified later.
+    """
+    if isinstance(interceptors, InterceptorChain):
+        return interceptors
+    if not interceptors:
+        return None
+    return InterceptorChain(interceptors)
+
+
+def extendChain(chain, interceptor):
+    """
+    Return chain with C{interceptor} appended as the innermost one. Returns
+    C{chain} itself if it already contains the interceptor, so chain built
+    once by a factory is shared by all its protocols.
+    """
+    if chain is not None and interceptor in chain:
+        return chain
+    return InterceptorChain(list(chain or ()) + [interceptor])
+
+
+__all__ = ['Call', 'Interceptor', 'InterceptorChain']
@@ -0,0 +1,138 @@
+"""
+Keepalive probes of stream connections.
+
+Client protocol with C{keepaliveInterval} periodically calls reserved RPC
+method C{__ping__} of its peer. Connection whose peer doesn't answer within
+C{keepaliveTimeout} is aborted, so reconnecting factory replaces it before
+requests are sent into it. Round-trip times of answered probes are smoothed
+to exponentially weighted moving average available as C{protocol.rtt}.
+
+Probes are not recorded by metrics nor slow log of the client, and their
+answers don't postpone idle timeout (C{waitTimeout}) of the connection.
+"""
+from twisted.python import log
+
+from txmsgpackrpc.core import MSGTYPE_RESPONSE
+
+
+PING_METHOD = '__ping__'
+
+
+def ping():
+    """
+    Reserved RPC method answering keepalive probes.
+    """
+    return None
+
+
+class KeepAlive(object):
+    """
+    Keepalive probe of one connection.
+
+    @ivar rtt: smoothed round-trip time in seconds, None until the first
+        probe is answered.
+    @ivar lastRtt: round-trip time of the last answered probe in seconds.
+    @ivar sent: number of sent probes.
+    @ivar expired: number of probes that were not answered in time.
+    """
+    def __init__(self, protocol, interval, timeout=None, alpha=0.125, clock=None):
+        """
+        @param protocol: probed connection.
+        @type protocol: C{protocol.MsgpackStreamProtocol}
+        @param interval: number of seconds between answer of probe and the
+            next probe.
+        @type interval: C{int} or C{float}
+        @param timeout: number of seconds to wait for answer before the
+            connection is aborted. Default is C{interval}.
+        @type timeout: C{int} or C{float}
+        @param alpha: weight of the newest sample in moving average of
+            round-trip time. Default is 0.125.
+        @type alpha: C{float}
+        @param clock: provider of C{IReactorTime}. Default is reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.protocol = protocol
+        self.interval = interval
+        self.timeout = timeout if timeout is not None else interval
+        self.alpha = alpha
+        self.clock = clock
+        self.rtt = None
+        self.lastRtt = None
+        self.sent = 0
+        self.expired = 0
+        self._call = None
+        self._timeoutCall = None
+        self._msgid = None
+
+    def start(self):
+        if self._call is None and self._timeoutCall is None:
+            self._call = self.clock.callLater(self.interval, self.probe)
+
+    def stop(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if self._timeoutCall is not None:
+            self._timeoutCall.cancel()
+            self._timeoutCall = None
+
+    def probe(self):
+        self._call = None
+        if not self.protocol.isConnected():
+            return
+        started = self.clock.seconds()
+        msgid = self.protocol.getNextMsgid()
+        try:
+            d = self.protocol.sendProbe(msgid, PING_METHOD, ())
+        except Exception:
+            log.err(None, 'Cannot send keepalive probe')
+            return
+        self._msgid = msgid
+        self.sent += 1
+        self._timeoutCall = self.clock.callLater(self.timeout, self.timedOut)
+        d.addCallbacks(self.answered, self.failed, callbackArgs=(started,))
+
+    def isAnswer(self, message):
+        """
+        Return True if C{message} is response to the pending probe.
+        """
+        return self._msgid is not None and message[0] == MSGTYPE_RESPONSE and message[1] == self._msgid
+
+    def answered(self, result, started):
+        self._msgid = None
+        if self._timeoutCall is None:
+            # connection was aborted already
+            return
+        self._timeoutCall.cancel()
+        self._timeoutCall = None
+
+        sample = self.clock.seconds() - started
+        self.lastRtt = sample
+        if self.rtt is None:
+            self.rtt = sample
+        else:
+            self.rtt += self.alpha * (sample - self.rtt)
+        self._call = self.clock.callLater(self.interval, self.probe)
+
+    def failed(self, f):
+        self._msgid = None
+        # connection is lost or the peer doesn't know the method, the former
+        # stops probes, the latter is still an answer
+        if self.protocol.isConnected() and self._timeoutCall is not None:
+            self._timeoutCall.cancel()
+            self._timeoutCall = None
+            self._call = self.clock.callLater(self.interval, self.probe)
+
+    def timedOut(self):
+        self._timeoutCall = None
+        self.expired += 1
+        log.msg('Keepalive probe was not answered in %s seconds, aborting connection' % self.timeout)
+        transport = self.protocol.transport
+        if hasattr(transport, 'abortConnection'):
+            transport.abortConnection()
+        else:
+            transport.loseConnection()
+
+
+__all__ = ['KeepAlive', 'PING_METHOD', 'ping']
@@ -0,0 +1,445 @@
+"""
+Open-loop load generator of msgpack-rpc servers.
+
+Requests are sent at fixed rate regardless of responses, and latency of each
+request is measured from the time it was intended to be sent, not from the
+time it was actually sent. Closed-loop clients wait for responses before
+sending next requests, so they slow down together with the server and don't
+record the requests they failed to send (coordinated omission), which hides
+tail latency of overloaded servers.
+
+Rate can be ramped up in steps to find the saturation knee, the highest rate
+server sustains without falling behind or exceeding latency limit::
+
+    % python -m txmsgpackrpc.loadgen 127.0.0.1 8000 echo '["hello"]' --rate 1000 --duration 30
+    % python -m txmsgpackrpc.loadgen 127.0.0.1 8000 echo '["hello"]' --ramp 500:10000:500 --max-p99 50
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+from twisted.internet import defer
+
+from txmsgpackrpc.metrics import Histogram
+
+
+class LoadGenerator(object):
+    """
+    Sends requests of one method at fixed rate and records their latencies
+    in microseconds to HDR histograms.
+    """
+    def __init__(self, conn, method, params=(), rate=1000, duration=10, maxOutstanding=None,
+                 drainTimeout=10, clock=None):
+        """
+        @param conn: connection handler or protocol with C{createRequest}
+            method, e.g. result of C{client.connect_pool} or
+            C{client.connect_UDP}.
+        @param method: name of called method.
+        @type method: C{str}
+        @param params: parameters of called method.
+        @type params: C{tuple} or C{list}
+        @param rate: number of requests sent per second.
+        @type rate: C{float}
+        @param duration: number of seconds requests are sent.
+        @type duration: C{float}
+        @param maxOutstanding: maximum number of requests waiting for
+            response. Requests that can't be sent on time are delayed, but
+            their latency is still measured from intended send time. Default
+            is None, i.e. no limit.
+        @type maxOutstanding: C{int}
+        @param drainTimeout: number of seconds to wait for outstanding
+            responses after the last request is sent. Requests without
+            response are counted as timeouts. Default is 10 seconds.
+        @type drainTimeout: C{float}
+        @param clock: provider of C{IReactorTime}. Default is reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.conn = conn
+        self.method = method
+        self.params = params
+        self.rate = float(rate)
+        self.duration = duration
+        self.maxOutstanding = maxOutstanding
+        self.drainTimeout = drainTimeout
+        self.clock = clock
+
+        self.total = int(round(self.rate * duration))
+        self.latency = Histogram()
+        self.serviceLatency = Histogram()
+        self.sent = 0
+        self.completed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.outstanding = 0
+        self.maxLag = 0.0
+
+        self._start = None
+        self._finished = None
+        self._pending = {}
+        self._deferred = None
+        self._delayedSend = None
+        self._delayedDrain = None
+        self._sending = False
+
+    def run(self):
+        """
+        Start sending requests. Returns C{t.i.d.Deferred} that callbacks with
+        result dictionary (see L{result}) after all requests are completed or
+        drain timeout expires.
+        """
+        if self._deferred is not None:
+            raise RuntimeError('Load generator is already running')
+        self._deferred = defer.Deferred()
+        self._start = self.clock.seconds()
+        self._send()
+        return self._deferred
+
+    def intendedTime(self, index):
+        return self._start + index / self.rate
+
+    def _send(self):
+        self._delayedSend = None
+        now = self.clock.seconds()
+        due = min(self.total, int((now - self._start) * self.rate) + 1)
+
+        while self.sent < due:
+            if self.maxOutstanding is not None and self.outstanding >= self.maxOutstanding:
+                break
+            index = self.sent
+            self.sent += 1
+            self.outstanding += 1
+            self.maxLag = max(self.maxLag, now - self.intendedTime(index))
+            self._pending[index] = now
+            # synchronous errors, e.g. of datagram protocols, complete the request
+            # as failed, the loop below schedules what comes next
+            self._sending = True
+            d = defer.maybeDeferred(self.conn.createRequest, self.method, *self.params)
+            d.addCallbacks(self._requestFinished, self._requestFailed,
+                           callbackArgs=(index,), errbackArgs=(index,))
+            self._sending = False
+
+        if self.sent < self.total:
+            if self.sent < due:
+                # blocked by maxOutstanding, next completed request sends again
+                return
+            delay = max(0, self.intendedTime(self.sent) - self.clock.seconds())
+            self._delayedSend = self.clock.callLater(delay, self._send)
+        elif self.outstanding:
+            if self._delayedDrain is None:
+                self._delayedDrain = self.clock.callLater(self.drainTimeout, self._drainExpired)
+        else:
+            self._finish()
+
+    def _record(self, index):
+        sent = self._pending.pop(index, None)
+        if sent is None:
+            # request already counted as timeout
+            return False
+        now = self.clock.seconds()
+        self.outstanding -= 1
+        self.latency.record((now - self.intendedTime(index)) * 1e6)
+        self.serviceLatency.record((now - sent) * 1e6)
+        return True
+
+    def _requestFinished(self, result, index):
+        if self._record(index):
+            self.completed += 1
+            self._continue()
+
+    def _requestFailed(self, failure, index):
+        if self._record(index):
+            self.errors += 1
+            self._continue()
+
+    def _continue(self):
+        if self._delayedSend is None and self._finished is None and not self._sending:
+            if self.sent < self.total:
+                self._send()
+            elif not self.outstanding:
+                self._finish()
+
+    def _drainExpired(self):
+        self._delayedDrain = None
+        now = self.clock.seconds()
+        for index in list(self._pending):
+            del self._pending[index]
+            self.latency.record((now - self.intendedTime(index)) * 1e6)
+            self.timeouts += 1
+        self.outstanding = 0
+        self._finish()
+
+    def _finish(self):
+        if self._finished is not None:
+            return
+        self._finished = self.clock.seconds()
+        if self._delayedDrain is not None:
+            self._delayedDrain.cancel()
+            self._delayedDrain = None
+        d, self._deferred = self._deferred, None
+        d.callback(self.result())
+
+    def stop(self):
+        """
+        Stop sending requests, outstanding requests are still awaited.
+        """
+        if self._delayedSend is not None:
+            self._delayedSend.cancel()
+            self._delayedSend = None
+        self.total = self.sent
+        self._continue()
+
+    def result(self):
+        """
+        Return dictionary with target and achieved rate, counts of requests
+        and latency percentiles in microseconds. C{latency} is measured from
+        intended send time, C{service_latency} from actual send time.
+        """
+        elapsed = (self._finished or self.clock.seconds()) - self._start
+        return {
+            'method': self.method,
+            'rate': self.rate,
+            'duration': self.duration,
+            'elapsed': elapsed,
+            'sent': self.sent,
+            'completed': self.completed,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'throughput': self.completed / elapsed if elapsed > 0 else 0.0,
+            'max_lag': self.maxLag,
+            'latency_us': summarize(self.latency),
+            'service_latency_us': summarize(self.serviceLatency),
+        }
+
+
+def summarize(histogram, percentiles=(50, 90, 99, 99.9, 99.99)):
+    summary = dict(('p%s' % p, v) for p, v in zip(percentiles, histogram.percentiles(percentiles)))
+    summary.update({'min': histogram.min or 0, 'max': histogram.max or 0, 'mean': histogram.mean(),
+                    'count': histogram.count})
+    return summary
+
+
+def percentileDistribution(histogram, ticksPerHalfDistance=5, scale=1.0):
+    """
+    Return text with percentile distribution of histogram in format of
+    HdrHistogram C{outputPercentileDistribution}, which can be plotted by
+    HdrHistogram plotter. Values are divided by C{scale}, e.g. 1000 to output
+    milliseconds of histogram recorded in microseconds.
+    """
+    lines = ['%12s %14s %10s %14s' % ('Value', 'Percentile', 'TotalCount', '1/(1-Percentile)'), '']
+    count = histogram.count
+
+    if count:
+        buckets = list(histogram.iterBuckets())
+        position = 0
+        percentile = 0.0
+        while True:
+            threshold = max(1, count * percentile / 100.0)
+            while buckets[position][2] < threshold:
+                position += 1
+            highest, _, cumulative = buckets[position]
+            value = min(highest, histogram.max) / scale
+            if cumulative >= count:
+                lines.append('%12.3f %14.12f %10d %14s' % (value, 1.0, cumulative, ''))
+                break
+            lines.append('%12.3f %14.12f %10d %14.2f' % (value, percentile / 100.0, cumulative,
+                                                        1 / (1 - percentile / 100.0)))
+            # halve the remaining distance in ticksPerHalfDistance steps
+            halfDistance = 2 ** int(_log2(100.0 / (100.0 - percentile)) + 1)
+            percentile += 100.0 / (halfDistance * ticksPerHalfDistance)
+
+    lines.append('#[Mean    = %12.3f, StdDeviation   = %12.3f]' % (histogram.mean() / scale, _stddev(histogram) / scale))
+    lines.append('#[Max     = %12.3f, Total count    = %12d]' % ((histogram.max or 0) / scale, count))
+    return '\n'.join(lines) + '\n'
+
+
+def _log2(value):
+    result = 0
+    while value >= 2:
+        value /= 2.0
+        result += 1
+    return result
+
+
+def _stddev(histogram):
+    if not histogram.count:
+        return 0.0
+    mean = histogram.mean()
+    variance = 0.0
+    for index, count in histogram.counts.items():
+        lowest, highest = histogram.bucketRange(index)
+        variance += count * ((lowest + highest) / 2.0 - mean) ** 2
+    return (variance / histogram.count) ** 0.5
+
+
+def isSaturated(result, tolerance=0.05, maxP99=None):
+    """
+    Return True if server did not keep up with target rate of C{result}:
+    achieved throughput is lower by more than C{tolerance}, some requests
+    failed to complete, or p99 latency exceeds C{maxP99} microseconds.
+    """
+    if result['timeouts']:
+        return True
+    if result['throughput'] < result['rate'] * (1 - tolerance):
+        return True
+    if maxP99 is not None and result['latency_us']['p99'] > maxP99:
+        return True
+    return False
+
+
+@defer.inlineCallbacks
+def ramp(conn, method, params, rates, duration, tolerance=0.05, maxP99=None, maxOutstanding=None,
+         drainTimeout=10, stopAtKnee=True, clock=None, report=None):
+    """
+    Run load generator for every rate of C{rates} in order. Returns
+    C{t.i.d.Deferred} that callbacks with tuple(list of results, knee), where
+    knee is the highest rate before the first saturated step (see
+    L{isSaturated}), or None if even the first rate saturated the server.
+    """
+    results = []
+    knee = None
+    saturated = False
+    for rate in rates:
+        generator = LoadGenerator(conn, method, params, rate, duration, maxOutstanding=maxOutstanding,
+                                  drainTimeout=drainTimeout, clock=clock)
+        result = yield generator.run()
+        result['saturated'] = isSaturated(result, tolerance, maxP99)
+        results.append((result, generator.latency))
+        if report is not None:
+            report(result)
+        if result['saturated']:
+            saturated = True
+            if stopAtKnee:
+                break
+        elif not saturated:
+            knee = rate
+    defer.returnValue((results, knee))
+
+
+def _rampRates(value):
+    try:
+        start, stop, step = [float(v) for v in value.split(':')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('ramp must be START:STOP:STEP')
+    if start <= 0 or step <= 0 or stop < start:
+        raise argparse.ArgumentTypeError('ramp must be positive and increasing')
+    rates = []
+    rate = start
+    while rate <= stop + 1e-9:
+        rates.append(rate)
+        rate += step
+    return rates
+
+
+def formatResult(result):
+    latency = result['latency_us']
+    return ('rate=%-9.1f throughput=%-9.1f sent=%-8d errors=%-6d timeouts=%-6d '
+            'p50=%.3fms p99=%.3fms p99.9=%.3fms max=%.3fms%s') % (
+        result['rate'], result['throughput'], result['sent'], result['errors'], result['timeouts'],
+        latency['p50'] / 1e3, latency['p99'] / 1e3, latency['p99.9'] / 1e3, latency['max'] / 1e3,
+        '  SATURATED' if result.get('saturated') else '')
+
+
+@defer.inlineCallbacks
+def _connect(options):
+    from txmsgpackrpc import client
+
+    if options.transport == 'udp':
+        conn = yield client.connect_UDP(options.host, options.port, waitTimeout=options.timeout)
+    else:
+        conn = yield client.connect_pool(options.host, options.port, poolsize=options.poolsize,
+                                         connectTimeout=options.timeout, waitTimeout=options.timeout)
+    defer.returnValue(conn)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m txmsgpackrpc.loadgen',
+                                     description=__doc__.strip().split('\n')[0])
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('method')
+    parser.add_argument('params', nargs='?', default='[]', type=json.loads,
+                        help='JSON list of method parameters (default: [])')
+    parser.add_argument('--transport', choices=('pool', 'udp'), default='pool',
+                        help='connection type (default: pool)')
+    parser.add_argument('--poolsize', type=int, default=10, help='size of connection pool (default: 10)')
+    parser.add_argument('--timeout', type=float, default=10,
+                        help='seconds to wait for connection and responses (default: 10)')
+    rates = parser.add_mutually_exclusive_group()
+    rates.add_argument('--rate', type=float, default=1000, help='requests per second (default: 1000)')
+    rates.add_argument('--ramp', type=_rampRates, help='ramp rate START:STOP:STEP requests per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of every rate step (default: 10)')
+    parser.add_argument('--warmup', type=float, default=0, help='seconds of warmup at the first rate (default: 0)')
+    parser.add_argument('--max-outstanding', type=int, help='maximum number of requests waiting for response')
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help='relative throughput shortfall considered saturation (default: 0.05)')
+    parser.add_argument('--max-p99', type=float, help='p99 latency in milliseconds considered saturation')
+    parser.add_argument('--no-stop', action='store_true', help='continue ramp after saturation')
+    parser.add_argument('--hdr', help='write HdrHistogram percentile distributions (ms) to file')
+    parser.add_argument('--output', help='write JSON results to file')
+    options = parser.parse_args(argv)
+
+    if not isinstance(options.params, list):
+        parser.error('params must be JSON list')
+
+    from twisted.internet import reactor
+
+    rates = options.ramp or [options.rate]
+    maxP99 = options.max_p99 * 1e3 if options.max_p99 is not None else None
+    output = {}
+
+    def report(result):
+        print(formatResult(result), file=sys.stderr)
+
+    @defer.inlineCallbacks
+    def run():
+        try:
+            conn = yield _connect(options)
+            if options.warmup:
+                yield LoadGenerator(conn, options.method, options.params, rates[0], options.warmup,
+                                    maxOutstanding=options.max_outstanding, drainTimeout=options.timeout).run()
+            output['results'], output['knee'] = yield ramp(
+                conn, options.method, options.params, rates, options.duration, options.tolerance, maxP99,
+                options.max_outstanding, options.timeout, not options.no_stop, report=report)
+        except Exception as e:
+            print('load generator failed: %s' % e, file=sys.stderr)
+            output['failed'] = True
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+    if output.get('failed'):
+        return 1
+
+    results = output['results']
+    knee = output['knee']
+    if len(rates) > 1:
+        print('saturation knee: %s' % ('%.1f req/s' % knee if knee is not None else 'below the first rate'),
+              file=sys.stderr)
+
+    if options.hdr:
+        with open(options.hdr, 'w') as f:
+            for result, histogram in results:
+                f.write('# rate %.1f req/s\n' % result['rate'])
+                f.write(percentileDistribution(histogram, scale=1e3))
+                f.write('\n')
+    else:
+        print(percentileDistribution(results[-1][1], scale=1e3), file=sys.stderr)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'knee': knee, 'results': [result for result, _ in results]}, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 0
+
+
+__all__ = ['LoadGenerator', 'ramp', 'isSaturated', 'percentileDistribution']
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,308 @@
+from timeit import default_timer
+
+from twisted.python import failure
+from twisted.web import resource
+
+
+STATS_METHOD = '__stats__'
+
+ROLE_SERVER = 'server'
+ROLE_CLIENT = 'client'
+
+
+class Histogram(object):
+    """
+    Histogram of non-negative integer values with log-linear buckets in the
+    manner of HdrHistogram. Values lower than 2**C{significantBits} are
+    counted exactly, larger values fall into buckets whose width is
+    proportional to their magnitude, so relative error of reported values
+    is lower than 2**-(C{significantBits} - 1). Recording is one dictionary
+    update and memory depends only on number of distinct buckets.
+    """
+    def __init__(self, significantBits=7):
+        """
+        @param significantBits: number of significant bits of recorded
+            values. Default is 7, i.e. relative error under 1.6%.
+        @type significantBits: C{int}
+        """
+        self.significantBits = significantBits
+        self._linear = 1 << significantBits
+        self._half = 1 << (significantBits - 1)
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucketIndex(self, value):
+        if value < self._linear:
+            return value
+        shift = value.bit_length() - self.significantBits
+        return self._linear + (shift - 1) * self._half + (value >> shift) - self._half
+
+    def bucketRange(self, index):
+        """
+        Return tuple(lowest, highest) of values counted in bucket C{index}.
+        """
+        if index < self._linear:
+            return index, index
+        shift = (index - self._linear) // self._half + 1
+        lowest = ((index - self._linear) % self._half + self._half) << shift
+        return lowest, lowest + (1 << shift) - 1
+
+    def record(self, value, count=1):
+        value = int(value)
+        if value < 0:
+            value = 0
+        index = self.bucketIndex(value)
+        counts = self.counts
+        counts[index] = counts.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def reset(self):
+        self.counts.clear()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def mean(self):
+        if not self.count:
+            return 0
+        return float(self.total) / self.count
+
+    def iterBuckets(self):
+        """
+        Iterate over tuples(highest value of bucket, count, cumulative count)
+        ordered by value.
+        """
+        cumulative = 0
+        for index in sorted(self.counts):
+            count = self.counts[index]
+            cumulative += count
+            yield self.bucketRange(index)[1], count, cumulative
+
+    def percentile(self, percentile):
+        """
+        Return value under which C{percentile} percent of recorded values lie.
+        """
+        if not self.count:
+            return 0
+        threshold = max(1, self.count * percentile / 100.0)
+        for highest, _, cumulative in self.iterBuckets():
+            if cumulative >= threshold:
+                return min(highest, self.max)
+        return self.max
+
+    def percentiles(self, percentiles=(50, 90, 99, 99.9)):
+        """
+        Return list of values of C{percentiles} computed in one pass.
+        """
+        results = []
+        if not self.count:
+            return [0] * len(percentiles)
+        buckets = self.iterBuckets()
+        highest, cumulative = 0, 0
+        for percentile in percentiles:
+            threshold = max(1, self.count * percentile / 100.0)
+            while cumulative < threshold:
+                highest, _, cumulative = next(buckets)
+            results.append(min(highest, self.max))
+        return results
+
+
+class MethodStats(object):
+    """
+    Statistics of calls of one RPC method. Latency is recorded
+    in microseconds.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.inFlight = 0
+        self.latency = Histogram()
+
+    def snapshot(self):
+        p50, p90, p99, p999 = self.latency.percentiles((50, 90, 99, 99.9))
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'in_flight': self.inFlight,
+            'latency': {
+                'min': (self.latency.min or 0) / 1e6,
+                'mean': self.latency.mean() / 1e6,
+                'p50': p50 / 1e6,
+                'p90': p90 / 1e6,
+                'p99': p99 / 1e6,
+                'p999': p999 / 1e6,
+                'max': (self.latency.max or 0) / 1e6,
+                'sum': self.latency.total / 1e6,
+            },
+        }
+
+
+class Metrics(object):
+    """
+    Per-method metrics of RPC calls recorded by protocols. One object can be
+    shared by any number of protocols, factories and connection handlers,
+    e.g. by stream factory and datagram protocol of the same server.
+
+    Server calls are measured from reception of the request until its
+    response is ready, client calls from creation of the request until
+    its response is received.
+    """
+    def __init__(self, timer=default_timer):
+        """
+        @param timer: function returning current time in seconds. Default is
+            C{timeit.default_timer}.
+        @type timer: C{callable}
+        """
+        self.timer = timer
+        self.methods = {ROLE_SERVER: {}, ROLE_CLIENT: {}}
+        self.inFlight = {ROLE_SERVER: 0, ROLE_CLIENT: 0}
+        self.bytesIn = 0
+        self.bytesOut = 0
+        # requests of connection handlers waiting for connection
+        self.queued = 0
+        self.queueRejected = 0
+        self.queueExpired = 0
+
+    def getMethodStats(self, role, method):
+        methods = self.methods[role]
+        try:
+            return methods[method]
+        except KeyError:
+            stats = methods[method] = MethodStats()
+            return stats
+
+    def callStarted(self, role, method):
+        """
+        Record start of a call. Returns start time that must be passed to
+        L{callFinished}.
+        """
+        stats = self.getMethodStats(role, method)
+        stats.calls += 1
+        stats.inFlight += 1
+        self.inFlight[role] += 1
+        return self.timer()
+
+    def callFinished(self, role, method, started, error=False):
+        stats = self.getMethodStats(role, method)
+        stats.inFlight -= 1
+        self.inFlight[role] -= 1
+        if error:
+            stats.errors += 1
+        stats.latency.record((self.timer() - started) * 1e6)
+
+    def callbackFinished(self, result, role, method, started):
+        """
+        Callback that records end of call when added to Deferred of its result.
+        """
+        self.callFinished(role, method, started, isinstance(result, failure.Failure))
+        return result
+
+    def snapshot(self):
+        """
+        Return current values of all metrics as dictionary that can be
+        serialized by msgpack.
+        """
+        return {
+            'bytes_in': self.bytesIn,
+            'bytes_out': self.bytesOut,
+            'in_flight': dict(self.inFlight),
+            'queued': self.queued,
+            'queue_rejected': self.queueRejected,
+            'queue_expired': self.queueExpired,
+            ROLE_SERVER: dict((method, stats.snapshot())
+                              for method, stats in self.methods[ROLE_SERVER].items()),
+            ROLE_CLIENT: dict((method, stats.snapshot())
+                              for method, stats in self.methods[ROLE_CLIENT].items()),
+        }
+
+    def toPrometheus(self, prefix='txmsgpackrpc'):
+        """
+        Return metrics in Prometheus text exposition format.
+        """
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+            for suffix, labels, value in samples:
+                if labels:
+                    labels = '{%s}' % ','.join('%s="%s"' % (k, _escapeLabel(v)) for k, v in labels)
+                lines.append('%s_%s%s%s %s' % (prefix, name, suffix, labels or '', _formatValue(value)))
+
+        calls, errors, inFlight, latency = [], [], [], []
+        for role in (ROLE_SERVER, ROLE_CLIENT):
+            for method, stats in sorted(self.methods[role].items()):
+                labels = (('role', role), ('method', method))
+                calls.append(('', labels, stats.calls))
+                errors.append(('', labels, stats.errors))
+                inFlight.append(('', labels, stats.inFlight))
+                quantiles = (0.5, 0.9, 0.99, 0.999)
+                values = stats.latency.percentiles([q * 100 for q in quantiles])
+                for q, value in zip(quantiles, values):
+                    latency.append(('', labels + (('quantile', repr(q)),), value / 1e6))
+                latency.append(('_sum', labels, stats.latency.total / 1e6))
+                latency.append(('_count', labels, stats.latency.count))
+
+        metric('requests_total', 'counter', 'Number of RPC calls.', calls)
+        metric('errors_total', 'counter', 'Number of failed RPC calls.', errors)
+        metric('in_flight', 'gauge', 'Number of RPC calls in progress.', inFlight)
+        metric('latency_seconds', 'summary', 'Latency of RPC calls.', latency)
+        metric('received_bytes_total', 'counter', 'Number of bytes received.', [('', None, self.bytesIn)])
+        metric('sent_bytes_total', 'counter', 'Number of bytes sent.', [('', None, self.bytesOut)])
+        metric('queued_requests', 'gauge', 'Number of requests waiting for connection.',
+               [('', None, self.queued)])
+        metric('queue_rejected_total', 'counter', 'Number of requests rejected by full queue.',
+               [('', None, self.queueRejected)])
+        metric('queue_expired_total', 'counter', 'Number of requests that waited for connection too long.',
+               [('', None, self.queueExpired)])
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escapeLabel(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsResource(resource.Resource):
+    """
+    Twisted web resource that renders metrics in Prometheus text format.
+    """
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self.metrics.toPrometheus().encode('utf-8')
+
+
+__all__ = ['Histogram', 'Metrics', 'MetricsResource', 'STATS_METHOD']
@@ -0,0 +1,379 @@
+"""
+Batched datagram I/O for Linux.
+
+L{Port} and L{MulticastPort} are drop-in replacements of Twisted UDP ports
+that receive up to C{batchSize} datagrams per wakeup with C{recvmmsg(2)} and
+send datagrams written by protocol in one C{sendmmsg(2)} call. Datagrams
+written while received batch is dispatched are flushed after the batch,
+datagrams written outside of it in the next reactor iteration.
+
+L{listenUDP} and L{listenMulticast} fall back to regular reactor ports on
+platforms without C{recvmmsg}/C{sendmmsg}.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import sys
+
+from twisted.internet import error, udp
+from twisted.internet.interfaces import IReactorFDSet
+from twisted.python import log
+
+
+MSG_DONTWAIT = 0x40
+
+# size of struct sockaddr_storage
+SOCKADDR_SIZE = 128
+
+ADDRESS_CACHE_SIZE = 4096
+
+_sockErrReadIgnore = (errno.EAGAIN, errno.EINTR, errno.EWOULDBLOCK)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def _loadLibc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+
+_libc = _loadLibc()
+
+
+def isSupported(reactor=None):
+    """
+    Returns True if batched datagram I/O can be used with C{reactor}.
+    """
+    if _libc is None:
+        return False
+    if reactor is None:
+        from twisted.internet import reactor
+    return IReactorFDSet.providedBy(reactor)
+
+
+def encodeAddress(addr, family):
+    """
+    Encode (host, port) tuple to C{struct sockaddr_in} or
+    C{struct sockaddr_in6}.
+    """
+    host, port = addr[:2]
+    try:
+        if family == socket.AF_INET6:
+            return (struct.pack('=H', socket.AF_INET6) + struct.pack('>HI', port, 0) +
+                    socket.inet_pton(socket.AF_INET6, host) + struct.pack('=I', 0))
+        if host == '<broadcast>':
+            host = '255.255.255.255'
+        return struct.pack('=H', socket.AF_INET) + struct.pack('>H', port) + socket.inet_pton(socket.AF_INET, host) + b'\0' * 8
+    except (socket.error, struct.error, TypeError):
+        raise error.InvalidAddressError(host, 'write() only accepts IP addresses of port address family')
+
+
+def decodeAddress(raw):
+    """
+    Decode C{struct sockaddr_in} or C{struct sockaddr_in6} to (host, port)
+    tuple.
+    """
+    family, = struct.unpack_from('=H', raw)
+    port, = struct.unpack_from('>H', raw, 2)
+    if family == socket.AF_INET6:
+        return socket.inet_ntop(socket.AF_INET6, raw[8:24]), port
+    return socket.inet_ntop(socket.AF_INET, raw[4:8]), port
+
+
+class _BatchedIOMixin(object):
+    """
+    Replaces C{doRead} and C{write} of Twisted UDP port with batched
+    versions.
+    """
+    batchSize = 64
+
+    datagramsReceived = 0
+    datagramsSent = 0
+    recvCalls = 0
+    sendCalls = 0
+
+    def _initBatches(self, batchSize):
+        self.batchSize = batchSize
+        self._recvBuffers = [ctypes.create_string_buffer(self.maxPacketSize) for _ in range(batchSize)]
+        self._recvNames = ctypes.create_string_buffer(SOCKADDR_SIZE * batchSize)
+        self._recvIovecs = (iovec * batchSize)()
+        self._recvMsgs = (mmsghdr * batchSize)()
+        namesAddress = ctypes.addressof(self._recvNames)
+        for i in range(batchSize):
+            self._recvIovecs[i].iov_base = ctypes.addressof(self._recvBuffers[i])
+            self._recvIovecs[i].iov_len = self.maxPacketSize
+            hdr = self._recvMsgs[i].msg_hdr
+            hdr.msg_name = namesAddress + i * SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self._recvIovecs[i])
+            hdr.msg_iovlen = 1
+        self._sendIovecs = (iovec * batchSize)()
+        self._sendMsgs = (mmsghdr * batchSize)()
+        for i in range(batchSize):
+            hdr = self._sendMsgs[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self._sendIovecs[i])
+            hdr.msg_iovlen = 1
+        self._sendQueue = []
+        self._flushCall = None
+        self._dispatching = False
+        self._decoded = {}
+        self._encoded = {}
+
+    def doRead(self):
+        """
+        Called when my socket is ready for reading.
+        """
+        recvmmsg = _libc[0]
+        fd = self.fileno()
+        msgs = self._recvMsgs
+        namesAddress = ctypes.addressof(self._recvNames)
+        buffers = self._recvBuffers
+        batchSize = self.batchSize
+        read = 0
+        self._dispatching = True
+        try:
+            while read < self.maxThroughput:
+                for i in range(batchSize):
+                    msgs[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+                count = recvmmsg(fd, msgs, batchSize, MSG_DONTWAIT, None)
+                if count < 0:
+                    no = ctypes.get_errno()
+                    if no in _sockErrReadIgnore:
+                        return
+                    if no == errno.ECONNREFUSED:
+                        if self._connectedAddr:
+                            self.protocol.connectionRefused()
+                        return
+                    raise OSError(no, os.strerror(no))
+
+                self.recvCalls += 1
+                self.datagramsReceived += count
+                for i in range(count):
+                    length = msgs[i].msg_len
+                    data = ctypes.string_at(buffers[i], length)
+                    read += length
+                    addr = self._decodeAddress(ctypes.string_at(namesAddress + i * SOCKADDR_SIZE,
+                                                                msgs[i].msg_hdr.msg_namelen))
+                    try:
+                        self.protocol.datagramReceived(data, addr)
+                    except BaseException:
+                        log.err()
+                if count < batchSize:
+                    return
+        finally:
+            self._dispatching = False
+            if self._sendQueue:
+                self.flush()
+
+    def _decodeAddress(self, raw):
+        addr = self._decoded.get(raw)
+        if addr is None:
+            if len(self._decoded) >= ADDRESS_CACHE_SIZE:
+                self._decoded.clear()
+            addr = self._decoded[raw] = decodeAddress(raw)
+        return addr
+
+    def _encodeAddress(self, addr):
+        raw = self._encoded.get(addr)
+        if raw is None:
+            if len(self._encoded) >= ADDRESS_CACHE_SIZE:
+                self._encoded.clear()
+            raw = self._encoded[addr] = encodeAddress(addr, self.addressFamily)
+        return raw
+
+    def write(self, datagram, addr=None):
+        """
+        Queue datagram to be sent with other written datagrams.
+
+        @type datagram: C{bytes}
+        @param datagram: The datagram to be sent.
+        @param addr: (host, port) tuple; can be None in connected mode.
+        """
+        if self._connectedAddr:
+            assert addr in (None, self._connectedAddr)
+            raw = None
+        else:
+            assert addr is not None
+            raw = self._encodeAddress(addr)
+        self._sendQueue.append((datagram, raw))
+        if len(self._sendQueue) >= self.batchSize:
+            self.flush()
+        elif not self._dispatching and self._flushCall is None:
+            self._flushCall = self.reactor.callLater(0, self.flush)
+
+    def flush(self):
+        """
+        Send all queued datagrams.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+
+        sendmmsg = _libc[1]
+        fd = self.fileno()
+        msgs = self._sendMsgs
+        iovecs = self._sendIovecs
+        queue = self._sendQueue
+        while queue:
+            count = min(len(queue), self.batchSize)
+            for i in range(count):
+                datagram, raw = queue[i]
+                iovecs[i].iov_base = ctypes.cast(datagram, ctypes.c_void_p)
+                iovecs[i].iov_len = len(datagram)
+                hdr = msgs[i].msg_hdr
+                if raw is None:
+                    hdr.msg_name = None
+                    hdr.msg_namelen = 0
+                else:
+                    hdr.msg_name = ctypes.cast(raw, ctypes.c_void_p)
+                    hdr.msg_namelen = len(raw)
+
+            sent = sendmmsg(fd, msgs, count, MSG_DONTWAIT)
+            if sent < 0:
+                no = ctypes.get_errno()
+                if no == errno.EINTR:
+                    continue
+                if no in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.startWriting()
+                    return
+                # the first datagram can't be sent, drop it and continue
+                del queue[0]
+                if no == errno.ECONNREFUSED:
+                    if self._connectedAddr:
+                        self.protocol.connectionRefused()
+                elif no == errno.EMSGSIZE:
+                    log.msg('Dropped datagram: message too long')
+                else:
+                    log.err(OSError(no, os.strerror(no)), 'Dropped datagram')
+                continue
+
+            self.sendCalls += 1
+            self.datagramsSent += sent
+            del queue[:sent]
+
+    def doWrite(self):
+        """
+        Called when my socket is ready for writing after C{sendmmsg} would
+        block.
+        """
+        self.stopWriting()
+        self.flush()
+
+    def connectionLost(self, reason=None):
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+        if self._sendQueue and self.socket is not None:
+            self.flush()
+        del self._sendQueue[:]
+        super(_BatchedIOMixin, self).connectionLost(reason)
+
+
+class Port(_BatchedIOMixin, udp.Port):
+    """
+    UDP port using C{recvmmsg}/C{sendmmsg}.
+    """
+    def __init__(self, port, proto, interface='', maxPacketSize=8192, batchSize=64, reactor=None):
+        super(Port, self).__init__(port, proto, interface=interface, maxPacketSize=maxPacketSize, reactor=reactor)
+        self._initBatches(batchSize)
+
+
+class MulticastPort(_BatchedIOMixin, udp.MulticastPort):
+    """
+    Multicast UDP port using C{recvmmsg}/C{sendmmsg}.
+    """
+    def __init__(self, port, proto, interface='', maxPacketSize=8192, batchSize=64, reactor=None,
+                 listenMultiple=False):
+        super(MulticastPort, self).__init__(port, proto, interface=interface, maxPacketSize=maxPacketSize,
+                                            reactor=reactor, listenMultiple=listenMultiple)
+        self._initBatches(batchSize)
+
+
+def listenUDP(port, protocol, interface='', maxPacketSize=8192, batchSize=64, reactor=None):
+    """
+    Connects a given C{DatagramProtocol} to the given numeric UDP port,
+    like C{IReactorUDP.listenUDP}, but with batched I/O where available.
+
+    @param port: port number.
+    @type port: C{int}
+    @param protocol: datagram protocol, e.g.
+        C{protocol.MsgpackDatagramProtocol}.
+    @param interface: local IP address to bind to. Default is all.
+    @type interface: C{str}
+    @param maxPacketSize: size of receive buffer of one datagram.
+        Default is 8192.
+    @type maxPacketSize: C{int}
+    @param batchSize: maximum number of datagrams received or sent in one
+        system call. Default is 64.
+    @type batchSize: C{int}
+    @param reactor: reactor. Default is global reactor.
+    @return listening port
+    @rtype C{IListeningPort}
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    if not isSupported(reactor):
+        return reactor.listenUDP(port, protocol, interface=interface, maxPacketSize=maxPacketSize)
+    p = Port(port, protocol, interface=interface, maxPacketSize=maxPacketSize, batchSize=batchSize,
+             reactor=reactor)
+    p.startListening()
+    return p
+
+
+def listenMulticast(port, protocol, interface='', maxPacketSize=8192, listenMultiple=False, batchSize=64,
+                    reactor=None):
+    """
+    Connects a given C{DatagramProtocol} to the given numeric UDP port,
+    like C{IReactorMulticast.listenMulticast}, but with batched I/O where
+    available. See L{listenUDP} for description of parameters.
+
+    @param listenMultiple: allow multiple sockets to bind the same port.
+        Default is False.
+    @type listenMultiple: C{bool}
+    @return listening port
+    @rtype C{IListeningPort}
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    if not isSupported(reactor):
+        return reactor.listenMulticast(port, protocol, interface=interface, maxPacketSize=maxPacketSize,
+                                       listenMultiple=listenMultiple)
+    p = MulticastPort(port, protocol, interface=interface, maxPacketSize=maxPacketSize, batchSize=batchSize,
+                      reactor=reactor, listenMultiple=listenMultiple)
+    p.startListening()
+    return p
+
+
+__all__ = ['Port', 'MulticastPort', 'listenUDP', 'listenMulticast', 'isSupported']
@@ -0,0 +1,232 @@
+import base64
+import cProfile
+import io
+import marshal
+import pstats
+import sys
+import threading
+from collections import defaultdict
+from timeit import default_timer
+
+from twisted.internet import defer
+
+from txmsgpackrpc.error import InvalidRequest
+from txmsgpackrpc.interceptor import Interceptor
+
+
+PROFILE_METHOD = '__profile__'
+
+MODE_CPROFILE = 'cprofile'
+MODE_SAMPLING = 'sampling'
+
+
+class _Sampler(threading.Thread):
+    """
+    Thread that periodically samples stack of reactor thread and counts
+    stacks in which code of profiled method is active, or all stacks if the
+    code is None.
+    """
+    def __init__(self, threadId, code, interval):
+        threading.Thread.__init__(self, name='txmsgpackrpc-sampler')
+        self.daemon = True
+        self.threadId = threadId
+        self.code = code
+        self.interval = interval
+        self.samples = 0
+        self.stacks = defaultdict(int)
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            self.samples += 1
+            stack = []
+            matched = self.code is None
+            while frame is not None:
+                code = frame.f_code
+                if code is self.code:
+                    matched = True
+                stack.append('%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            if matched:
+                stack.reverse()
+                self.stacks[';'.join(stack)] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class _Session(object):
+    def __init__(self, method, mode, calls):
+        self.method = method
+        self.mode = mode
+        self.maxCalls = calls
+        self.calls = 0
+        self.started = default_timer()
+        self.deferred = defer.Deferred()
+        self.timer = None
+        self.profile = None
+        self.sampler = None
+        self.depth = 0
+
+
+class MethodProfiler(Interceptor):
+    """
+    Interceptor that profiles calls of one RPC method on demand. Profiling
+    is started by reserved RPC method C{__profile__} served by protocols
+    configured with the profiler::
+
+        __profile__(method, mode='cprofile', duration=None, calls=None)
+
+    Profiling ends after C{duration} seconds or after C{calls} calls of the
+    method, whichever comes first, and the response carries collected data.
+
+    Mode C{'cprofile'} runs C{cProfile} during synchronous execution of the
+    method and returns text report and base64 encoded marshalled pstats data,
+    that can be loaded by C{pstats.Stats} after it is decoded and written to
+    file. Mode C{'sampling'} samples stack of reactor thread and returns collapsed
+    stacks, including asynchronous continuations of the method (e.g.
+    C{inlineCallbacks} generators), that can be rendered as flame graph.
+    Methods without code object of their own (e.g. C{functools.partial})
+    are sampled together with everything else the reactor thread runs.
+    """
+    def __init__(self, defaultDuration=10, maxDuration=300, sampleInterval=0.005, reportLimit=50, clock=None):
+        """
+        @param defaultDuration: duration of profiling in seconds if neither
+            duration nor number of calls is requested. Default is 10 seconds.
+        @type defaultDuration: C{int}
+        @param maxDuration: maximum duration of profiling in seconds.
+            Default is 300 seconds.
+        @type maxDuration: C{int}
+        @param sampleInterval: interval between samples of sampling profiler
+            in seconds. Default is 5 ms.
+        @type sampleInterval: C{float}
+        @param reportLimit: number of functions in cProfile text report.
+            Default is 50.
+        @type reportLimit: C{int}
+        @param clock: provider of delayed calls. Default is reactor.
+        @type clock: C{t.i.i.IReactorTime}
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.clock = clock
+        self.defaultDuration = defaultDuration
+        self.maxDuration = maxDuration
+        self.sampleInterval = sampleInterval
+        self.reportLimit = reportLimit
+        self._session = None
+
+    def isProfiling(self):
+        return self._session is not None
+
+    def startProfiling(self, method, mode=MODE_CPROFILE, duration=None, calls=None):
+        """
+        Start profiling of C{method}. Returns Deferred that fires with
+        collected data when profiling ends.
+        """
+        if self._session is not None:
+            raise InvalidRequest("Method %s is already being profiled" % self._session.method)
+        if mode not in (MODE_CPROFILE, MODE_SAMPLING):
+            raise InvalidRequest("Unknown profiling mode: %s" % mode)
+        if calls is not None and calls < 1:
+            raise InvalidRequest("Number of calls must be positive")
+
+        if duration is None:
+            duration = self.maxDuration if calls is not None else self.defaultDuration
+        duration = min(duration, self.maxDuration)
+
+        session = _Session(method, mode, calls)
+        if mode == MODE_CPROFILE:
+            session.profile = cProfile.Profile()
+        session.timer = self.clock.callLater(duration, self._finish, session)
+        self._session = session
+        return session.deferred
+
+    def stopProfiling(self):
+        """
+        Stop running profiling, its Deferred fires with data collected so far.
+        """
+        if self._session is not None:
+            self._finish(self._session)
+
+    def intercept(self, call, proceed):
+        session = self._session
+        if session is None or call.method != session.method or call.notification:
+            return proceed(call)
+
+        if session.mode == MODE_SAMPLING and session.sampler is None:
+            self._startSampler(session, call)
+
+        session.depth += 1
+        if session.profile is not None and session.depth == 1:
+            session.profile.enable()
+        try:
+            d = proceed(call)
+        finally:
+            session.depth -= 1
+            if session.profile is not None and session.depth == 0:
+                session.profile.disable()
+
+        d.addBoth(self._callFinished, session)
+        return d
+
+    def _startSampler(self, session, call):
+        try:
+            method = call.protocol.getRemoteMethod(call.protocol, call.method)
+        except Exception:
+            # the call fails on its own
+            method = None
+        func = getattr(method, '__func__', method)
+        while hasattr(func, '__wrapped__'):
+            func = func.__wrapped__
+        # partials and callable objects have no code of their own, whole
+        # reactor thread is sampled then
+        code = getattr(func, '__code__', None)
+        session.sampler = _Sampler(threading.current_thread().ident, code, self.sampleInterval)
+        session.sampler.start()
+
+    def _callFinished(self, result, session):
+        session.calls += 1
+        if session.maxCalls is not None and session.calls >= session.maxCalls:
+            self._finish(session)
+        return result
+
+    def _finish(self, session):
+        if self._session is not session:
+            return
+        self._session = None
+
+        if session.timer.active():
+            session.timer.cancel()
+
+        result = {
+            'method': session.method,
+            'mode': session.mode,
+            'calls': session.calls,
+            'duration': default_timer() - session.started,
+        }
+
+        if session.mode == MODE_CPROFILE:
+            stream = io.StringIO() if sys.version_info.major >= 3 else io.BytesIO()
+            profile = session.profile
+            profile.create_stats()
+            # pstats.Stats takes over stats of profile, so dump them first
+            result['pstats'] = base64.b64encode(marshal.dumps(profile.stats)).decode('ascii')
+            if profile.stats:
+                stats = pstats.Stats(profile, stream=stream)
+                stats.sort_stats('cumulative').print_stats(self.reportLimit)
+            result['report'] = stream.getvalue()
+        else:
+            samples, stacks = 0, {}
+            if session.sampler is not None:
+                session.sampler.stop()
+                samples, stacks = session.sampler.samples, session.sampler.stacks
+            result['samples'] = samples
+            result['stacks'] = '\n'.join('%s %d' % item for item in sorted(stacks.items()))
+
+        session.deferred.callback(result)
+
+
+__all__ = ['MethodProfiler', 'PROFILE_METHOD', 'MODE_CPROFILE', 'MODE_SAMPLING']
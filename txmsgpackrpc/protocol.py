@@ -7,31 +7,33 @@
 from __future__ import print_function
 
 import logging
-import msgpack
-import sys
-from collections import defaultdict, deque, namedtuple
+from collections import defaultdict, deque
 from twisted.internet import defer, protocol
 from twisted.protocols import policies
 from twisted.python import failure, log
 
-from txmsgpackrpc.error import (ConnectionError, ResponseError, InvalidRequest,
-                                InvalidResponse, InvalidData, TimeoutError,
-                                SerializationError)
-
-
-MSGTYPE_REQUEST=0
-MSGTYPE_RESPONSE=1
-MSGTYPE_NOTIFICATION=2
-
-
-Context = namedtuple('Context', ['peer'])
+from txmsgpackrpc.core import (MSGTYPE_REQUEST, MSGTYPE_RESPONSE, MSGTYPE_NOTIFICATION,
+                               Context, RequestTable, NO_REQUESTS, createPacker, createUnpacker, sharedPacker,
+                               packMessage, packRequest, unpackRequest, unpackResponse,
+                               invokeMethod, errorValue)
+from txmsgpackrpc.error import (ConnectionError, InvalidRequest, TimeoutError,
+                                RateLimitExceeded, unpackError)
+from txmsgpackrpc.fragment import Reassembler, fragment, isFragment
+from txmsgpackrpc.handler import MethodStub
+from txmsgpackrpc.interceptor import Call, buildChain, extendChain
+from txmsgpackrpc.keepalive import KeepAlive
+from txmsgpackrpc.metrics import STATS_METHOD, ROLE_CLIENT, ROLE_SERVER
+from txmsgpackrpc.profiler import PROFILE_METHOD
+from txmsgpackrpc.reliable import PENDING
 
 
 class MsgpackBaseProtocol(object):
     """
     msgpack rpc client/server protocol - base implementation
     """
-    def __init__(self, sendErrors=False, packerEncoding="utf-8", unpackerEncoding="utf-8", useList=True):
+    def __init__(self, sendErrors=False, packerEncoding="utf-8", unpackerEncoding="utf-8", useList=True,
+                 rateLimiter=None, metrics=None, exposeStats=False, interceptors=None, profiler=None,
+                 slowLog=None, lowMemory=False):
         """
         @param sendErrors: forward any uncaught Exception details to remote peer.
         @type sendErrors: C{bool}.
@@ -41,13 +43,57 @@ class MsgpackBaseProtocol(object):
         @type unpackerEncoding: C{str}.
         @param useList: If true, unpack msgpack array to Python list.  Otherwise, unpack to Python tuple.
         @type useList: C{bool}.
+        @param rateLimiter: limiter consulted before dispatch of each incoming request and notification.
+        @type rateLimiter: C{ratelimit.RateLimiter}
+        @param metrics: collector of per-method metrics of incoming and outgoing requests.
+        @type metrics: C{metrics.Metrics}
+        @param exposeStats: serve snapshot of C{metrics} by reserved RPC method C{__stats__}. Default is False.
+        @type exposeStats: C{bool}
+        @param interceptors: interceptors of incoming and outgoing calls, the first one is the outermost.
+        @type interceptors: C{list} or C{interceptor.InterceptorChain}
+        @param profiler: profiler of incoming calls controlled by reserved RPC method C{__profile__}.
+        @type profiler: C{profiler.MethodProfiler}
+        @param slowLog: log of incoming and outgoing requests that exceed latency threshold.
+        @type slowLog: C{slowlog.SlowRequestLog}
+        @param lowMemory: reduce memory of idle protocol. Packer is shared with other protocols, unpacker is
+            released when all received data is consumed and request tables are allocated on first use.
+            Default is False.
+        @type lowMemory: C{bool}
         """
         self._sendErrors = sendErrors
-        self._incoming_requests = {}
-        self._outgoing_requests = {}
-        self._next_msgid = 0
-        self._packer = msgpack.Packer(encoding=packerEncoding)
-        self._unpacker = msgpack.Unpacker(encoding=unpackerEncoding, unicode_errors='strict', use_list=useList)
+        self._rateLimiter = rateLimiter
+        self._metrics = metrics
+        self._interceptors = buildChain(interceptors)
+        self._builtinMethods = None
+        if exposeStats:
+            if metrics is None:
+                raise ValueError('Cannot expose stats without metrics')
+            self.addBuiltinMethod(STATS_METHOD, metrics.snapshot)
+        if profiler is not None:
+            self._interceptors = extendChain(self._interceptors, profiler)
+            self.addBuiltinMethod(PROFILE_METHOD, profiler.startProfiling)
+        self._slowLog = slowLog
+        self._timings = {} if slowLog is not None else None
+        self._received = None
+        self._messageSize = None
+        self._unpackedOffset = 0
+        # all instances set the same attributes in the same order, so they
+        # share keys of their __dict__
+        self._lowMemory = lowMemory
+        self._bytesFed = 0
+        self._packerEncoding = packerEncoding
+        self._unpackerEncoding = unpackerEncoding
+        self._useList = useList
+        if lowMemory:
+            self._incoming_requests = NO_REQUESTS
+            self._outgoing_requests = NO_REQUESTS
+            self._packer = sharedPacker(packerEncoding)
+            self._unpacker = None
+        else:
+            self._incoming_requests = {}
+            self._outgoing_requests = RequestTable()
+            self._packer = createPacker(packerEncoding)
+            self._unpacker = createUnpacker(unpackerEncoding, useList)
 
     def isConnected(self):
         raise NotImplementedError('Must be implemented in descendant')
@@ -61,6 +107,18 @@ class MsgpackBaseProtocol(object):
     def getClientContext(self):
         raise NotImplementedError('Must be implemented in descendant')
 
+    def getPeerKey(self, context):
+        raise NotImplementedError('Must be implemented in descendant')
+
+    def addBuiltinMethod(self, methodName, method):
+        """
+        Register reserved RPC method that is served by protocol itself instead
+        of RPC server object.
+        """
+        if self._builtinMethods is None:
+            self._builtinMethods = {}
+        self._builtinMethods[methodName] = method
+
     def createRequest(self, method, params):
         """
         Create new RPC request. If protocol is not connected, errback with
@@ -80,17 +138,98 @@ class MsgpackBaseProtocol(object):
             errbacks with C{error.MsgpackError}.
         @rtype C{t.i.d.Deferred}
         """
+        if self._interceptors is None:
+            return self.sendRequest(method, params)
+        call = Call(ROLE_CLIENT, method, params, self.getClientContext(), protocol=self)
+        return self._interceptors.execute(call, self._sendInterceptedRequest)
+
+    def method(self, method):
+        """
+        Return L{handler.MethodStub} that calls RPC method C{method} using
+        this protocol.
+        """
+        return MethodStub(self, method)
+
+    def callStub(self, stub, params):
+        try:
+            return self.createPreparedRequest(stub, params)
+        except Exception:
+            return defer.fail()
+
+    def createPreparedRequest(self, stub, params):
+        """
+        Create new RPC request of method of L{handler.MethodStub}, whose name
+        is serialized only once. See L{createRequest}.
+        """
+        if self._interceptors is not None:
+            return self.createRequest(stub.method, params)
+        encoded = stub.encoded.get(self._packerEncoding)
+        if encoded is None:
+            encoded = stub.encoded[self._packerEncoding] = packMessage(self._packer, stub.method, self._sendErrors)
+        return self.sendRequest(stub.method, params, encoded)
+
+    def sendRequest(self, method, params, encodedMethod=None):
+        """
+        Write RPC request to peer bypassing interceptors. See L{createRequest}.
+        """
         if not self.isConnected():
             raise ConnectionError("Not connected")
         msgid = self.getNextMsgid()
+        if self._metrics is not None:
+            started = self._metrics.callStarted(ROLE_CLIENT, method)
         message = (MSGTYPE_REQUEST, msgid, method, params)
+        if encodedMethod is not None:
+            data = packRequest(self._packer, msgid, encodedMethod, params, self._sendErrors)
+        else:
+            data = None
         ctx = self.getClientContext()
-        self.writeMessage(message, ctx)
+        try:
+            if self._slowLog is None:
+                self.writeMessage(message, ctx, data=data)
+            else:
+                timing = self._slowLog.startRequest(ROLE_CLIENT, method, msgid, ctx and ctx.peer, params=params)
+                self.writeMessage(message, ctx, timing, data)
+        except Exception:
+            # request was not sent, its timing is dropped
+            if self._metrics is not None:
+                self._metrics.callFinished(ROLE_CLIENT, method, started, error=True)
+            raise
 
         df = defer.Deferred()
         self._outgoing_requests[msgid] = df
+        if self._metrics is not None:
+            df.addBoth(self._metrics.callbackFinished, ROLE_CLIENT, method, started)
+        if self._slowLog is not None:
+            df.addBoth(self._finishTimedRequest, timing)
         return df
 
+    def sendProbe(self, msgid, method, params):
+        """
+        Write request with C{msgid} of L{getNextMsgid} that is not recorded
+        by metrics nor slow log, e.g. keepalive probe. Returns Deferred of
+        its response.
+        """
+        if not self.isConnected():
+            raise ConnectionError("Not connected")
+        self.writeMessage((MSGTYPE_REQUEST, msgid, method, params), self.getClientContext())
+        df = defer.Deferred()
+        self._outgoing_requests[msgid] = df
+        return df
+
+    def _finishTimedRequest(self, result, timing):
+        timing.finished = self._slowLog.timer()
+        timing.received = self._received
+        if timing.received is not None:
+            timing.responseSize = self._messageSize
+        if isinstance(result, failure.Failure):
+            self._slowLog.finishRequest(timing, error=result.value)
+        else:
+            self._slowLog.finishRequest(timing, result=result)
+        return result
+
+    def _sendInterceptedRequest(self, call):
+        return self.sendRequest(call.method, call.params)
+
     def createNotification(self, method, params):
         """
         Create new RPC notification. If protocol is not connected, errback with
@@ -108,57 +247,116 @@ class MsgpackBaseProtocol(object):
             errbacks with C{error.MsgpackError}.
         @rtype C{t.i.d.Deferred}
         """
-        if not self.isConnected():
-            raise ConnectionError("Not connected")
         if not type(params) in (list, tuple):
             params = (params,)
+        if self._interceptors is None:
+            return self.sendNotification(method, params)
+        call = Call(ROLE_CLIENT, method, params, self.getClientContext(), notification=True, protocol=self)
+        return self._interceptors.execute(call, self._sendInterceptedNotification)
+
+    def sendNotification(self, method, params):
+        """
+        Write RPC notification to peer bypassing interceptors. See L{createNotification}.
+        """
+        if not self.isConnected():
+            raise ConnectionError("Not connected")
         message = (MSGTYPE_NOTIFICATION, method, params)
         ctx = self.getClientContext()
         self.writeMessage(message, ctx)
 
+    def _sendInterceptedNotification(self, call):
+        return self.sendNotification(call.method, call.params)
+
     def getNextMsgid(self):
-        self._next_msgid += 1
-        return self._next_msgid
+        if self._outgoing_requests is NO_REQUESTS:
+            self._outgoing_requests = RequestTable()
+        return self._outgoing_requests.nextMsgid()
 
     def rawDataReceived(self, data, context=None):
+        if self._metrics is not None:
+            self._metrics.bytesIn += len(data)
+        if self._slowLog is not None:
+            return self._rawDataReceivedTimed(data, context)
+        unpacker = self._unpacker
+        if unpacker is None:
+            unpacker = self._unpacker = createUnpacker(self._unpackerEncoding, self._useList)
         try:
-            self._unpacker.feed(data)
-            for message in self._unpacker:
+            unpacker.feed(data)
+            for message in unpacker:
                 self.messageReceived(message, context)
         except Exception:
             log.err()
+        if self._lowMemory:
+            self._releaseUnpacker(len(data))
+
+    def _releaseUnpacker(self, received):
+        # unpacker and its buffer are dropped when the last message is
+        # consumed completely, partial message keeps it until the rest arrives
+        self._bytesFed += received
+        unpacker = self._unpacker
+        if unpacker is not None and unpacker.tell() == self._bytesFed:
+            self._unpacker = None
+            self._bytesFed = 0
+            self._unpackedOffset = 0
+
+    def _rawDataReceivedTimed(self, data, context):
+        # same as rawDataReceived, but it tracks time of reception and size
+        # of each message for slow request log
+        self._received = self._slowLog.timer()
+        unpacker = self._unpacker
+        if unpacker is None:
+            unpacker = self._unpacker = createUnpacker(self._unpackerEncoding, self._useList)
+        try:
+            unpacker.feed(data)
+            for message in unpacker:
+                offset = unpacker.tell()
+                self._messageSize = offset - self._unpackedOffset
+                self._unpackedOffset = offset
+                self.messageReceived(message, context)
+        except Exception:
+            log.err()
+        finally:
+            self._received = None
+            self._messageSize = None
+        if self._lowMemory:
+            self._releaseUnpacker(len(data))
 
     def messageReceived(self, message, context):
         if message[0] == MSGTYPE_REQUEST:
             return self.requestReceived(message, context)
         if message[0] == MSGTYPE_RESPONSE:
-            return self.responseReceived(message)
+            return self.responseReceived(message, context)
         if message[0] == MSGTYPE_NOTIFICATION:
-            return self.notificationReceived(message)
+            return self.notificationReceived(message, context)
 
         return self.undefinedMessageReceived(message)
 
     def requestReceived(self, message, context):
-        try:
-            (msgType, msgid, methodName, params) = message
-        except ValueError:
-            if self._sendErrors:
-                raise
-            if not len(message) == 4:
-                raise InvalidData("Incorrect message length. Expected 4; received %s" % len(message))
-            raise InvalidData("Failed to unpack request.")
-        except Exception:
-            if self._sendErrors:
-                raise
-            raise InvalidData("Unexpected error. Failed to unpack request.")
+        msgid, methodName, params = unpackRequest(message, self._sendErrors)
 
         if msgid in self._incoming_requests:
             raise InvalidRequest("Request with msgid '%s' already exists" % msgid)
 
-        result = defer.maybeDeferred(self.callRemoteMethod, msgid, methodName, params)
+        if self._metrics is not None:
+            started = self._metrics.callStarted(ROLE_SERVER, methodName)
+        if self._slowLog is not None:
+            self._timings[msgid] = self._slowLog.startRequest(ROLE_SERVER, methodName, msgid, self.getPeerKey(context),
+                                                              self._received, self._messageSize, params)
+
+        if self._rateLimiter is not None and not self._rateLimiter.allow(self.getPeerKey(context), methodName):
+            result = defer.fail(RateLimitExceeded("Rate limit exceeded for method %s" % methodName))
+        elif self._interceptors is not None:
+            call = Call(ROLE_SERVER, methodName, params, context, msgid, protocol=self)
+            result = self._interceptors.execute(call, self._callInterceptedMethod)
+        else:
+            result = defer.maybeDeferred(self.callRemoteMethod, msgid, methodName, params)
 
+        if self._incoming_requests is NO_REQUESTS:
+            self._incoming_requests = {}
         self._incoming_requests[msgid] = (result, context)
 
+        if self._metrics is not None:
+            result.addBoth(self._metrics.callbackFinished, ROLE_SERVER, methodName, started)
         result.addCallback(self.respondCallback, msgid)
         result.addErrback(self.respondErrback, msgid)
         result.addBoth(self.endRequest, msgid)
@@ -166,52 +364,31 @@ class MsgpackBaseProtocol(object):
 
     def callRemoteMethod(self, msgid, methodName, params):
         try:
-            method = self.getRemoteMethod(self, methodName)
+            if self._builtinMethods is not None and methodName in self._builtinMethods:
+                method = self._builtinMethods[methodName]
+            else:
+                method = self.getRemoteMethod(self, methodName)
         except Exception:
             if self._sendErrors:
                 raise
             raise InvalidRequest("Client attempted to call unimplemented method: remote_%s" % methodName)
 
-        send_msgid = False
-        try:
-            # If the remote_method has a keyword argment called msgid, then pass
-            # it the msgid as a keyword argument. 'params' is always a list.
-            if sys.version_info.major == 2:
-                method_arguments = method.func_code.co_varnames
-            elif sys.version_info.major == 3:
-                method_arguments = method.__code__.co_varnames
-            else:
-                raise NotImplementedError('Unsupported Python version %s' % sys.version_info.major)
-
-            if 'msgid' in method_arguments:
-                send_msgid = True
-        except Exception:
-            pass
+        return invokeMethod(method, methodName, msgid, params, self._sendErrors, self)
 
-        try:
-            if send_msgid:
-                result = method(*params, msgid=msgid)
-            else:
-                result = method(*params)
-        except TypeError:
-            if self._sendErrors:
-                raise
-            raise InvalidRequest("Wrong number of arguments for %s" % methodName)
-
-        return result
+    def _callInterceptedMethod(self, call):
+        return self.callRemoteMethod(call.msgid, call.method, call.params)
 
     def endRequest(self, result, msgid):
         if msgid in self._incoming_requests:
             del self._incoming_requests[msgid]
+            if self._lowMemory and not self._incoming_requests:
+                self._incoming_requests = NO_REQUESTS
+        if self._timings is not None:
+            self._timings.pop(msgid, None)
         return result
 
-    def responseReceived(self, message):
-        try:
-            (msgType, msgid, error, result) = message
-        except Exception as e:
-            if self._sendErrors:
-                raise
-            raise InvalidResponse("Failed to unpack response: %s" % e)
+    def responseReceived(self, message, context=None):
+        msgid, error, result = unpackResponse(message, self._sendErrors)
 
         try:
             df = self._outgoing_requests.pop(msgid)
@@ -226,7 +403,7 @@ class MsgpackBaseProtocol(object):
             # The remote host returned an error, so we need to create a Failure
             # object to pass into the errback chain. The Failure object in turn
             # requires an Exception
-            ex = ResponseError(error)
+            ex = unpackError(error)
             df.errback(failure.Failure(exc_value=ex))
         else:
             df.callback(result)
@@ -239,14 +416,11 @@ class MsgpackBaseProtocol(object):
 
         error = None
         response = (MSGTYPE_RESPONSE, msgid, error, result)
-        return self.writeMessage(response, ctx)
+        return self._writeResponse(msgid, response, ctx)
 
     def respondErrback(self, f, msgid):
         result = None
-        if self._sendErrors:
-            error = f.getBriefTraceback()
-        else:
-            error = f.getErrorMessage()
+        error = errorValue(f.value, self._sendErrors, f.getBriefTraceback() if self._sendErrors else None)
         self.respondError(msgid, error, result)
 
     def respondError(self, msgid, error, result=None):
@@ -256,20 +430,33 @@ class MsgpackBaseProtocol(object):
             ctx = None
 
         response = (MSGTYPE_RESPONSE, msgid, error, result)
-        self.writeMessage(response, ctx)
+        self._writeResponse(msgid, response, ctx)
 
-    def writeMessage(self, message, context):
-        try:
-            message = self._packer.pack(message)
-        except Exception:
-            self._packer.reset()
-            if self._sendErrors:
-                raise
-            raise SerializationError("ERROR: Failed to write message: %s" % message)
+    def _writeResponse(self, msgid, response, ctx):
+        timing = self._timings.pop(msgid, None) if self._timings is not None else None
+        if timing is None:
+            return self.writeMessage(response, ctx)
+
+        timing.executed = self._slowLog.timer()
+        self.writeMessage(response, ctx, timing)
+        self._slowLog.finishRequest(timing, response[2], response[3])
 
-        self.writeRawData(message, context)
+    def writeMessage(self, message, context, timing=None, data=None):
+        if data is None:
+            message = packMessage(self._packer, message, self._sendErrors)
+        else:
+            message = data
+
+        if self._metrics is not None:
+            self._metrics.bytesOut += len(message)
+        if timing is None:
+            self.writeRawData(message, context)
+        else:
+            serialized = self._slowLog.timer()
+            self.writeRawData(message, context)
+            timing.messageWritten(serialized, self._slowLog.timer(), len(message))
 
-    def notificationReceived(self, message):
+    def notificationReceived(self, message, context=None):
         # Notifications don't expect a return value, so they don't supply a msgid
         msgid = None
 
@@ -278,9 +465,17 @@ class MsgpackBaseProtocol(object):
         except Exception:
             # Log the error - there's no way to return it for a notification
             log.err()
+            return None
+
+        if self._rateLimiter is not None and not self._rateLimiter.allow(self.getPeerKey(context), methodName):
+            return None
 
         try:
-            result = defer.maybeDeferred(self.callRemoteMethod, msgid, methodName, params)
+            if self._interceptors is not None:
+                call = Call(ROLE_SERVER, methodName, params, context, notification=True, protocol=self)
+                result = self._interceptors.execute(call, self._callInterceptedMethod)
+            else:
+                result = defer.maybeDeferred(self.callRemoteMethod, msgid, methodName, params)
             result.addBoth(self.notificationCallback)
         except Exception:
             # Log the error - there's no way to return it for a notification
@@ -302,6 +497,74 @@ class MsgpackBaseProtocol(object):
             msgid, d = self._outgoing_requests.popitem()
             func(d)
 
+    def waitForRequests(self):
+        """
+        Return Deferred that callbacks when all requests received so far are
+        answered. Requests received later are not waited for.
+        """
+        return _whenFinished([result for result, _ in self._incoming_requests.values()])
+
+    def waitForResponses(self):
+        """
+        Return Deferred that callbacks when all requests sent so far got
+        response or failed. Requests sent later are not waited for.
+        """
+        return _whenFinished(list(self._outgoing_requests.values()))
+
+
+def _whenFinished(deferreds):
+    if not deferreds:
+        return defer.succeed(None)
+    d = defer.Deferred()
+    remaining = [len(deferreds)]
+
+    def finished(result):
+        remaining[0] -= 1
+        if not remaining[0]:
+            d.callback(None)
+        return result
+
+    for pending in deferreds:
+        pending.addBoth(finished)
+    return d
+
+
+class ClientProxy(object):
+    """
+    Caller of RPC methods of client on the other side of server connection.
+    Client serves them by C{rpcHandler} passed to C{client.connect}. Requests
+    are sent over the same connection and their responses are matched by
+    the connection like responses of any other request. Remote methods of
+    server decorated by C{server.passConnection} get the proxy by
+    C{connection.getClientProxy()}.
+    """
+    __slots__ = ('connection',)
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def createRequest(self, method, *params):
+        """
+        Create new RPC request to client. See
+        C{handler.SimpleConnectionHandler.createRequest}.
+        """
+        return defer.maybeDeferred(self.connection.createRequest, method, params)
+
+    def createNotification(self, method, params):
+        """
+        Create new RPC notification to client.
+        """
+        return defer.maybeDeferred(self.connection.createNotification, method, params)
+
+    def method(self, method):
+        """
+        Return callable L{handler.MethodStub} of RPC method C{method} of client.
+        """
+        return self.connection.method(method)
+
+    def __repr__(self):
+        return '<ClientProxy of %r>' % (self.connection,)
+
 
 class MsgpackStreamProtocol(protocol.Protocol, policies.TimeoutMixin, MsgpackBaseProtocol):
     """
@@ -309,13 +572,15 @@ class MsgpackStreamProtocol(protocol.Protocol, policies.TimeoutMixin, MsgpackBas
 
     @ivar factory: The L{MsgpackClientFactory} or L{MsgpackServerFactory}  which created this L{Msgpack}.
     """
-    def __init__(self, factory, sendErrors=False, timeout=None, packerEncoding="utf-8", unpackerEncoding="utf-8", useList=True):
+    def __init__(self, factory, sendErrors=False, timeout=None, packerEncoding="utf-8", unpackerEncoding="utf-8", useList=True,
+                 keepaliveInterval=None, keepaliveTimeout=None, clock=None, **kwargs):
         """
         @param factory: factory which created this protocol.
         @type factory: C{protocol.Factory}.
         @param sendErrors: forward any uncaught Exception details to remote peer.
         @type sendErrors: C{bool}.
-        @param timeout: idle timeout in seconds before connection will be closed.
+        @param timeout: idle timeout in seconds before connection will be closed. Answers of keepalive
+            probes don't postpone it.
         @type timeout: C{int}
         @param packerEncoding: encoding used to encode Python str and unicode. Default is 'utf-8'.
         @type packerEncoding: C{str}
@@ -323,11 +588,32 @@ class MsgpackStreamProtocol(protocol.Protocol, policies.TimeoutMixin, MsgpackBas
         @type unpackerEncoding: C{str}.
         @param useList: If true, unpack msgpack array to Python list.  Otherwise, unpack to Python tuple.
         @type useList: C{bool}.
+        @param keepaliveInterval: seconds between keepalive probes of peer. Default is None, i.e. no probes.
+        @type keepaliveInterval: C{int} or C{float}
+        @param keepaliveTimeout: seconds to wait for answer of keepalive probe before connection is aborted.
+            Default is C{keepaliveInterval}.
+        @type keepaliveTimeout: C{int} or C{float}
+        @param clock: provider of C{IReactorTime} used for keepalive probes. Default is reactor.
+        @param kwargs: other options of L{MsgpackBaseProtocol}.
         """
-        super(MsgpackStreamProtocol, self).__init__(sendErrors, packerEncoding, unpackerEncoding, useList)
+        super(MsgpackStreamProtocol, self).__init__(sendErrors, packerEncoding, unpackerEncoding, useList, **kwargs)
         self.factory = factory
         self.setTimeout(timeout)
         self.connected = 0
+        self._peerKey = None
+        if keepaliveInterval:
+            self.keepalive = KeepAlive(self, keepaliveInterval, keepaliveTimeout, clock=clock)
+        else:
+            self.keepalive = None
+
+    @property
+    def rtt(self):
+        """
+        Smoothed round-trip time of keepalive probes in seconds, or None.
+        """
+        if self.keepalive is None:
+            return None
+        return self.keepalive.rtt
 
     def isConnected(self):
         return self.connected == 1
@@ -342,19 +628,51 @@ class MsgpackStreamProtocol(protocol.Protocol, policies.TimeoutMixin, MsgpackBas
     def getClientContext(self):
         return None
 
+    def getClientProxy(self):
+        """
+        Return L{ClientProxy} calling methods of peer of this connection.
+        Remote methods of server decorated by C{server.passConnection} get
+        the connection by keyword argument C{connection}.
+        """
+        return ClientProxy(self)
+
+    def getPeerKey(self, context):
+        if self._peerKey is None:
+            peer = self.transport.getPeer()
+            host = getattr(peer, 'host', None)
+            if host:
+                self._peerKey = host
+            else:
+                # clients of UNIX sockets have no address, every connection
+                # is a peer of its own
+                self._peerKey = '%s@%x' % (peer.__class__.__name__, id(self))
+        return self._peerKey
+
     def dataReceived(self, data):
-        self.resetTimeout()
+        if self.keepalive is None:
+            self.resetTimeout()
 
         self.rawDataReceived(data)
 
+    def messageReceived(self, message, context):
+        if self.keepalive is not None and not self.keepalive.isAnswer(message):
+            # answer of probe doesn't mean that requests are answered, it
+            # mustn't hide requests stuck on live connection
+            self.resetTimeout()
+        return super(MsgpackStreamProtocol, self).messageReceived(message, context)
+
     def connectionMade(self):
         # log.msg("connectionMade", logLevel=logging.DEBUG)
         self.connected = 1
+        if self.keepalive is not None:
+            self.keepalive.start()
         self.factory.addConnection(self)
 
     def connectionLost(self, reason=protocol.connectionDone):
         # log.msg("connectionLost", logLevel=logging.DEBUG)
         self.connected = 0
+        if self.keepalive is not None:
+            self.keepalive.stop()
         self.factory.delConnection(self)
 
         self.callbackOutgoingRequests(lambda d: d.errback(reason))
@@ -374,7 +692,8 @@ class MsgpackDatagramProtocol(protocol.DatagramProtocol, MsgpackBaseProtocol):
     msgpack rpc client/server datagram protocol
     """
     def __init__(self, address=None, handler=None, sendErrors=False, timeout=None, packerEncoding="utf-8",
-                 unpackerEncoding="utf-8", useList=True):
+                 unpackerEncoding="utf-8", useList=True, retransmitInterval=None, retransmitBackoff=2,
+                 maxRetransmits=5, responseCache=None, mtu=None, reassembler=None, clock=None, **kwargs):
         """
         @param address: tuple(host,port) containing address of client where protocol will connect to.
         @type address: C{tuple}.
@@ -390,8 +709,26 @@ class MsgpackDatagramProtocol(protocol.DatagramProtocol, MsgpackBaseProtocol):
         @type unpackerEncoding: C{str}.
         @param useList: If true, unpack msgpack array to Python list.  Otherwise, unpack to Python tuple.
         @type useList: C{bool}.
+        @param retransmitInterval: seconds after which unanswered request is sent again. The interval is
+            multiplied by C{retransmitBackoff} after each retransmission and requests are not retransmitted
+            after C{timeout} would expire. Default is None, i.e. requests are sent once.
+        @type retransmitInterval: C{float}
+        @param retransmitBackoff: multiplier of retransmission interval. Default is 2.
+        @type retransmitBackoff: C{float}
+        @param maxRetransmits: maximum number of retransmissions of one request. Default is 5.
+        @type maxRetransmits: C{int}
+        @param responseCache: cache of responses used to answer retransmitted requests without executing them again.
+        @type responseCache: C{reliable.ResponseCache}
+        @param mtu: maximum size of sent datagram in bytes, larger messages are split to fragments. Default is None,
+            i.e. every message is sent in one datagram. 1472 fits into Ethernet frame with IPv4 and UDP headers.
+        @type mtu: C{int}
+        @param reassembler: buffer of fragments of received messages. Default is C{fragment.Reassembler} with
+            default limits created when the first fragment is received.
+        @type reassembler: C{fragment.Reassembler}
+        @param clock: provider of C{IReactorTime} used for timeouts. Default is reactor.
+        @param kwargs: other options of L{MsgpackBaseProtocol}.
         """
-        super(MsgpackDatagramProtocol, self).__init__(sendErrors, packerEncoding, unpackerEncoding, useList)
+        super(MsgpackDatagramProtocol, self).__init__(sendErrors, packerEncoding, unpackerEncoding, useList, **kwargs)
 
         if address:
             if not isinstance(address, tuple) or len(address) != 2:
@@ -400,17 +737,35 @@ class MsgpackDatagramProtocol(protocol.DatagramProtocol, MsgpackBaseProtocol):
         else:
             self.conn_address = None
 
+        if clock is None:
+            from twisted.internet import reactor as clock
+
         self.handler = handler
         self.timeout = timeout
+        self.retransmitInterval = retransmitInterval
+        self.retransmitBackoff = retransmitBackoff
+        self.maxRetransmits = maxRetransmits
+        self.retransmits = 0
+        self.clock = clock
         self.connected = 0
         self._pendingTimeouts = {}
+        self._pendingRetransmits = {} if retransmitInterval else None
+        self._responseCache = responseCache
+        self.mtu = mtu
+        self._reassembler = reassembler
+        self._fragmentedId = 0
 
     def isConnected(self):
         return self.connected == 1
 
     def writeRawData(self, message, context):
         # transport.write returns None
-        self.transport.write(message, context.peer)
+        if self.mtu is None or len(message) <= self.mtu:
+            self.transport.write(message, context.peer)
+        else:
+            self._fragmentedId = (self._fragmentedId + 1) & 0xFFFFFFFF
+            for datagram in fragment(message, self._fragmentedId, self.mtu):
+                self.transport.write(datagram, context.peer)
 
     def getRemoteMethod(self, protocol, methodName):
         return getattr(self.handler, "remote_" + methodName)
@@ -418,6 +773,9 @@ class MsgpackDatagramProtocol(protocol.DatagramProtocol, MsgpackBaseProtocol):
     def getClientContext(self):
         return Context(peer=self.conn_address)
 
+    def getPeerKey(self, context):
+        return context.peer[0]
+
     def createRequest(self, method, *params):
         """
         Create new RPC request. If protocol is not connected, errback with
@@ -441,22 +799,64 @@ class MsgpackDatagramProtocol(protocol.DatagramProtocol, MsgpackBaseProtocol):
         # methods defined by connection handlers
         return super(MsgpackDatagramProtocol, self).createRequest(method, params)
 
-    def writeMessage(self, message, context):
-        if self.timeout:
+    def writeMessage(self, message, context, timing=None, data=None):
+        msgType = message[0]
+        if msgType == MSGTYPE_REQUEST:
             msgid = message[1]
-            from twisted.internet import reactor
-            dc = reactor.callLater(self.timeout, self.timeoutRequest, msgid)
-            self._pendingTimeouts[msgid] = dc
-
-        return super(MsgpackDatagramProtocol, self).writeMessage(message, context)
+            if self.timeout:
+                dc = self.clock.callLater(self.timeout, self.timeoutRequest, msgid)
+                self._pendingTimeouts[msgid] = dc
+            if self._pendingRetransmits is not None:
+                if data is None:
+                    data = packMessage(self._packer, message, self._sendErrors)
+                self._scheduleRetransmit(msgid, data, context, self.retransmitInterval, 0, 0)
+        elif msgType == MSGTYPE_RESPONSE and self._responseCache is not None:
+            if data is None:
+                data = packMessage(self._packer, message, self._sendErrors)
+            self._responseCache.responseWritten(context.peer, message[1], data)
+
+        return super(MsgpackDatagramProtocol, self).writeMessage(message, context, timing, data)
+
+    def _scheduleRetransmit(self, msgid, data, context, interval, elapsed, count):
+        if count >= self.maxRetransmits or (self.timeout and elapsed + interval >= self.timeout):
+            return
+        dc = self.clock.callLater(interval, self._retransmit, msgid, data, context, interval, elapsed + interval,
+                                  count + 1)
+        self._pendingRetransmits[msgid] = dc
 
-    def responseReceived(self, message):
-        msgid = message[1]
-        dc = self._pendingTimeouts.get(msgid)
-        if dc is not None:
+    def _retransmit(self, msgid, data, context, interval, elapsed, count):
+        del self._pendingRetransmits[msgid]
+        if msgid not in self._outgoing_requests or not self.isConnected():
+            return
+        self.retransmits += 1
+        if self._metrics is not None:
+            self._metrics.bytesOut += len(data)
+        self.writeRawData(data, context)
+        self._scheduleRetransmit(msgid, data, context, interval * self.retransmitBackoff, elapsed, count)
+
+    def _cancelPending(self, msgid):
+        dc = self._pendingTimeouts.pop(msgid, None)
+        if dc is not None and dc.active():
             dc.cancel()
+        if self._pendingRetransmits is not None:
+            dc = self._pendingRetransmits.pop(msgid, None)
+            if dc is not None:
+                dc.cancel()
 
-        return super(MsgpackDatagramProtocol, self).responseReceived(message)
+    def requestReceived(self, message, context):
+        if self._responseCache is not None and len(message) == 4:
+            cached = self._responseCache.requestReceived(context.peer, message[1])
+            if cached is not None:
+                # duplicate of retransmitted request
+                if cached is not PENDING:
+                    self.writeRawData(cached, context)
+                return None
+        return super(MsgpackDatagramProtocol, self).requestReceived(message, context)
+
+    def responseReceived(self, message, context=None):
+        self._cancelPending(message[1])
+
+        return super(MsgpackDatagramProtocol, self).responseReceived(message, context)
 
     def startProtocol(self):
         if self.conn_address:
@@ -465,6 +865,12 @@ class MsgpackDatagramProtocol(protocol.DatagramProtocol, MsgpackBaseProtocol):
         self.connected = 1
 
     def datagramReceived(self, data, address):
+        if isFragment(data):
+            if self._reassembler is None:
+                self._reassembler = Reassembler(clock=self.clock)
+            data = self._reassembler.feed(address, data)
+            if data is None:
+                return
         ctx = Context(peer=address)
         self.rawDataReceived(data, ctx)
 
@@ -476,6 +882,7 @@ class MsgpackDatagramProtocol(protocol.DatagramProtocol, MsgpackBaseProtocol):
 
     def timeoutRequest(self, msgid):
         # log.msg("timeoutRequest", logLevel=logging.DEBUG)
+        self._cancelPending(msgid)
         try:
             d = self._outgoing_requests.pop(msgid)
             d.errback(TimeoutError("Request timed out"))
@@ -484,6 +891,10 @@ class MsgpackDatagramProtocol(protocol.DatagramProtocol, MsgpackBaseProtocol):
 
     def closeConnection(self):
         self.connected = 0
+        if self._pendingRetransmits:
+            for dc in self._pendingRetransmits.values():
+                dc.cancel()
+            self._pendingRetransmits.clear()
         self.transport.stopListening()
 
 
@@ -492,7 +903,7 @@ class MsgpackMulticastDatagramProtocol(MsgpackDatagramProtocol, MsgpackBaseProto
     msgpack rpc client/server multicast datagram protocol
     """
     def __init__(self, group, ttl, port=None, timeout=30, handler=None, sendErrors=False, packerEncoding="utf-8",
-                 unpackerEncoding="utf-8", useList=True):
+                 unpackerEncoding="utf-8", useList=True, completion=None, **kwargs):
         """
         @param group: IP of multicast group that will be joined.
         @type group: C{str}.
@@ -500,7 +911,8 @@ class MsgpackMulticastDatagramProtocol(MsgpackDatagramProtocol, MsgpackBaseProto
         @type ttl: C{int}.
         @param port: port where client will send packets.
         @type port: C{int}.
-        @param timeout: timeout of client's requests. Protocol always wait for responses until timeout expires. Default is 30 seconds.
+        @param timeout: timeout of client's requests. Protocol waits for responses until timeout expires unless
+            completion policy is satisfied earlier. Default is 30 seconds.
         @type timeout: C{int}.
         @param handler: object of RPC server that will process requests and notifications.
         @type handler: C{server.MsgpackRPCServer}
@@ -514,26 +926,68 @@ class MsgpackMulticastDatagramProtocol(MsgpackDatagramProtocol, MsgpackBaseProto
         @type unpackerEncoding: C{str}.
         @param useList: If true, unpack msgpack array to Python list.  Otherwise, unpack to Python tuple.
         @type useList: C{bool}.
+        @param completion: default policy deciding when request is complete and collected results are delivered.
+            Default is None, i.e. results are delivered when request times out.
+        @type completion: C{completion.CompletionPolicy}
+        @param kwargs: other options of L{MsgpackDatagramProtocol} and L{MsgpackBaseProtocol}.
         """
+        if kwargs.get('retransmitInterval'):
+            # servers that already responded would respond to retransmitted request again
+            raise ValueError('Retransmission is not supported by multicast protocol')
         super(MsgpackMulticastDatagramProtocol, self).__init__(handler=handler, timeout=timeout, sendErrors=sendErrors,
-            packerEncoding=packerEncoding, unpackerEncoding=unpackerEncoding, useList=useList)
+            packerEncoding=packerEncoding, unpackerEncoding=unpackerEncoding, useList=useList, **kwargs)
 
         self.group = group
         self.ttl = ttl
         self.port = port
 
+        self.completion = completion
+        self._requestCompletion = None
         self._multicast_results = defaultdict(deque)
+        # msgid -> [policy, responders, quiet period timer]
+        self._completions = {}
 
     def getClientContext(self):
         return Context(peer=(self.group, self.port))
 
-    def responseReceived(self, message):
+    def createRequest(self, method, *params, **kwargs):
+        """
+        Create new RPC request. Deferred callbacks with tuple of results
+        collected until C{completion} policy is satisfied or request times
+        out. See L{MsgpackDatagramProtocol.createRequest}.
+
+        @param completion: policy deciding when request is complete, keyword
+            only. Default is policy given to protocol.
+        @type completion: C{completion.CompletionPolicy}
+        """
+        completion = kwargs.pop('completion', None)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kwargs))
+        if completion is None:
+            return super(MsgpackMulticastDatagramProtocol, self).createRequest(method, *params)
+        if self._interceptors is None:
+            return self._sendRequestWithCompletion(method, params, completion)
+        call = Call(ROLE_CLIENT, method, params, self.getClientContext(), protocol=self)
+        return self._interceptors.execute(
+            call, lambda call: self._sendRequestWithCompletion(call.method, call.params, completion))
+
+    def _sendRequestWithCompletion(self, method, params, completion):
+        # policy is picked up by writeMessage of the request
+        self._requestCompletion = completion
         try:
-            (msgType, msgid, error, result) = message
-        except Exception as e:
-            if self._sendErrors:
-                raise
-            raise InvalidResponse("Failed to unpack response: %s" % e)
+            return self.sendRequest(method, params)
+        finally:
+            self._requestCompletion = None
+
+    def writeMessage(self, message, context, timing=None, data=None):
+        if message[0] == MSGTYPE_REQUEST:
+            completion = self._requestCompletion or self.completion
+            if completion is not None:
+                self._completions[message[1]] = [completion, [], None]
+        return super(MsgpackMulticastDatagramProtocol, self).writeMessage(message, context, timing, data)
+
+    def responseReceived(self, message, context=None):
+        msgid, error, result = unpackResponse(message, self._sendErrors)
 
         if msgid not in self._outgoing_requests:
             # Response can be delivered after timeout, code below is for debugging
@@ -544,13 +998,33 @@ class MsgpackMulticastDatagramProtocol(MsgpackDatagramProtocol, MsgpackBaseProto
             # The remote host returned an error, so we need to create a Failure
             # object to pass into the errback chain. The Failure object in turn
             # requires an Exception
-            ex = ResponseError(error)
+            ex = unpackError(error)
             self._multicast_results[msgid].append(failure.Failure(exc_value=ex))
         else:
             self._multicast_results[msgid].append(result)
 
-    def timeoutRequest(self, msgid):
-        # log.msg("timeoutRequest", logLevel=logging.DEBUG)
+        state = self._completions.get(msgid)
+        if state is None:
+            return
+        completion, responders, dc = state
+        responders.append(context.peer if context is not None else None)
+        if completion.isSatisfied(responders):
+            self.completeRequest(msgid)
+        elif completion.quietPeriod is not None:
+            if dc is None:
+                state[2] = self.clock.callLater(completion.quietPeriod, self.completeRequest, msgid)
+            else:
+                dc.reset(completion.quietPeriod)
+
+    def completeRequest(self, msgid):
+        """
+        Deliver results collected so far. Request errbacks with
+        C{TimeoutError} if no response was received.
+        """
+        self._cancelPending(msgid)
+        state = self._completions.pop(msgid, None)
+        if state is not None and state[2] is not None and state[2].active():
+            state[2].cancel()
         try:
             try:
                 d = self._outgoing_requests.pop(msgid)
@@ -568,10 +1042,14 @@ class MsgpackMulticastDatagramProtocol(MsgpackDatagramProtocol, MsgpackBaseProto
             if msgid in self._multicast_results:
                 del self._multicast_results[msgid]
 
+    def timeoutRequest(self, msgid):
+        # log.msg("timeoutRequest", logLevel=logging.DEBUG)
+        self.completeRequest(msgid)
+
     def startProtocol(self):
         self.transport.setTTL(self.ttl)
         self.transport.joinGroup(self.group)
         self.connected = 1
 
 
-__all__ = ['MsgpackStreamProtocol', 'MsgpackDatagramProtocol', 'MsgpackMulticastDatagramProtocol']
+__all__ = ['MsgpackStreamProtocol', 'MsgpackDatagramProtocol', 'MsgpackMulticastDatagramProtocol', 'ClientProxy']
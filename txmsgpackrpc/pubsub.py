@@ -0,0 +1,299 @@
+"""
+Topic-based publish/subscribe over stream connections.
+
+Clients subscribe topics by reserved RPC methods C{__subscribe__} and
+C{__unsubscribe__}. Server publishes message to topic by L{Broker.publish},
+which packs notification C{__event__ [topic, message]} once and writes the
+same bytes to every subscribed connection.
+
+Each subscribed connection has its own bounded queue. While transport of the
+connection has full write buffer (it paused the broker as its producer),
+published messages are queued. When the queue is full, the oldest message is
+dropped (L{DROP}) or the connection is aborted (L{DISCONNECT}).
+"""
+import functools
+from collections import deque
+
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log
+from zope.interface import implementer
+
+from txmsgpackrpc.core import MSGTYPE_NOTIFICATION, createPacker, packMessage
+
+
+SUBSCRIBE_METHOD = '__subscribe__'
+UNSUBSCRIBE_METHOD = '__unsubscribe__'
+EVENT_METHOD = '__event__'
+
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+
+
+@implementer(IPushProducer)
+class _Channel(object):
+    """
+    Subscribed topics and queue of published messages of one connection.
+    Channel is registered as streaming producer of transport, so it learns
+    when the transport can't send data as fast as they are published.
+    """
+    def __init__(self, broker, protocol):
+        self.broker = broker
+        self.protocol = protocol
+        self.topics = set()
+        self.queue = deque()
+        self.paused = False
+        self.dropped = 0
+        self._registered = False
+        try:
+            protocol.transport.registerProducer(self, True)
+            self._registered = True
+        except (AttributeError, RuntimeError):
+            # transport doesn't support producers or it has one already,
+            # messages are buffered by transport
+            pass
+
+    def write(self, data):
+        if not self.paused and not self.queue:
+            self.protocol.writeRawData(data, None)
+            return True
+
+        queue = self.queue
+        if len(queue) >= self.broker.maxQueue:
+            if self.broker.overflow == DISCONNECT:
+                self.broker.overflowed(self)
+                return False
+            queue.popleft()
+            self.dropped += 1
+            self.broker.dropped += 1
+        queue.append(data)
+        return True
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        queue = self.queue
+        while queue and not self.paused:
+            self.protocol.writeRawData(queue.popleft(), None)
+
+    def stopProducing(self):
+        self.paused = True
+        self.queue.clear()
+
+    def close(self):
+        # queued messages are left to buffer of transport
+        queue = self.queue
+        while queue:
+            self.protocol.writeRawData(queue.popleft(), None)
+        if self._registered:
+            self._registered = False
+            self.protocol.transport.unregisterProducer()
+
+
+class Broker(object):
+    """
+    Registry of topics and their subscribed connections. Set it as
+    C{broker} of C{server.MsgpackRPCServer} before its stream factory is
+    created, or pass it to C{factory.MsgpackServerFactory}.
+
+    @ivar published: number of published messages.
+    @ivar delivered: number of messages written or queued to subscribers.
+    @ivar dropped: number of queued messages dropped by overflow.
+    @ivar disconnected: number of subscribers disconnected by overflow.
+    """
+    def __init__(self, maxQueue=1000, overflow=DROP, packerEncoding="utf-8"):
+        """
+        @param maxQueue: maximum number of messages queued for one
+            subscriber whose transport can't keep up. Default is 1000.
+        @type maxQueue: C{int}
+        @param overflow: what happens when queue of subscriber is full,
+            L{DROP} drops the oldest queued message, L{DISCONNECT} aborts
+            connection of subscriber. Default is L{DROP}.
+        @type overflow: C{str}
+        @param packerEncoding: encoding used to encode Python str and unicode. Default is 'utf-8'.
+        @type packerEncoding: C{str}
+        """
+        if overflow not in (DROP, DISCONNECT):
+            raise ValueError('Unknown overflow policy %r' % (overflow,))
+        self.maxQueue = maxQueue
+        self.overflow = overflow
+        self.topics = {}
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.disconnected = 0
+        self._channels = {}
+        self._packer = createPacker(packerEncoding)
+
+    def remoteMethod(self, protocol, methodName):
+        """
+        Return reserved RPC method C{methodName} bound to C{protocol}.
+        """
+        if methodName == SUBSCRIBE_METHOD:
+            return functools.partial(self.subscribe, protocol)
+        if methodName == UNSUBSCRIBE_METHOD:
+            return functools.partial(self.unsubscribe, protocol)
+        raise AttributeError(methodName)
+
+    def subscribe(self, protocol, topic):
+        """
+        Subscribe C{protocol} to C{topic}. Returns True if the protocol
+        wasn't subscribed yet.
+        """
+        channel = self._channels.get(protocol)
+        if channel is None:
+            channel = self._channels[protocol] = _Channel(self, protocol)
+        if topic in channel.topics:
+            return False
+        channel.topics.add(topic)
+        self.topics.setdefault(topic, []).append(channel)
+        return True
+
+    def unsubscribe(self, protocol, topic):
+        """
+        Unsubscribe C{protocol} from C{topic}. Returns True if the protocol
+        was subscribed.
+        """
+        channel = self._channels.get(protocol)
+        if channel is None or topic not in channel.topics:
+            return False
+        channel.topics.discard(topic)
+        self._removeFromTopic(channel, topic)
+        if not channel.topics:
+            del self._channels[protocol]
+            channel.close()
+        return True
+
+    def _removeFromTopic(self, channel, topic):
+        channels = self.topics[topic]
+        channels.remove(channel)
+        if not channels:
+            del self.topics[topic]
+
+    def connectionLost(self, protocol):
+        channel = self._channels.pop(protocol, None)
+        if channel is None:
+            return
+        for topic in channel.topics:
+            self._removeFromTopic(channel, topic)
+        channel.topics.clear()
+        channel.queue.clear()
+
+    def overflowed(self, channel):
+        self.disconnected += 1
+        self.connectionLost(channel.protocol)
+        transport = channel.protocol.transport
+        if hasattr(transport, 'abortConnection'):
+            transport.abortConnection()
+        else:
+            transport.loseConnection()
+
+    def subscribers(self, topic):
+        """
+        Return number of connections subscribed to C{topic}.
+        """
+        return len(self.topics.get(topic, ()))
+
+    def publish(self, topic, message):
+        """
+        Send C{message} to all subscribers of C{topic}. Message is serialized
+        only once.
+
+        @param topic: name of topic.
+        @type topic: C{str}
+        @param message: any msgpack serializable object.
+        @return number of subscribers the message was written or queued to.
+        @rtype C{int}
+        """
+        self.published += 1
+        channels = self.topics.get(topic)
+        if not channels:
+            return 0
+        data = packMessage(self._packer, (MSGTYPE_NOTIFICATION, EVENT_METHOD, [topic, message]))
+        delivered = 0
+        for channel in list(channels):
+            if channel.write(data):
+                delivered += 1
+        self.delivered += delivered
+        return delivered
+
+
+class Subscriber(object):
+    """
+    Client side of publish/subscribe. Pass it to C{client.connect},
+    C{client.connect_pool} or C{client.connect_UNIX} as C{subscriber}.
+    Topics are subscribed on one connection of the client, when the
+    connection is lost they are subscribed again on another one.
+    """
+    def __init__(self):
+        self.callbacks = {}
+        self.connection = None
+        self._connections = []
+
+    def subscribe(self, topic, callback):
+        """
+        Call C{callback(topic, message)} for every message published to
+        C{topic}. Returns Deferred that callbacks when the server confirms
+        subscription, or immediately if client isn't connected, the topic is
+        subscribed when connection is made.
+        """
+        callbacks = self.callbacks.get(topic)
+        if callbacks is not None:
+            callbacks.append(callback)
+            return defer.succeed(None)
+        self.callbacks[topic] = [callback]
+        return self._call(SUBSCRIBE_METHOD, topic)
+
+    def unsubscribe(self, topic, callback=None):
+        """
+        Remove C{callback} of C{topic}, or all callbacks if it is None. The
+        topic is unsubscribed when it has no callbacks left.
+        """
+        callbacks = self.callbacks.get(topic)
+        if callbacks is None:
+            return defer.succeed(None)
+        if callback is not None:
+            callbacks.remove(callback)
+            if callbacks:
+                return defer.succeed(None)
+        del self.callbacks[topic]
+        return self._call(UNSUBSCRIBE_METHOD, topic)
+
+    def _call(self, method, topic):
+        if self.connection is None:
+            return defer.succeed(None)
+        try:
+            return self.connection.createRequest(method, [topic])
+        except Exception:
+            return defer.fail()
+
+    def connectionMade(self, connection):
+        self._connections.append(connection)
+        if self.connection is None:
+            self._useConnection(connection)
+
+    def connectionLost(self, connection):
+        if connection in self._connections:
+            self._connections.remove(connection)
+        if connection is self.connection:
+            self.connection = None
+            if self._connections:
+                self._useConnection(self._connections[0])
+
+    def _useConnection(self, connection):
+        self.connection = connection
+        for topic in list(self.callbacks):
+            self._call(SUBSCRIBE_METHOD, topic).addErrback(log.err, 'Cannot subscribe topic %s' % topic)
+
+    def eventReceived(self, topic, message):
+        for callback in list(self.callbacks.get(topic, ())):
+            try:
+                callback(topic, message)
+            except Exception:
+                log.err(None, 'Subscriber callback of topic %s failed' % topic)
+
+
+__all__ = ['Broker', 'Subscriber', 'DROP', 'DISCONNECT', 'SUBSCRIBE_METHOD', 'UNSUBSCRIBE_METHOD',
+           'EVENT_METHOD']
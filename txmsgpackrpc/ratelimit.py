@@ -0,0 +1,174 @@
+from collections import OrderedDict, defaultdict
+
+
+class ExpiringTable(object):
+    """
+    Bounded mapping of keys to values. Entries that were not accessed for
+    C{ttl} seconds expire and least recently used entries are evicted when
+    the table grows over C{maxsize}. Expired entries are purged
+    incrementally on insert, so the table never needs a timer.
+
+    All methods take the current time as argument, so the caller can read
+    the clock once for several operations.
+    """
+    def __init__(self, maxsize=100000, ttl=60):
+        """
+        @param maxsize: maximum number of entries in the table.
+        @type maxsize: C{int}
+        @param ttl: number of seconds after which unused entry expires.
+        @type ttl: C{int} or C{float}
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> [value, last access time]; ordered from least recently used
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, now, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        if now - entry[1] > self.ttl:
+            return default
+        entry[1] = now
+        self._entries[key] = entry
+        return entry[0]
+
+    def set(self, key, value, now):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.expire(now, limit=2)
+            while len(self._entries) >= self.maxsize:
+                self._entries.popitem(last=False)
+        self._entries[key] = [value, now]
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def expire(self, now, limit=None):
+        """
+        Remove expired entries, at most C{limit} of them if it is set.
+        """
+        entries = self._entries
+        deadline = now - self.ttl
+        removed = 0
+        while entries and (limit is None or removed < limit):
+            key = next(iter(entries))
+            if entries[key][1] >= deadline:
+                break
+            del entries[key]
+            removed += 1
+        return removed
+
+    def clear(self):
+        self._entries.clear()
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiter for RPC servers. Requests are limited per peer
+    and optionally per peer and method. Each bucket is refilled by C{rate}
+    tokens per second up to C{burst} tokens and each request consumes one
+    token. Buckets of idle peers expire, so memory usage is bounded by
+    C{maxPeers} regardless of number of distinct peers. Peers of stream
+    connections are told apart by host, clients of UNIX sockets by
+    connection.
+
+    Rejected requests are counted in C{rejected} and C{rejectedByMethod}.
+    """
+    def __init__(self, rate=None, burst=None, methodLimits=None, maxPeers=100000, idleTimeout=60, clock=None):
+        """
+        @param rate: number of requests per second allowed for each peer. If
+            None, requests are limited only per method. Default is None.
+        @type rate: C{int} or C{float}
+        @param burst: maximum number of requests that peer can send at once.
+            Default is C{rate}.
+        @type burst: C{int}
+        @param methodLimits: limits applied per peer and method, mapping
+            of method name to C{rate} or tuple(C{rate}, C{burst}).
+        @type methodLimits: C{dict}
+        @param maxPeers: maximum number of buckets kept in memory. Least
+            recently used buckets are dropped first. Default is 100000.
+        @type maxPeers: C{int}
+        @param idleTimeout: number of seconds after which bucket of idle peer
+            is dropped. Default is 60 seconds.
+        @type idleTimeout: C{int}
+        @param clock: provider of current time. Default is reactor.
+        @type clock: C{t.i.i.IReactorTime}
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+
+        self.methodLimits = {}
+        for method, limit in (methodLimits or {}).items():
+            if isinstance(limit, (tuple, list)):
+                methodRate, methodBurst = limit
+            else:
+                methodRate, methodBurst = limit, limit
+            self.methodLimits[method] = (methodRate, methodBurst)
+
+        self._peers = ExpiringTable(maxPeers, idleTimeout)
+        self._methods = ExpiringTable(maxPeers, idleTimeout)
+
+        self.rejected = 0
+        self.rejectedByMethod = defaultdict(int)
+
+    def _refill(self, table, key, rate, burst, now):
+        bucket = table.get(key, now)
+        if bucket is None:
+            bucket = [burst, now]
+            table.set(key, bucket, now)
+        else:
+            tokens = bucket[0] + (now - bucket[1]) * rate
+            bucket[0] = tokens if tokens < burst else burst
+            bucket[1] = now
+        return bucket
+
+    def allow(self, peer, method):
+        """
+        Consume one token of peer's buckets.
+
+        @param peer: identification of peer, e.g. its IP address.
+        @type peer: hashable object
+        @param method: RPC method name.
+        @type method: C{str}
+        @return True if request may be dispatched, False if it must be rejected.
+        @rtype C{bool}
+        """
+        now = self.clock.seconds()
+
+        peerBucket = None
+        if self.rate is not None:
+            peerBucket = self._refill(self._peers, peer, self.rate, self.burst, now)
+
+        methodBucket = None
+        limit = self.methodLimits.get(method)
+        if limit is not None:
+            methodBucket = self._refill(self._methods, (peer, method), limit[0], limit[1], now)
+
+        if (peerBucket is not None and peerBucket[0] < 1) or \
+                (methodBucket is not None and methodBucket[0] < 1):
+            self.rejected += 1
+            self.rejectedByMethod[method] += 1
+            return False
+
+        if peerBucket is not None:
+            peerBucket[0] -= 1
+        if methodBucket is not None:
+            methodBucket[0] -= 1
+        return True
+
+
+__all__ = ['ExpiringTable', 'RateLimiter']
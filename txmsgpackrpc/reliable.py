@@ -0,0 +1,57 @@
+from txmsgpackrpc.ratelimit import ExpiringTable
+
+
+# marker of request whose response is not ready yet
+PENDING = object()
+
+
+class ResponseCache(object):
+    """
+    Cache of responses of datagram server keyed by (peer address, msgid).
+    Retransmitted requests are recognized as duplicates and instead of
+    executing the method again, the cached response is sent back, or the
+    duplicate is dropped if the original request is still processed.
+
+    Entries expire after C{ttl} seconds, which should be longer than the
+    time clients retransmit requests, and least recently used entries are
+    evicted when the cache grows over C{maxsize}.
+    """
+    def __init__(self, maxsize=10000, ttl=60, clock=None):
+        """
+        @param maxsize: maximum number of cached responses. Default is 10000.
+        @type maxsize: C{int}
+        @param ttl: number of seconds responses are cached. Default is 60.
+        @type ttl: C{int} or C{float}
+        @param clock: provider of C{IReactorTime}. Default is reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.duplicates = 0
+        self._table = ExpiringTable(maxsize, ttl)
+
+    def __len__(self):
+        return len(self._table)
+
+    def requestReceived(self, peer, msgid):
+        """
+        Register request. Returns None for new request, L{PENDING} for
+        duplicate of request that is being processed, or serialized response
+        that must be sent again.
+        """
+        key = (peer, msgid)
+        now = self.clock.seconds()
+        cached = self._table.get(key, now)
+        if cached is None:
+            self._table.set(key, PENDING, now)
+            return None
+        self.duplicates += 1
+        return cached
+
+    def responseWritten(self, peer, msgid, data):
+        key = (peer, msgid)
+        if key in self._table:
+            self._table.set(key, data, self.clock.seconds())
+
+
+__all__ = ['ResponseCache', 'PENDING']
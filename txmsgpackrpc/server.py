@@ -1,3 +1,4 @@
+from txmsgpackrpc.core     import passConnection
 from txmsgpackrpc.factory  import MsgpackServerFactory
 from txmsgpackrpc.protocol import MsgpackDatagramProtocol, MsgpackMulticastDatagramProtocol
 
@@ -10,31 +11,48 @@ class MsgpackRPCServer(object):
     It contains methods to generate factory and protocol objects that should
     be passed to reactor's listen* methods. Generated objects are binded with
     server.
+
+    @ivar broker: topics of publish/subscribe, set it to C{pubsub.Broker} to
+        let clients subscribe to topics of stream factories created later.
     """
+    broker = None
 
-    def getStreamFactory(self, factory_class=MsgpackServerFactory):
+    def getStreamFactory(self, factory_class=MsgpackServerFactory, **kwargs):
         """
         Generate factory object for TCP, SSL and UNIX sockets.
 
         @param factory_class: factory class to be instantiated. Default is C{MsgpackServerFactory}.
         @type factory_class: C{type}.
+        @param kwargs: options passed to factory, e.g. C{rateLimiter}.
         @return factory object
         @rtype C{t.i.p.Factory}
         """
-        return factory_class(self)
+        if self.broker is not None:
+            kwargs.setdefault('broker', self.broker)
+        return factory_class(self, **kwargs)
+
+    def publish(self, topic, message):
+        """
+        Send C{message} to all clients subscribed to C{topic}. See
+        C{pubsub.Broker.publish}.
+        """
+        if self.broker is None:
+            raise ValueError('Publishing requires broker')
+        return self.broker.publish(topic, message)
 
-    def getDatagramProtocol(self, protocol_class=MsgpackDatagramProtocol):
+    def getDatagramProtocol(self, protocol_class=MsgpackDatagramProtocol, **kwargs):
         """
         Generate protocol object for UDP sockets.
 
         @param factory_class: protocol class to be instantiated. Default is C{MsgpackDatagramProtocol}.
         @type factory_class: C{type}.
+        @param kwargs: options passed to protocol, e.g. C{rateLimiter}.
         @return protocol object
         @rtype C{t.i.p.DatagramProtocol}
         """
-        return protocol_class(handler=self)
+        return protocol_class(handler=self, **kwargs)
 
-    def getMulticastProtocol(self, group, ttl=1, protocol_class=MsgpackMulticastDatagramProtocol):
+    def getMulticastProtocol(self, group, ttl=1, protocol_class=MsgpackMulticastDatagramProtocol, **kwargs):
         """
         Generate protocol object for multicast UDP sockets.
 
@@ -44,10 +62,11 @@ class MsgpackRPCServer(object):
         @type ttl: C{int}.
         @param factory_class: protocol class to be instantiated. Default is C{MsgpackMulticastDatagramProtocol}.
         @type factory_class: C{type}.
+        @param kwargs: options passed to protocol, e.g. C{rateLimiter}.
         @return protocol object
         @rtype C{t.i.p.DatagramProtocol}
         """
-        return protocol_class(group, ttl, handler=self)
+        return protocol_class(group, ttl, handler=self, **kwargs)
 
 
-__all__ = ['MsgpackRPCServer']
+__all__ = ['MsgpackRPCServer', 'passConnection']
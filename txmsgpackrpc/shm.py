@@ -0,0 +1,389 @@
+"""
+Shared-memory transport for processes on the same host.
+
+Both peers of UNIX socket connection use L{SharedMemoryStreamProtocol}. Each
+peer writes its large messages into its own ring buffer in shared memory
+(mmap of anonymous file) and sends only their offset and length over the
+socket. The receiver deserializes message directly from the
+mapped ring and releases the space. Small messages and messages that don't
+fit into free space of the ring are sent over the socket as usual.
+
+Control messages are msgpack extension types, so they are ordered with other
+messages of the stream::
+
+    ATTACH                     ring of sender is ready to be mapped, its
+                               descriptor is passed with the message
+    ATTACHED                   receiver mapped ring of peer
+    FRAME    offset, length    message is stored in ring of sender
+    RELEASE  offset            message at offset was consumed
+
+Client sends ATTACH as the first message of connection, server answers with
+ATTACHED and ATTACH of its own ring. Rings are never reachable by path, peer
+maps only the descriptor it received. Receiver maps only regular files and,
+where the platform supports file seals, only files sealed against shrinking,
+so the sender can't truncate the ring under the mapping.
+"""
+import mmap
+import os
+import stat
+import struct
+import tempfile
+from collections import deque
+
+import msgpack
+from twisted.internet.interfaces import IFileDescriptorReceiver, IUNIXTransport
+from twisted.python import log
+from zope.interface import implementer
+
+from txmsgpackrpc.core import unpackMessage
+from txmsgpackrpc.factory import MsgpackClientFactory, MsgpackServerFactory
+from txmsgpackrpc.protocol import MsgpackStreamProtocol
+
+
+SHM_ATTACH = 0x51
+SHM_ATTACHED = 0x52
+SHM_FRAME = 0x53
+SHM_RELEASE = 0x54
+
+DEFAULT_RING_SIZE = 64 * 1024 * 1024
+DEFAULT_THRESHOLD = 64 * 1024
+
+_FRAME = struct.Struct('>QQ')
+_RELEASE = struct.Struct('>Q')
+
+
+try:
+    import fcntl
+    _F_ADD_SEALS, _F_GET_SEALS = fcntl.F_ADD_SEALS, fcntl.F_GET_SEALS
+    _SEALS = fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW | fcntl.F_SEAL_SEAL
+    _SEAL_SHRINK = fcntl.F_SEAL_SHRINK
+    _memfdCreate = os.memfd_create
+except (ImportError, AttributeError):
+    _F_ADD_SEALS = _F_GET_SEALS = None
+    _memfdCreate = None
+
+
+def _defaultDirectory():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return None
+
+
+def _createRingFile(size, directory):
+    if _memfdCreate is not None:
+        fd = _memfdCreate('txmsgpackrpc-ring', os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+        try:
+            os.ftruncate(fd, size)
+            fcntl.fcntl(fd, _F_ADD_SEALS, _SEALS)
+        except Exception:
+            os.close(fd)
+            raise
+        return fd
+
+    fd, path = tempfile.mkstemp(prefix='txmsgpackrpc-', suffix='.ring', dir=directory or _defaultDirectory())
+    os.unlink(path)
+    try:
+        os.ftruncate(fd, size)
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
+
+class RingWriter(object):
+    """
+    Ring buffer in shared memory owned by sender. Frames are released by
+    receiver in the order they were written.
+
+    @ivar fileno: descriptor of ring file passed to peer, None after
+        L{closeDescriptor}.
+    """
+    def __init__(self, size=DEFAULT_RING_SIZE, directory=None):
+        """
+        @param size: size of ring in bytes.
+        @type size: C{int}
+        @param directory: directory of ring file on platforms without
+            C{memfd_create}, the file is removed right after it is created.
+            Default is C{/dev/shm} if it exists, otherwise default temporary
+            directory.
+        @type directory: C{str}
+        """
+        self.fileno = _createRingFile(size, directory)
+        try:
+            self.mmap = mmap.mmap(self.fileno, size)
+        except Exception:
+            self.closeDescriptor()
+            raise
+        self.size = size
+        self._frames = deque()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def write(self, data):
+        """
+        Copy C{data} into free space of the ring. Returns offset of the frame
+        or None if there is not enough contiguous free space.
+        """
+        length = len(data)
+        frames = self._frames
+        if not frames:
+            offset = 0 if length <= self.size else None
+        else:
+            first = frames[0][0]
+            head = frames[-1][1]
+            if head > first:
+                # free space is after the last frame and before the first one
+                if self.size - head >= length:
+                    offset = head
+                elif first >= length:
+                    offset = 0
+                else:
+                    offset = None
+            elif first - head >= length:
+                offset = head
+            else:
+                offset = None
+
+        if offset is None:
+            return None
+        self.mmap[offset:offset + length] = data
+        frames.append((offset, offset + length))
+        return offset
+
+    def release(self, offset):
+        if not self._frames or self._frames[0][0] != offset:
+            raise ValueError('Released frame at %d is not the oldest one' % offset)
+        self._frames.popleft()
+
+    def closeDescriptor(self):
+        if self.fileno is not None:
+            os.close(self.fileno)
+            self.fileno = None
+
+    def close(self):
+        self.closeDescriptor()
+        self.mmap.close()
+
+
+class RingReader(object):
+    """
+    Read-only mapping of ring of peer.
+    """
+    def __init__(self, fileno):
+        """
+        @param fileno: descriptor of ring file received from peer, the caller
+            closes it.
+        @type fileno: C{int}
+        """
+        info = os.fstat(fileno)
+        if not stat.S_ISREG(info.st_mode) or not info.st_size:
+            raise ValueError('Ring of peer is not a regular file')
+        if _F_GET_SEALS is not None:
+            try:
+                seals = fcntl.fcntl(fileno, _F_GET_SEALS)
+            except (IOError, OSError):
+                seals = 0
+            if not seals & _SEAL_SHRINK:
+                raise ValueError('Ring of peer is not sealed against shrinking')
+        size = info.st_size
+        self.mmap = mmap.mmap(fileno, size, access=mmap.ACCESS_READ)
+        self.size = size
+        self._view = memoryview(self.mmap)
+
+    def read(self, offset, length):
+        if offset + length > self.size:
+            raise ValueError('Frame at %d of %d bytes is out of ring' % (offset, length))
+        return self._view[offset:offset + length]
+
+    def close(self):
+        self._view.release()
+        self.mmap.close()
+
+
+@implementer(IFileDescriptorReceiver)
+class SharedMemoryStreamProtocol(MsgpackStreamProtocol):
+    """
+    Stream protocol that passes messages of at least C{threshold} bytes
+    through shared-memory ring. Both peers must use this protocol.
+    """
+    def __init__(self, factory, ringSize=DEFAULT_RING_SIZE, threshold=DEFAULT_THRESHOLD, directory=None,
+                 initiate=False, **kwargs):
+        """
+        @param factory: factory which created this protocol.
+        @type factory: C{protocol.Factory}.
+        @param ringSize: size of ring of outgoing messages in bytes. Default is 64 MB.
+        @type ringSize: C{int}
+        @param threshold: minimal size of message in bytes that is passed through ring. Default is 64 kB.
+        @type threshold: C{int}
+        @param directory: directory of ring file on platforms without C{memfd_create}. Default is C{/dev/shm}.
+        @type directory: C{str}
+        @param initiate: send ring to peer when connection is made. Client protocols initiate, servers answer.
+        @type initiate: C{bool}
+        @param kwargs: other options of C{protocol.MsgpackStreamProtocol}.
+        """
+        super(SharedMemoryStreamProtocol, self).__init__(factory, **kwargs)
+        self.ringSize = ringSize
+        self.threshold = threshold
+        self.directory = directory
+        self.initiate = initiate
+        self.framesSent = 0
+        self.framesReceived = 0
+        self._ring = None
+        self._ringReady = False
+        self._peerRing = None
+        self._peerDescriptor = None
+
+    def connectionMade(self):
+        # ring is offered before factory lets users send requests
+        if self.initiate:
+            self._attach()
+        super(SharedMemoryStreamProtocol, self).connectionMade()
+
+    def _attach(self):
+        if not IUNIXTransport.providedBy(self.transport):
+            # descriptors can be passed only over UNIX socket
+            return
+        try:
+            self._ring = RingWriter(self.ringSize, self.directory)
+        except Exception:
+            log.err(None, 'Cannot create shared memory ring')
+            return
+        self.transport.sendFileDescriptor(self._ring.fileno)
+        self.transport.write(self._packer.pack(msgpack.ExtType(SHM_ATTACH, b'')))
+
+    def fileDescriptorReceived(self, descriptor):
+        # only descriptor passed with the last ATTACH is used
+        if self._peerDescriptor is not None:
+            os.close(self._peerDescriptor)
+        self._peerDescriptor = descriptor
+
+    def writeRawData(self, message, context):
+        if self._ringReady and len(message) >= self.threshold:
+            offset = self._ring.write(message)
+            if offset is not None:
+                self.framesSent += 1
+                message = self._packer.pack(msgpack.ExtType(SHM_FRAME, _FRAME.pack(offset, len(message))))
+        self.transport.write(message)
+
+    def messageReceived(self, message, context):
+        if type(message) is msgpack.ExtType:
+            return self.controlReceived(message.code, message.data, context)
+        return super(SharedMemoryStreamProtocol, self).messageReceived(message, context)
+
+    def controlReceived(self, code, data, context):
+        if code == SHM_FRAME:
+            offset, length = _FRAME.unpack(data)
+            if self._peerRing is None:
+                raise ValueError('Shared memory frame received before ring was attached')
+            view = self._peerRing.read(offset, length)
+            try:
+                message = unpackMessage(view, self._unpackerEncoding, self._useList)
+            finally:
+                view.release()
+                self.transport.write(self._packer.pack(msgpack.ExtType(SHM_RELEASE, _RELEASE.pack(offset))))
+            self.framesReceived += 1
+            if self._metrics is not None:
+                self._metrics.bytesIn += length
+            return self.messageReceived(message, context)
+
+        if code == SHM_RELEASE:
+            offset, = _RELEASE.unpack(data)
+            self._ring.release(offset)
+        elif code == SHM_ATTACH:
+            descriptor, self._peerDescriptor = self._peerDescriptor, None
+            if descriptor is None:
+                log.msg('Shared memory ring of peer was attached without descriptor')
+                return
+            if self._peerRing is not None:
+                os.close(descriptor)
+                log.msg('Shared memory ring of peer is attached already')
+                return
+            try:
+                self._peerRing = RingReader(descriptor)
+            except Exception:
+                log.err(None, 'Cannot map shared memory ring of peer')
+                return
+            finally:
+                os.close(descriptor)
+            self.transport.write(self._packer.pack(msgpack.ExtType(SHM_ATTACHED, b'')))
+            if not self.initiate and self._ring is None:
+                self._attach()
+        elif code == SHM_ATTACHED:
+            if self._ring is not None:
+                # both peers have the ring mapped
+                self._ring.closeDescriptor()
+                self._ringReady = True
+        else:
+            return self.undefinedMessageReceived(msgpack.ExtType(code, data))
+
+    def connectionLost(self, reason=None):
+        super(SharedMemoryStreamProtocol, self).connectionLost(reason)
+        self._ringReady = False
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+        if self._peerRing is not None:
+            self._peerRing.close()
+            self._peerRing = None
+        if self._peerDescriptor is not None:
+            os.close(self._peerDescriptor)
+            self._peerDescriptor = None
+
+
+class SharedMemoryServerFactory(MsgpackServerFactory):
+    """
+    Factory of server protocols passing large messages through shared memory.
+    Listen with it on UNIX socket, e.g.
+    C{server.getStreamFactory(SharedMemoryServerFactory)}.
+    """
+    protocol = SharedMemoryStreamProtocol
+
+    def __init__(self, handler, ringSize=DEFAULT_RING_SIZE, threshold=DEFAULT_THRESHOLD, directory=None, **kwargs):
+        """
+        @param ringSize: size of ring of each connection in bytes. Default is 64 MB.
+        @type ringSize: C{int}
+        @param threshold: minimal size of message in bytes that is passed through ring. Default is 64 kB.
+        @type threshold: C{int}
+        @param directory: directory of ring files on platforms without C{memfd_create}. Default is C{/dev/shm}.
+        @type directory: C{str}
+        @param kwargs: other options of C{factory.MsgpackServerFactory}.
+        """
+        super(SharedMemoryServerFactory, self).__init__(handler, **kwargs)
+        self.ringSize = ringSize
+        self.threshold = threshold
+        self.directory = directory
+
+    def buildProtocol(self, addr):
+        p = self.protocol(self, sendErrors=True, rateLimiter=self.rateLimiter,
+                          metrics=self.metrics, exposeStats=self.exposeStats,
+                          interceptors=self.interceptors, profiler=self.profiler,
+                          slowLog=self.slowLog, lowMemory=self.lowMemory, ringSize=self.ringSize,
+                          threshold=self.threshold, directory=self.directory)
+        return p
+
+
+class SharedMemoryClientFactory(MsgpackClientFactory):
+    """
+    Factory of client protocols passing large messages through shared memory.
+    """
+    protocol = SharedMemoryStreamProtocol
+
+    def __init__(self, ringSize=DEFAULT_RING_SIZE, threshold=DEFAULT_THRESHOLD, directory=None, **kwargs):
+        super(SharedMemoryClientFactory, self).__init__(**kwargs)
+        self.ringSize = ringSize
+        self.threshold = threshold
+        self.directory = directory
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        p = self.protocol(self, timeout=self.waitTimeout, metrics=self.metrics,
+                          interceptors=self.interceptors, slowLog=self.slowLog,
+                          keepaliveInterval=self.keepaliveInterval, keepaliveTimeout=self.keepaliveTimeout,
+                          clock=self.clock, ringSize=self.ringSize, threshold=self.threshold,
+                          directory=self.directory, initiate=True)
+        return p
+
+
+__all__ = ['SharedMemoryStreamProtocol', 'SharedMemoryServerFactory', 'SharedMemoryClientFactory',
+           'RingWriter', 'RingReader']
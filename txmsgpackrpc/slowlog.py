@@ -0,0 +1,214 @@
+import json
+import logging
+import random
+import threading
+from timeit import default_timer
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from txmsgpackrpc.metrics import ROLE_SERVER
+
+
+# params of request that was not chosen for capture
+_NOT_CAPTURED = object()
+
+
+class RequestTiming(object):
+    """
+    Timestamps of one request recorded by protocol.
+
+    Server requests are timed from reception of data containing the request
+    (C{received}), through dispatch (C{started}), completion of remote method
+    (C{executed}) and serialization of response (C{serialized}) until the
+    response is written to transport (C{written}).
+
+    Client requests are timed from creation (C{started}), through
+    serialization (C{serialized}) and write to transport (C{written}), until
+    the response is received (C{received}) and delivered (C{finished}).
+    """
+    __slots__ = ('role', 'method', 'msgid', 'peer', 'requestSize', 'responseSize', 'params',
+                 'received', 'started', 'executed', 'serialized', 'written', 'finished')
+
+    def __init__(self, role, method, msgid, peer, started, received=None, requestSize=None, params=_NOT_CAPTURED):
+        self.role = role
+        self.method = method
+        self.msgid = msgid
+        self.peer = peer
+        self.requestSize = requestSize
+        self.responseSize = None
+        self.params = params
+        self.received = received
+        self.started = started
+        self.executed = None
+        self.serialized = None
+        self.written = None
+        self.finished = None
+
+    def messageWritten(self, serialized, written, size):
+        self.serialized = serialized
+        self.written = written
+        if self.role == ROLE_SERVER:
+            self.responseSize = size
+        else:
+            self.requestSize = size
+
+    def breakdown(self):
+        """
+        Return dictionary of durations of phases of the request in seconds.
+        For clients, C{execute} is the time spent waiting for response and
+        C{queue} is the time response spent in protocol after it was received.
+        """
+        if self.role == ROLE_SERVER:
+            received = self.received if self.received is not None else self.started
+            return {
+                'total': self.written - received,
+                'queue': self.started - received,
+                'execute': self.executed - self.started,
+                'serialize': self.serialized - self.executed,
+                'write': self.written - self.serialized,
+            }
+        else:
+            received = self.received if self.received is not None else self.finished
+            return {
+                'total': self.finished - self.started,
+                'queue': max(0.0, self.finished - received),
+                'execute': received - self.written,
+                'serialize': self.serialized - self.started,
+                'write': self.written - self.serialized,
+            }
+
+
+class SlowRequestLog(object):
+    """
+    Log of requests whose end-to-end latency exceeds C{threshold}. Records
+    contain method, peer, msgid, sizes of messages and timing breakdown of
+    the request, and for sampled requests also their parameters and result.
+
+    Records are passed to C{writer} by background thread, so writing never
+    blocks the reactor. When writer can't keep up and the queue is full,
+    records are dropped and counted in C{dropped}.
+    """
+    def __init__(self, threshold=1.0, captureRate=0.0, maxPayload=1024, maxQueue=10000, writer=None,
+                 timer=default_timer):
+        """
+        @param threshold: minimal latency of logged requests in seconds.
+            Default is 1 second.
+        @type threshold: C{float}
+        @param captureRate: fraction of logged requests whose parameters and
+            result are captured. Default is 0, i.e. no payload is captured.
+        @type captureRate: C{float}
+        @param maxPayload: maximum length of captured payload representation.
+            Default is 1024 characters.
+        @type maxPayload: C{int}
+        @param maxQueue: maximum number of records waiting for writer.
+            Default is 10000.
+        @type maxQueue: C{int}
+        @param writer: function called with record (C{dict}) in background
+            thread. Default writes JSON record to logger C{txmsgpackrpc.slowlog}
+            with level WARNING.
+        @type writer: C{callable}
+        @param timer: function returning current time in seconds. Default is
+            C{timeit.default_timer}.
+        @type timer: C{callable}
+        """
+        self.threshold = threshold
+        self.captureRate = captureRate
+        self.maxPayload = maxPayload
+        self.writer = writer or self._logRecord
+        self.timer = timer
+
+        self.logged = 0
+        self.dropped = 0
+
+        self._queue = queue.Queue(maxQueue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def startRequest(self, role, method, msgid, peer, received=None, requestSize=None, params=None):
+        # captured params are formatted only if the request turns out slow
+        if not (self.captureRate and random.random() < self.captureRate):
+            params = _NOT_CAPTURED
+        return RequestTiming(role, method, msgid, peer, self.timer(), received, requestSize, params)
+
+    def finishRequest(self, timing, error=None, result=None):
+        if timing.role == ROLE_SERVER:
+            latency = timing.written - (timing.received if timing.received is not None else timing.started)
+        else:
+            latency = timing.finished - timing.started
+        if latency < self.threshold:
+            return
+
+        record = {
+            'role': timing.role,
+            'method': timing.method,
+            'msgid': timing.msgid,
+            'peer': timing.peer if timing.peer is None else str(timing.peer),
+            'request_size': timing.requestSize,
+            'response_size': timing.responseSize,
+            'error': error is not None,
+            'timing': timing.breakdown(),
+        }
+        if timing.params is not _NOT_CAPTURED:
+            record['params'] = self._capture(timing.params)
+            record['result'] = self._capture(error if error is not None else result)
+
+        self.logged += 1
+        self._enqueue(record)
+
+    def _capture(self, payload):
+        text = repr(payload)
+        if len(text) > self.maxPayload:
+            text = text[:self.maxPayload] + '...'
+        return text
+
+    def _enqueue(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='txmsgpackrpc-slowlog')
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    return
+                self.writer(record)
+            except Exception:
+                logging.getLogger('txmsgpackrpc.slowlog').exception('Failed to write slow request record')
+            finally:
+                self._queue.task_done()
+
+    def _logRecord(self, record):
+        logging.getLogger('txmsgpackrpc.slowlog').warning('slow request %s', json.dumps(record, sort_keys=True))
+
+    def flush(self):
+        """
+        Block until all queued records are written.
+        """
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        """
+        Write queued records and stop background thread.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+
+__all__ = ['SlowRequestLog', 'RequestTiming']
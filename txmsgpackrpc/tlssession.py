@@ -0,0 +1,179 @@
+"""
+TLS session resumption of client connections.
+
+Full TLS handshake costs public key operations on both sides and one extra
+round trip. L{TLSSessionCache} remembers the last session negotiated by any
+connection it created and offers it in handshakes of the following ones, so
+the server can resume it (by session ticket or by its session cache) and skip
+the expensive part. Pass the same cache to all connections of a pool, it
+survives their reconnects.
+"""
+from timeit import default_timer
+
+from OpenSSL import SSL
+from twisted.internet import defer
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from zope.interface import implementer
+
+from txmsgpackrpc.metrics import Histogram
+
+try:
+    from OpenSSL._util import lib as _lib
+    _sessionReused = _lib.SSL_session_reused
+except (ImportError, AttributeError):
+    _sessionReused = None
+
+
+def sessionReused(connection):
+    """
+    Return True if handshake of C{connection} resumed previous session, or
+    None if pyOpenSSL can't tell.
+
+    @param connection: connection after finished handshake.
+    @type connection: C{OpenSSL.SSL.Connection}
+    """
+    if _sessionReused is None:
+        return None
+    return bool(_sessionReused(connection._ssl))
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class TLSSessionCache(object):
+    """
+    Creator of client TLS connections sharing one TLS session. Pass it to
+    C{reactor.connectSSL} in place of the options it wraps.
+
+    @ivar session: the last negotiated session or None.
+    @ivar handshakes: number of finished handshakes.
+    @ivar resumed: number of handshakes that resumed cached session.
+    @ivar durations: histogram of handshake durations in microseconds,
+        measured from TCP connection to finished handshake.
+    """
+    def __init__(self, options=None, timer=default_timer, clock=None):
+        """
+        @param options: the security properties of the connections.
+            If None is passed, default options object is created.
+            Default is None.
+        @type options: C{CertificateOptions} or provider of
+            C{IOpenSSLClientConnectionCreator}
+        @param timer: function returning current time in seconds.
+            Default is C{timeit.default_timer}.
+        @param clock: provider of C{IReactorTime}. Default is reactor.
+        """
+        if options is None:
+            from twisted.internet import ssl
+            options = ssl.CertificateOptions()
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.options = options
+        self.timer = timer
+        self.clock = clock
+        self.session = None
+        self.handshakes = 0
+        self.resumed = 0
+        self.durations = Histogram()
+        self._waiting = []
+
+    @property
+    def full(self):
+        """
+        Number of handshakes that negotiated new session.
+        """
+        return self.handshakes - self.resumed
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        if IOpenSSLClientConnectionCreator.providedBy(self.options):
+            connection = self.options.clientConnectionForTLS(tlsProtocol)
+        else:
+            connection = SSL.Connection(self.options.getContext(), None)
+            connection.set_connect_state()
+        if self.session is not None:
+            try:
+                connection.set_session(self.session)
+            except SSL.Error:
+                # session of different context, negotiate new one
+                self.session = None
+        started = self.timer()
+        finished = []
+
+        def infoCallback(conn, where, ret):
+            if where & SSL.SSL_CB_HANDSHAKE_DONE:
+                if not finished:
+                    finished.append(True)
+                    self.handshakeDone(conn, self.timer() - started)
+                if conn.get_protocol_version_name() != 'TLSv1.3':
+                    self._storeSession(conn)
+            elif finished and where & SSL.SSL_CB_LOOP:
+                # TLS 1.3 session is resumable only with session ticket,
+                # which server sends after the handshake
+                self._storeSession(conn)
+
+        connection.set_info_callback(infoCallback)
+        return connection
+
+    def _storeSession(self, connection):
+        session = connection.get_session()
+        if session is None:
+            return
+        self.session = session
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(session)
+
+    def handshakeDone(self, connection, duration):
+        self.handshakes += 1
+        if sessionReused(connection):
+            self.resumed += 1
+        self.durations.record(duration * 1000000)
+
+    def waitForSession(self, timeout=None):
+        """
+        Return Deferred that callbacks with session when one is negotiated,
+        i.e. the following connections can resume it.
+
+        @param timeout: number of seconds after which the Deferred callbacks
+            with None if no session was negotiated, e.g. the server doesn't
+            issue session tickets. Default is None, i.e. wait forever.
+        @type timeout: C{int} or C{float}
+        """
+        if self.session is not None:
+            return defer.succeed(self.session)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        if timeout is not None:
+            call = self.clock.callLater(timeout, self._waitTimedOut, d)
+            d.addBoth(self._cancelWaitTimeout, call)
+        return d
+
+    def _waitTimedOut(self, d):
+        self._waiting.remove(d)
+        d.callback(None)
+
+    def _cancelWaitTimeout(self, result, call):
+        if call.active():
+            call.cancel()
+        return result
+
+    def clear(self):
+        """
+        Forget cached session, the next connection negotiates new one.
+        """
+        self.session = None
+
+    def snapshot(self):
+        """
+        Return dictionary of handshake counts and durations in microseconds.
+        """
+        p50, p90, p99 = self.durations.percentiles((50, 90, 99))
+        return {
+            'handshakes': self.handshakes,
+            'resumed': self.resumed,
+            'full': self.full,
+            'duration_mean_us': self.durations.mean(),
+            'duration_p50_us': p50,
+            'duration_p90_us': p90,
+            'duration_p99_us': p99,
+        }
+
+
+__all__ = ['TLSSessionCache', 'sessionReused']